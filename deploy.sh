@@ -12,6 +12,11 @@ pkill -f "node src/index.js" || true
 echo "Building the application..."
 npm run build
 
+# Build the centroids for the embeddings analysis engine (needs OPENAI_API_KEY);
+# without them that engine falls back to the local analysis
+echo "Building embedding centroids..."
+npm run build-centroids || echo "Warning: could not build embedding centroids, the embeddings engine will use the local analysis"
+
 # Start the server in production mode
 echo "Starting server in production mode..."
 npm run prod &
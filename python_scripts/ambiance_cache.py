@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Ambiance Cache for Storia
+
+A small on-disk cache shared by the Python scripts. Analyses are stored as
+JSON, audio clips, embeddings and downloaded books as raw bytes, all keyed by
+a SHA-256 hash of their inputs, so repeated pages and prompts can be served
+without calling the upstream providers. Page entries map a book page to its
+ambiance prompt, so the Node reader route (src/ambiance_cache.js) can find the
+clip prepared for the page it is showing.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+import resilience
+import profiling
+
+logger = logging.getLogger('ambiance_cache')
+
+CACHE_DIR = Path(os.getenv('STORIA_CACHE_DIR', resilience.STATE_DIR / 'cache'))
+
+def content_key(*parts):
+    """Build a cache key from the given parts"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def normalize_text(text):
+    """
+    Collapse whitespace so the same page text hashes the same whether it comes
+    from the server-side pagination or from the reader's rendered paragraphs
+    """
+    return ' '.join(text.split())
+
+def _path(kind, key, suffix):
+    return CACHE_DIR / kind / key[:2] / f"{key}{suffix}"
+
+def _write_atomic(path, data):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f"{path.suffix}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not write cache entry {path}: {str(e)}")
+        return False
+
+@profiling.phase('cache')
+def get_analysis(text):
+    """Return the cached analysis for a text, or None"""
+    path = _path('analysis', content_key(normalize_text(text)), '.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            analysis = json.load(f)
+        logger.info(f"Analysis cache hit: {path.name}")
+        return analysis
+    except (OSError, ValueError):
+        return None
+
+@profiling.phase('cache')
+def put_analysis(text, analysis):
+    """Cache a complete analysis for a text"""
+    path = _path('analysis', content_key(normalize_text(text)), '.json')
+    return _write_atomic(path, json.dumps(analysis).encode('utf-8'))
+
+def clip_key(prompt, duration_seconds, prompt_influence):
+    """Cache key for a generated clip"""
+    return content_key(prompt.strip(), f"{float(duration_seconds):.2f}", f"{float(prompt_influence):.2f}")
+
+@profiling.phase('cache')
+def get_clip(key):
+    """Return cached audio bytes for a clip key, or None"""
+    path = _path('clips', key, '.audio')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        logger.info(f"Clip cache hit: {path.name} ({len(data)} bytes)")
+        return data
+    except OSError:
+        return None
+
+@profiling.phase('cache')
+def put_clip(key, audio_data):
+    """Cache audio bytes under a clip key"""
+    return _write_atomic(_path('clips', key, '.audio'), audio_data)
+
+@profiling.phase('cache')
+def get_embedding(model, text):
+    """Return the cached embedding vector for a text, or None"""
+    path = _path('embeddings', content_key(model, normalize_text(text)), '.f32')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+@profiling.phase('cache')
+def put_embedding(model, text, vector_bytes):
+    """Cache an embedding vector (raw float32 bytes) for a text"""
+    return _write_atomic(_path('embeddings', content_key(model, normalize_text(text)), '.f32'), vector_bytes)
+
+@profiling.phase('cache')
+def get_book(book_id):
+    """Return the cached raw text of a book, or None"""
+    try:
+        with open(_path('books', content_key('book', book_id), '.txt'), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+@profiling.phase('cache')
+def put_book(book_id, raw_bytes):
+    """Cache the raw text of a book, so the prefetch and the warm-up do not download it again"""
+    return _write_atomic(_path('books', content_key('book', book_id), '.txt'), raw_bytes)
+
+@profiling.phase('cache')
+def get_page(book_id, page):
+    """Return the cached ambiance entry for a book page, or None"""
+    path = _path('pages', content_key('page', book_id, page), '.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@profiling.phase('cache')
+def put_page(book_id, page, entry):
+    """Cache the ambiance entry (prompt, mood and setting) for a book page"""
+    path = _path('pages', content_key('page', book_id, page), '.json')
+    return _write_atomic(path, json.dumps(entry).encode('utf-8'))
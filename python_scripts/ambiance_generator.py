@@ -11,11 +11,16 @@ import sys
 import json
 import argparse
 from pathlib import Path
+import profiling  # Imported before the heavier modules so --profile wall times their import
 from dotenv import load_dotenv
 import openai
 from openai import OpenAI
 import logging
 import traceback  # Added for more detailed error tracing
+import re
+import resilience
+import ambiance_cache
+from deadline import Deadline
 
 # Set up logging with more detailed format - send logs to stderr instead of stdout
 logging.basicConfig(
@@ -27,6 +32,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger('ambiance_generator')
 
+# Minimum time worth giving the OpenAI analysis call when running under a deadline
+MIN_ANALYSIS_SECONDS = 0.8
+
+# Keyword tables for the local (no network) analysis used when the deadline
+# does not leave enough time for OpenAI. Mirrors generateMusicPrompt in src/index.js
+MOOD_KEYWORDS = {
+    'happy': ['happy', 'joy', 'laugh', 'smile', 'delight', 'cheerful', 'merry'],
+    'sad': ['sad', 'sorrow', 'grief', 'weep', 'tear', 'mourn', 'melancholy'],
+    'tense': ['fear', 'danger', 'threat', 'worry', 'anxious', 'terror', 'horror'],
+    'peaceful': ['peace', 'calm', 'tranquil', 'serene', 'gentle', 'quiet', 'still'],
+    'exciting': ['adventure', 'thrill', 'exciting', 'action', 'rush', 'speed', 'chase'],
+    'romantic': ['love', 'romance', 'passion', 'embrace', 'kiss', 'tender', 'affection'],
+    'mysterious': ['mystery', 'secret', 'unknown', 'strange', 'curious', 'wonder', 'enigma']
+}
+
+SETTING_KEYWORDS = {
+    'forest': ['forest', 'wood', 'woods', 'tree', 'trees', 'leaves', 'glade'],
+    'sea': ['sea', 'ocean', 'wave', 'waves', 'ship', 'shore', 'beach', 'sail'],
+    'city': ['city', 'street', 'streets', 'town', 'carriage', 'crowd', 'market'],
+    'house': ['house', 'room', 'hall', 'fire', 'hearth', 'window', 'door', 'chamber'],
+    'countryside': ['field', 'fields', 'meadow', 'farm', 'village', 'hill', 'hills'],
+    'storm': ['storm', 'rain', 'thunder', 'lightning', 'wind', 'tempest']
+}
+
+SETTING_SOUNDS = {
+    'forest': ['rustling leaves', 'birdsong'],
+    'sea': ['waves', 'seagulls'],
+    'city': ['distant crowd', 'horse carriages'],
+    'house': ['fire crackling', 'clock ticking'],
+    'countryside': ['wind through grass', 'distant birds'],
+    'storm': ['rain', 'distant thunder']
+}
+
+def _count_keywords(text, keywords):
+    return sum(len(re.findall(rf"\b{re.escape(keyword)}\b", text)) for keyword in keywords)
+
+def analyze_text_locally(text):
+    """
+    Analyze the text with keyword matching only, without calling OpenAI
+
+    Args:
+        text (str): The text content to analyze
+
+    Returns:
+        dict: Analysis results including mood, setting, and ambiance prompt
+    """
+    excerpt = text[:4000].lower()
+
+    mood_counts = {mood: _count_keywords(excerpt, words) for mood, words in MOOD_KEYWORDS.items()}
+    setting_counts = {setting: _count_keywords(excerpt, words) for setting, words in SETTING_KEYWORDS.items()}
+
+    mood = max(mood_counts, key=mood_counts.get) if max(mood_counts.values()) > 0 else "neutral"
+    setting = max(setting_counts, key=setting_counts.get) if max(setting_counts.values()) > 0 else "unspecified"
+    ambient_sounds = SETTING_SOUNDS.get(setting, [])
+
+    ambiance_prompt = f"Subtle {mood} background ambiance"
+    if setting != "unspecified":
+        ambiance_prompt += f" in a {setting} setting"
+    if ambient_sounds:
+        ambiance_prompt += f" with {' and '.join(ambient_sounds)}"
+    ambiance_prompt += ", instrumental without vocals"
+
+    logger.info(f"Local analysis: mood={mood}, setting={setting}")
+    return {
+        "mood": mood,
+        "setting": setting,
+        "ambient_sounds": ambient_sounds,
+        "ambiance_prompt": ambiance_prompt,
+        "source": "local"
+    }
+
+@profiling.phase('environment')
 def load_environment():
     """Load environment variables from .env files"""
     logger.info("Starting environment loading process")
@@ -62,12 +139,183 @@ def load_environment():
     logger.info(f"API key starts with: {api_key[:5]}***")
     return True
 
-def analyze_text_content(text):
+# Compact JSON schema for the structured analysis. Output tokens dominate
+# completion latency, so the reply is kept small
+STRUCTURED_SYSTEM_PROMPT = """
+You analyze book passages for background ambiance. Reply with only a JSON object:
+{"mood": "<one or two words>", "setting": "<one to three words>",
+ "sounds": ["<ambient sound>", ...], "prompt": "<ambiance prompt, max 40 words>"}
+"sounds" lists at most 4 short ambient sounds present in the scene. "prompt"
+describes subtle instrumental music and soundscape matching the mood and setting.
+"""
+STRUCTURED_MAX_TOKENS = 150
+MAX_STRUCTURED_SOUNDS = 4
+
+# Free-form numbered list used by the legacy text output mode
+TEXT_SYSTEM_PROMPT = """
+You are an expert at analyzing text and extracting emotional mood and setting details.
+Analyze the provided text and extract:
+1. The dominant emotional mood (e.g., joyful, tense, melancholic, peaceful)
+2. The setting or environment described (e.g., forest, urban, ocean, space)
+3. Any notable ambient sounds that would be present in this scene
+4. A concise prompt (max 100 words) for generating background ambiance that combines 
+   subtle music and soundscape elements matching the mood and setting
+"""
+TEXT_MAX_TOKENS = 500
+
+@profiling.phase('parsing')
+def parse_structured_analysis(content):
+    """
+    Validate a structured analysis reply against the compact schema
+
+    Args:
+        content (str): The JSON reply from the model
+
+    Returns:
+        dict: Analysis results including mood, setting, and ambiance prompt
+
+    Raises:
+        ValueError: If the reply is not valid JSON or does not match the schema
+    """
+    try:
+        data = json.loads(content or "")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"reply is not valid JSON: {str(e)}")
+    if not isinstance(data, dict):
+        raise ValueError("reply is not a JSON object")
+
+    for field in ("mood", "setting", "prompt"):
+        if not isinstance(data.get(field), str) or not data[field].strip():
+            raise ValueError(f"'{field}' must be a non-empty string")
+
+    sounds = data.get("sounds", [])
+    if not isinstance(sounds, list) or not all(isinstance(sound, str) for sound in sounds):
+        raise ValueError("'sounds' must be a list of strings")
+
+    return {
+        "mood": data["mood"].strip(),
+        "setting": data["setting"].strip(),
+        "ambient_sounds": [sound.strip() for sound in sounds if sound.strip()][:MAX_STRUCTURED_SOUNDS],
+        "ambiance_prompt": data["prompt"].strip()
+    }
+
+def request_structured_analysis(client, text, deadline=None):
+    """
+    Ask OpenAI for a compact JSON analysis, retrying once if the reply does
+    not match the schema
+
+    Raises:
+        ValueError: If both replies fail validation
+    """
+    messages = [
+        {"role": "system", "content": STRUCTURED_SYSTEM_PROMPT},
+        {"role": "user", "content": text}
+    ]
+    for attempt in range(2):
+        logger.info("Sending structured analysis request to OpenAI API...")
+        response = resilience.call_provider('openai', lambda: client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            temperature=0.4,
+            max_tokens=STRUCTURED_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        ), timeout_s=deadline.stage_budget('analysis') if deadline else None)
+
+        content = response.choices[0].message.content
+        logger.info(f"Structured analysis response: {content}")
+        try:
+            analysis = parse_structured_analysis(content)
+            logger.info(f"Extracted mood: {analysis['mood']}, setting: {analysis['setting']}")
+            return analysis
+        except ValueError as e:
+            logger.warning(f"Structured analysis failed validation (attempt {attempt + 1}): {str(e)}")
+            if attempt == 1:
+                raise
+            if deadline and not deadline.check('analysis', MIN_ANALYSIS_SECONDS):
+                raise
+            messages = messages + [
+                {"role": "assistant", "content": content or ""},
+                {"role": "user", "content": f"That reply was invalid ({str(e)}). Reply with only the JSON object."}
+            ]
+
+@profiling.phase('parsing')
+def parse_text_analysis(analysis_text):
+    """
+    Parse the free-form numbered list returned in text output mode
+
+    Args:
+        analysis_text (str): The reply from the model
+
+    Returns:
+        dict: Analysis results including mood, setting, and ambiance prompt
+    """
+    mood = "neutral"
+    setting = "unspecified"
+    ambient_sounds = []
+    ambiance_prompt = ""
+
+    lines = [line.strip() for line in analysis_text.split('\n')]
+    for index, line in enumerate(lines):
+        if line.startswith("1.") and "mood" in line.lower():
+            mood = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
+            logger.info(f"Extracted mood: {mood}")
+        elif line.startswith("2.") and "setting" in line.lower():
+            setting = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
+            logger.info(f"Extracted setting: {setting}")
+        elif line.startswith("3.") and "ambient" in line.lower():
+            sounds_text = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
+            ambient_sounds = [s.strip() for s in sounds_text.split(',')]
+            logger.info(f"Extracted ambient sounds: {ambient_sounds}")
+        elif line.startswith("4.") and "prompt" in line.lower():
+            ambiance_prompt = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
+            # If the prompt continues on next lines, capture those too
+            for next_line in lines[index + 1:]:
+                if next_line and not next_line.startswith(("1.", "2.", "3.")):
+                    ambiance_prompt += " " + next_line
+            logger.info(f"Extracted ambiance prompt: {ambiance_prompt}")
+
+    # If we couldn't extract a proper prompt, use the whole analysis
+    if not ambiance_prompt:
+        ambiance_prompt = analysis_text
+        logger.warning("Could not extract structured prompt, using full analysis")
+
+    return {
+        "mood": mood,
+        "setting": setting,
+        "ambient_sounds": ambient_sounds,
+        "ambiance_prompt": ambiance_prompt
+    }
+
+def request_text_analysis(client, text, deadline=None):
+    """Ask OpenAI for the free-form numbered analysis (legacy text output mode)"""
+    logger.info("Sending request to OpenAI API...")
+    response = resilience.call_provider('openai', lambda: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": TEXT_SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        temperature=0.7,
+        max_tokens=TEXT_MAX_TOKENS
+    ), timeout_s=deadline.stage_budget('analysis') if deadline else None)
+
+    # Extract the response content
+    analysis_text = response.choices[0].message.content
+    logger.info("Successfully received analysis from OpenAI")
+    logger.info(f"Full analysis response: {analysis_text}")
+    return parse_text_analysis(analysis_text)
+
+def analyze_text_content(text, deadline=None, output_mode='structured'):
     """
     Analyze the text content using OpenAI API to extract emotional mood and setting
     
     Args:
         text (str): The text content to analyze
+        deadline (Deadline): Optional time budget; when it runs short the local
+            keyword analysis is returned instead (as it is when the centroid
+            file has not been built yet)
+        output_mode (str): 'structured' for the compact JSON reply (default) or
+            'text' for the legacy free-form numbered list
         
     Returns:
         dict: Analysis results including mood, setting, and ambiance prompt
@@ -87,6 +335,9 @@ def analyze_text_content(text):
         text = text[:max_length] + "..."
         logger.info(f"Text truncated to {max_length} characters")
     
+    if deadline and not deadline.check('analysis', MIN_ANALYSIS_SECONDS):
+        return analyze_text_locally(text)
+    
     try:
         logger.info("Creating OpenAI client and sending request")
         # Print first 100 characters of the text for debugging
@@ -111,8 +362,10 @@ def analyze_text_content(text):
         from openai import OpenAI
         
         try:
-            # Create the OpenAI client using the environment variable
-            client = OpenAI()
+            # Create the OpenAI client using the environment variable.
+            # Timeouts and retries are handled by the resilience layer
+            policy = resilience.get_policy('openai')
+            client = OpenAI(timeout=policy['timeout_s'], max_retries=0)
             logger.info("Successfully created OpenAI client using environment variable")
         except Exception as e:
             logger.error(f"Failed to create OpenAI client: {str(e)}")
@@ -124,78 +377,77 @@ def analyze_text_content(text):
                 "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
             }
         
-        # Create the analysis prompt
-        system_prompt = """
-        You are an expert at analyzing text and extracting emotional mood and setting details.
-        Analyze the provided text and extract:
-        1. The dominant emotional mood (e.g., joyful, tense, melancholic, peaceful)
-        2. The setting or environment described (e.g., forest, urban, ocean, space)
-        3. Any notable ambient sounds that would be present in this scene
-        4. A concise prompt (max 100 words) for generating background ambiance that combines 
-           subtle music and soundscape elements matching the mood and setting
-        """
-        
-        logger.info("Sending request to OpenAI API...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text}
-            ],
-            temperature=0.7,
-            max_tokens=500
-        )
-        
-        # Extract the response content
-        analysis_text = response.choices[0].message.content
-        logger.info("Successfully received analysis from OpenAI")
-        logger.info(f"Full analysis response: {analysis_text}")
-        
-        # Parse the analysis to extract structured information
-        mood = "neutral"
-        setting = "unspecified"
-        ambient_sounds = []
-        ambiance_prompt = ""
-        
-        # Simple parsing of the response
-        lines = analysis_text.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith("1.") and "mood" in line.lower():
-                mood = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
-                logger.info(f"Extracted mood: {mood}")
-            elif line.startswith("2.") and "setting" in line.lower():
-                setting = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
-                logger.info(f"Extracted setting: {setting}")
-            elif line.startswith("3.") and "ambient" in line.lower():
-                sounds_text = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
-                ambient_sounds = [s.strip() for s in sounds_text.split(',')]
-                logger.info(f"Extracted ambient sounds: {ambient_sounds}")
-            elif line.startswith("4.") and "prompt" in line.lower():
-                ambiance_prompt = line.split(":", 1)[1].strip() if ":" in line else line[2:].strip()
-                # If the prompt continues on next lines, capture those too
-                prompt_index = lines.index(line)
-                for i in range(prompt_index + 1, len(lines)):
-                    if lines[i].strip() and not lines[i].strip().startswith(("1.", "2.", "3.")):
-                        ambiance_prompt += " " + lines[i].strip()
-                logger.info(f"Extracted ambiance prompt: {ambiance_prompt}")
-        
-        # If we couldn't extract a proper prompt, use the whole analysis
-        if not ambiance_prompt:
-            ambiance_prompt = analysis_text
-            logger.warning("Could not extract structured prompt, using full analysis")
+        if output_mode == 'text':
+            return request_text_analysis(client, text, deadline)
+        return request_structured_analysis(client, text, deadline)
         
+    except resilience.ProviderUnavailableError as e:
+        # The circuit breaker is open or every attempt failed; the local
+        # analysis still gives the reader an ambiance for this page
+        logger.warning(f"OpenAI unavailable, using local analysis: {str(e)}")
+        if deadline:
+            deadline.skip('analysis')
+        return analyze_text_locally(text)
+    except Exception as e:
+        logger.error(f"Error analyzing text with OpenAI: {str(e)}")
+        # Print full traceback for debugging
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        if deadline:
+            # Under a deadline a partial result beats an error
+            deadline.skip('analysis')
+            return analyze_text_locally(text)
         return {
-            "mood": mood,
-            "setting": setting,
-            "ambient_sounds": ambient_sounds,
-            "ambiance_prompt": ambiance_prompt
+            "mood": "neutral",
+            "setting": "unspecified",
+            "error": str(e),
+            "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
         }
+
+def analyze_text_with_embeddings(text, deadline=None):
+    """
+    Analyze the text content by embedding it and scoring it against the
+    precomputed mood and setting centroids (see embedding_classifier.py)
+    
+    Args:
+        text (str): The text content to analyze
+        deadline (Deadline): Optional time budget; when it runs short the local
+            keyword analysis is returned instead (as it is when the centroid
+            file has not been built yet)
         
+    Returns:
+        dict: Analysis results including mood, setting, and ambiance prompt
+    """
+    logger.info(f"Starting embeddings analysis of text (length: {len(text)})")
+    if not text or len(text.strip()) < 10:
+        logger.warning("Text content too short for analysis")
+        return {
+            "mood": "neutral",
+            "setting": "unspecified",
+            "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
+        }
+    
+    if deadline and not deadline.check('analysis', MIN_ANALYSIS_SECONDS):
+        return analyze_text_locally(text)
+    
+    import embedding_classifier
+    if not embedding_classifier.CENTROIDS_FILE.exists():
+        logger.warning(
+            f"Centroid file {embedding_classifier.CENTROIDS_FILE} not found, using the local analysis "
+            f"instead. Build it with: python embedding_classifier.py --build"
+        )
+        return analyze_text_locally(text)
+    
+    try:
+        return embedding_classifier.analyze_texts(
+            [text],
+            timeout_s=deadline.stage_budget('analysis') if deadline else None
+        )[0]
     except Exception as e:
-        logger.error(f"Error analyzing text with OpenAI: {str(e)}")
-        # Print full traceback for debugging
+        logger.error(f"Error analyzing text with embeddings: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
+        if deadline:
+            deadline.skip('analysis')
+            return analyze_text_locally(text)
         return {
             "mood": "neutral",
             "setting": "unspecified",
@@ -203,12 +455,18 @@ def analyze_text_content(text):
             "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
         }
 
-def generate_ambiance_prompt(text_content):
+def generate_ambiance_prompt(text_content, deadline_ms=None, engine='chat', output_mode='structured'):
     """
     Generate an ambiance prompt based on the text content
     
     Args:
         text_content (str): The text content to analyze
+        deadline_ms (int): Optional time budget in milliseconds. When it runs
+            out the best partial result (cached or local analysis) is returned
+            and the skipped stages are listed under "skipped_stages"
+        engine (str): 'chat' for the chat completion analysis or 'embeddings'
+            for the faster centroid classifier
+        output_mode (str): Reply format for the chat engine, 'structured' or 'text'
         
     Returns:
         str: JSON string with the analysis results
@@ -216,14 +474,42 @@ def generate_ambiance_prompt(text_content):
     logger.info("--- STARTING AMBIANCE GENERATION ---")
     logger.info(f"Received text content of length: {len(text_content)}")
     
-    if not load_environment():
-        logger.error("Failed to load environment, returning default response")
-        return json.dumps({
-            "error": "Failed to load environment variables",
-            "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
-        })
+    deadline = Deadline.from_ms(deadline_ms, stages=['environment', 'analysis'])
+    
+    cached = ambiance_cache.get_analysis(text_content)
+    if cached:
+        cached["source"] = "cache"
+        if deadline:
+            cached["skipped_stages"] = []
+            cached["partial"] = False
+        logger.info("--- COMPLETED AMBIANCE GENERATION (cached) ---")
+        return json.dumps(cached)
+    
+    if deadline and not deadline.check('environment'):
+        deadline.skip('analysis')
+        analysis = analyze_text_locally(text_content)
+    else:
+        if not load_environment():
+            logger.error("Failed to load environment, returning default response")
+            return json.dumps({
+                "error": "Failed to load environment variables",
+                "ambiance_prompt": "Subtle neutral background ambiance with gentle soundscape"
+            })
+        
+        if engine == 'embeddings':
+            analysis = analyze_text_with_embeddings(text_content, deadline)
+        else:
+            analysis = analyze_text_content(text_content, deadline, output_mode)
+    
+    # Only complete chat analyses are worth serving again; embeddings are
+    # cached on their own and re-scoring them is a single matrix multiply
+    if "error" not in analysis and analysis.get("source") not in ("local", "embeddings"):
+        ambiance_cache.put_analysis(text_content, analysis)
     
-    analysis = analyze_text_content(text_content)
+    if deadline:
+        analysis["skipped_stages"] = deadline.skipped_stages
+        analysis["partial"] = bool(deadline.skipped_stages)
+        logger.info(f"Deadline: {deadline.remaining_ms()}ms left, skipped stages: {deadline.skipped_stages}")
     
     # Log the generated prompt
     logger.info(f"Final analysis results: {json.dumps(analysis)}")
@@ -238,8 +524,15 @@ def main():
     parser = argparse.ArgumentParser(description='Generate ambiance prompts from text content')
     parser.add_argument('--text', type=str, help='Text content to analyze')
     parser.add_argument('--file', type=str, help='File containing text content to analyze')
+    parser.add_argument('--deadline-ms', type=int, help='Time budget in milliseconds; returns a partial result when exceeded')
+    parser.add_argument('--engine', choices=['chat', 'embeddings'], default='chat',
+                        help='Analysis engine: chat completion or embedding centroids')
+    parser.add_argument('--output-mode', choices=['structured', 'text'], default='structured',
+                        help='Chat reply format: compact JSON (structured) or legacy numbered list (text)')
+    profiling.add_arguments(parser)
     
     args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='ambiance_generator')
     logger.info(f"Command arguments: text={args.text is not None}, file={args.file}")
     
     text_content = ""
@@ -268,7 +561,7 @@ def main():
         logger.error("No text content provided")
         return 1
     
-    result = generate_ambiance_prompt(text_content)
+    result = generate_ambiance_prompt(text_content, deadline_ms=args.deadline_ms, engine=args.engine, output_mode=args.output_mode)
     print(result)  # This will go to stdout only, while logs go to stderr
     return 0
 
@@ -88,7 +88,8 @@ def check_environment():
             "elevenlabs": check_package("elevenlabs"),
             "openai": check_package("openai"),
             "dotenv": check_package("dotenv"),
-            "requests": check_package("requests")
+            "requests": check_package("requests"),
+            "numpy": check_package("numpy")
         },
         "environment_variables": {
             "ELEVENLABS_API_KEY": os.environ.get("ELEVENLABS_API_KEY") is not None,
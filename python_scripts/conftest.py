@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Shared pytest fixtures for the Python script tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add this directory to path to import the scripts
+sys.path.append(str(Path(__file__).resolve().parent))
+import ambiance_cache
+import resilience
+
+@pytest.fixture
+def temp_cache(tmp_path, monkeypatch):
+    """Point the ambiance cache and the provider state files at a temporary directory"""
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setattr(ambiance_cache, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(resilience, 'STATE_DIR', tmp_path / 'state')
+    return cache_dir
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Deadline Budgets for Storia
+
+A Deadline carries an end-to-end time budget through the ambiance and music
+pipelines. The budget is split across named stages (environment/client setup,
+analysis, generation); each stage is checked before its blocking call, and
+stages that cannot run in time are recorded so the response can report them.
+"""
+
+import time
+import logging
+
+logger = logging.getLogger('deadline')
+
+# Relative share of the budget for each stage. Time left over by an earlier
+# stage is redistributed over the stages that follow it.
+STAGE_WEIGHTS = {
+    'environment': 0.05,
+    'analysis': 0.35,
+    'generation': 0.60,
+}
+
+class Deadline:
+    """End-to-end time budget split across pipeline stages"""
+
+    def __init__(self, budget_ms, stages=None):
+        """
+        Args:
+            budget_ms (float): Total budget in milliseconds
+            stages (list): Names of the stages this budget covers, in order
+        """
+        self.budget_s = max(float(budget_ms), 0.0) / 1000.0
+        self.started = time.monotonic()
+        self.stages = list(stages or STAGE_WEIGHTS.keys())
+        self.skipped_stages = []
+
+    @classmethod
+    def from_ms(cls, budget_ms, stages=None):
+        """Build a Deadline, or return None when no budget was given"""
+        if budget_ms is None:
+            return None
+        return cls(budget_ms, stages)
+
+    def remaining(self):
+        """Seconds left in the overall budget"""
+        return max(self.budget_s - (time.monotonic() - self.started), 0.0)
+
+    def remaining_ms(self):
+        return int(self.remaining() * 1000)
+
+    def expired(self):
+        return self.remaining() <= 0.0
+
+    def stage_budget(self, stage):
+        """
+        Seconds available to a stage: its share of what is left, weighted
+        against the stages that still have to run after it
+        """
+        if stage not in self.stages:
+            return self.remaining()
+        upcoming = self.stages[self.stages.index(stage):]
+        total_weight = sum(STAGE_WEIGHTS.get(name, 0.0) for name in upcoming)
+        if total_weight <= 0:
+            return self.remaining()
+        return self.remaining() * STAGE_WEIGHTS.get(stage, 0.0) / total_weight
+
+    def check(self, stage, min_seconds=0.0):
+        """
+        Check whether a stage can start; records it as skipped otherwise
+
+        Args:
+            stage (str): Stage name
+            min_seconds (float): Minimum time the stage needs to be useful
+
+        Returns:
+            bool: True if the stage should run
+        """
+        budget = self.stage_budget(stage)
+        if self.expired() or budget < min_seconds:
+            logger.warning(f"Skipping stage '{stage}': {budget * 1000:.0f}ms available, {min_seconds * 1000:.0f}ms needed")
+            self.skip(stage)
+            return False
+        logger.info(f"Starting stage '{stage}' with {budget * 1000:.0f}ms budget ({self.remaining_ms()}ms left overall)")
+        return True
+
+    def skip(self, stage):
+        """Record a stage as skipped"""
+        if stage not in self.skipped_stages:
+            self.skipped_stages.append(stage)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Embedding Classifier for Storia
+
+A cheaper alternative to the chat completion analysis: page text is embedded
+with OpenAI's embeddings API and scored against precomputed mood and setting
+centroids with a single matrix multiply. The ambiance prompt is then built
+from templates.
+
+The centroids are built offline from the seed phrases below:
+
+    python embedding_classifier.py --build
+
+Many pages can be classified in one embeddings request:
+
+    python embedding_classifier.py --classify page1.txt page2.txt ...
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+import traceback
+from pathlib import Path
+
+import profiling  # Imported before the heavier modules so --profile wall times their import
+import numpy as np
+
+import resilience
+import ambiance_cache
+
+# Set up logging - use stderr instead of stdout for logs
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger('embedding_classifier')
+
+EMBEDDING_MODEL = os.getenv('STORIA_EMBEDDING_MODEL', 'text-embedding-3-small')
+CENTROIDS_FILE = Path(os.getenv(
+    'STORIA_CENTROIDS_FILE',
+    Path(__file__).resolve().parent / 'embedding_centroids.npz'
+))
+
+# Maximum number of texts sent in a single embeddings request
+EMBEDDING_BATCH_SIZE = 96
+
+# Only the beginning of a page is embedded; it carries enough of the scene
+MAX_TEXT_LENGTH = 4000
+
+# Seed phrases used to build the centroid for each label
+MOOD_SEEDS = {
+    'joyful': ["a happy, cheerful scene full of laughter and delight", "they smiled and laughed with joy"],
+    'melancholic': ["a sad, sorrowful scene of grief and loss", "she wept quietly, mourning what was gone"],
+    'tense': ["a tense, frightening scene full of danger and dread", "his heart pounded as footsteps drew closer"],
+    'peaceful': ["a calm, tranquil and serene moment", "all was quiet and still, a gentle peace settled"],
+    'adventurous': ["an exciting adventure with action and a chase", "they raced onward, thrilled by the danger ahead"],
+    'romantic': ["a tender, romantic scene of love and affection", "he took her hand and they embraced"],
+    'mysterious': ["a strange, mysterious scene full of secrets", "something unknown stirred in the shadows"],
+    'solemn': ["a grave, solemn and formal occasion", "they stood in silence before the altar"],
+}
+
+SETTING_SEEDS = {
+    'forest': ["a forest of tall trees with rustling leaves", "deep in the woods beneath the branches"],
+    'sea': ["a ship on the open ocean with waves and wind", "the shore where the sea meets the sand"],
+    'city': ["busy city streets with crowds and carriages", "a bustling town market full of people"],
+    'house': ["inside a house, a room with a fire in the hearth", "a quiet chamber with candles and old furniture"],
+    'countryside': ["open fields, meadows and a small village", "rolling hills and farmland under the sky"],
+    'storm': ["a violent storm with rain, thunder and lightning", "the wind howled and the rain lashed down"],
+    'battlefield': ["a battlefield with soldiers, cannon and clashing swords", "the army marched to war"],
+    'night': ["a dark, silent night under the moon and stars", "the village slept beneath the night sky"],
+}
+
+SETTING_SOUNDS = {
+    'forest': ['rustling leaves', 'birdsong'],
+    'sea': ['waves', 'seagulls'],
+    'city': ['distant crowd', 'horse carriages'],
+    'house': ['fire crackling', 'clock ticking'],
+    'countryside': ['wind through grass', 'distant birds'],
+    'storm': ['rain', 'distant thunder'],
+    'battlefield': ['distant drums', 'wind'],
+    'night': ['crickets', 'soft wind'],
+}
+
+PROMPT_TEMPLATE = "Subtle {mood} background ambiance in a {setting} setting with {sounds}, instrumental without vocals"
+
+def create_client():
+    """Create an OpenAI client; timeouts and retries are handled by the resilience layer"""
+    from openai import OpenAI
+    policy = resilience.get_policy('openai')
+    return OpenAI(timeout=policy['timeout_s'], max_retries=0)
+
+def embed_texts(texts, client=None, timeout_s=None):
+    """
+    Embed texts, using cached embeddings where available
+
+    Uncached texts are sent in as few requests as possible
+    (EMBEDDING_BATCH_SIZE texts per request).
+
+    Args:
+        texts (list): Texts to embed
+        client (OpenAI): Optional client to reuse
+        timeout_s (float): Optional time limit for each request
+
+    Returns:
+        numpy.ndarray: float32 matrix with one row per text
+    """
+    texts = [text[:MAX_TEXT_LENGTH] for text in texts]
+    vectors = [None] * len(texts)
+    missing = []
+    for index, text in enumerate(texts):
+        cached = ambiance_cache.get_embedding(EMBEDDING_MODEL, text)
+        if cached:
+            vectors[index] = np.frombuffer(cached, dtype=np.float32)
+        else:
+            missing.append(index)
+    logger.info(f"Embedding {len(texts)} texts ({len(texts) - len(missing)} cached, {len(missing)} to request)")
+
+    if missing:
+        client = client or create_client()
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            response = resilience.call_provider('openai', lambda: client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=[texts[index] for index in batch]
+            ), timeout_s=timeout_s)
+            for index, item in zip(batch, response.data):
+                vector = np.asarray(item.embedding, dtype=np.float32)
+                vectors[index] = vector
+                ambiance_cache.put_embedding(EMBEDDING_MODEL, texts[index], vector.tobytes())
+
+    return np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+def normalize_rows(matrix):
+    """Scale each row to unit length so dot products are cosine similarities"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def build_centroids(output_file=None, client=None):
+    """
+    Embed the seed phrases and save one normalized centroid per label
+
+    Args:
+        output_file (Path): Where to write the .npz file (default: CENTROIDS_FILE)
+        client (OpenAI): Optional client to reuse
+
+    Returns:
+        Path: The file written
+    """
+    def centroids_for(seeds):
+        labels = list(seeds)
+        phrases = [phrase for label in labels for phrase in seeds[label]]
+        embeddings = normalize_rows(embed_texts(phrases, client))
+        rows = []
+        offset = 0
+        for label in labels:
+            count = len(seeds[label])
+            rows.append(embeddings[offset:offset + count].mean(axis=0))
+            offset += count
+        return np.array(labels), normalize_rows(np.vstack(rows))
+
+    mood_labels, mood_matrix = centroids_for(MOOD_SEEDS)
+    setting_labels, setting_matrix = centroids_for(SETTING_SEEDS)
+
+    output_file = Path(output_file or CENTROIDS_FILE)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        output_file,
+        model=np.array(EMBEDDING_MODEL),
+        mood_labels=mood_labels,
+        mood_matrix=mood_matrix.astype(np.float32),
+        setting_labels=setting_labels,
+        setting_matrix=setting_matrix.astype(np.float32),
+    )
+    logger.info(f"Saved {len(mood_labels)} mood and {len(setting_labels)} setting centroids to {output_file}")
+    return output_file
+
+_centroids = None
+
+def load_centroids(centroids_file=None):
+    """Load the centroid matrices, caching them for the life of the process"""
+    global _centroids
+    centroids_file = centroids_file or CENTROIDS_FILE
+    if _centroids is None or _centroids['file'] != str(centroids_file):
+        with np.load(centroids_file) as data:
+            _centroids = {
+                'file': str(centroids_file),
+                'model': str(data['model']),
+                'mood_labels': [str(label) for label in data['mood_labels']],
+                'mood_matrix': data['mood_matrix'],
+                'setting_labels': [str(label) for label in data['setting_labels']],
+                'setting_matrix': data['setting_matrix'],
+            }
+        if _centroids['model'] != EMBEDDING_MODEL:
+            logger.warning(f"Centroids were built with {_centroids['model']}, not {EMBEDDING_MODEL}")
+    return _centroids
+
+@profiling.phase('scoring')
+def classify_embeddings(embeddings, centroids):
+    """
+    Score embeddings against the mood and setting centroids
+
+    Both label sets are scored with one matrix multiply against the stacked
+    centroid matrices.
+
+    Args:
+        embeddings (numpy.ndarray): One row per text
+        centroids (dict): Result of load_centroids
+
+    Returns:
+        list: (mood, mood_score, setting, setting_score) per row
+    """
+    moods = centroids['mood_matrix']
+    scores = normalize_rows(embeddings) @ np.vstack([moods, centroids['setting_matrix']]).T
+    mood_scores = scores[:, :len(moods)]
+    setting_scores = scores[:, len(moods):]
+
+    mood_index = mood_scores.argmax(axis=1)
+    setting_index = setting_scores.argmax(axis=1)
+    rows = np.arange(len(embeddings))
+    return [
+        (centroids['mood_labels'][m], float(ms), centroids['setting_labels'][s], float(ss))
+        for m, ms, s, ss in zip(
+            mood_index, mood_scores[rows, mood_index],
+            setting_index, setting_scores[rows, setting_index]
+        )
+    ]
+
+def build_analysis(mood, setting, mood_score=None, setting_score=None):
+    """Build an analysis result from a mood and setting using the prompt template"""
+    ambient_sounds = SETTING_SOUNDS.get(setting, [])
+    analysis = {
+        "mood": mood,
+        "setting": setting,
+        "ambient_sounds": ambient_sounds,
+        "ambiance_prompt": PROMPT_TEMPLATE.format(
+            mood=mood, setting=setting, sounds=' and '.join(ambient_sounds) or 'a gentle soundscape'
+        ),
+        "source": "embeddings"
+    }
+    if mood_score is not None:
+        analysis["scores"] = {"mood": round(mood_score, 4), "setting": round(setting_score, 4)}
+    return analysis
+
+def analyze_texts(texts, client=None, timeout_s=None, centroids_file=None):
+    """
+    Analyze many pages with one embeddings request per batch
+
+    Args:
+        texts (list): Page texts
+        client (OpenAI): Optional client to reuse
+        timeout_s (float): Optional time limit for each embeddings request
+        centroids_file (Path): Centroid file to score against (default: CENTROIDS_FILE)
+
+    Returns:
+        list: One analysis dict per text
+    """
+    if not texts:
+        return []
+    centroids = load_centroids(centroids_file)
+    embeddings = embed_texts(texts, client, timeout_s)
+    return [
+        build_analysis(mood, setting, mood_score, setting_score)
+        for mood, mood_score, setting, setting_score in classify_embeddings(embeddings, centroids)
+    ]
+
+def main():
+    """Main function to run the script from command line"""
+    parser = argparse.ArgumentParser(description='Embedding-based mood and setting classification')
+    parser.add_argument('--build', action='store_true', help='Build the centroid file from the seed phrases')
+    parser.add_argument('--classify', nargs='*', metavar='FILE', help='Text files to classify (default: JSON list of texts on stdin)')
+    parser.add_argument('--centroids', type=str, help=f'Centroid file (default: {CENTROIDS_FILE})')
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='embedding_classifier')
+
+    import ambiance_generator
+    if not ambiance_generator.load_environment():
+        logger.error("Failed to load environment variables")
+        return 1
+
+    try:
+        if args.build:
+            build_centroids(args.centroids)
+            return 0
+
+        if args.classify is None:
+            parser.print_help()
+            return 1
+
+        if args.classify:
+            texts = []
+            for file_name in args.classify:
+                with open(file_name, 'r', encoding='utf-8') as f:
+                    texts.append(f.read())
+        else:
+            texts = json.load(sys.stdin)
+
+        print(json.dumps(analyze_texts(texts, centroids_file=Path(args.centroids) if args.centroids else None)))
+        return 0
+    except Exception as e:
+        logger.error(f"Error running embedding classifier: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
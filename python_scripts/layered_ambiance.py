@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Layered Ambiance Generator for Storia
+
+Instead of generating one clip per scene, this script builds the ambiance from
+reusable stems: one per ambient sound ("rain", "fire crackling", ...) plus a
+music bed for the mood. Each stem is cached on its own, missing stems are
+requested from ElevenLabs concurrently, and the stems are mixed locally with
+NumPy. Common sounds are shared across books, so most scenes need few or no
+generation calls.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import wave
+import argparse
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling  # Imported before the heavier modules so --profile wall times their import
+import numpy as np
+from elevenlabs import ElevenLabs
+
+import resilience
+import ambiance_cache
+import music_gen
+from deadline import Deadline
+
+# Set up logging - use stderr instead of stdout for logs
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger('layered_ambiance')
+
+# Stems are requested as raw 16-bit mono PCM so they can be mixed without a decoder
+STEM_OUTPUT_FORMAT = 'pcm_22050'
+SAMPLE_RATE = 22050
+
+# Stems have a fixed length and are looped to the requested duration, so the
+# same cached stem serves every scene regardless of clip length
+STEM_DURATION_SECONDS = 10.0
+STEM_PROMPT_INFLUENCE = 0.6
+
+MAX_SOUND_STEMS = 4
+MAX_CONCURRENT_STEMS = 4
+
+MUSIC_BED_GAIN = 0.6
+SOUND_STEM_GAIN = 0.5
+FADE_SECONDS = 0.05
+PAN_SPREAD = 0.6
+
+def normalize_sound(sound):
+    """Normalize an ambient sound name so equivalent sounds share a cache entry"""
+    sound = re.sub(r"[^a-z0-9 ]+", " ", str(sound).lower())
+    return re.sub(r"\s+", " ", sound).strip()
+
+def plan_stems(analysis):
+    """
+    Build the list of stems for an analysis
+
+    Args:
+        analysis (dict): Output of ambiance_generator (mood, ambient_sounds, ...)
+
+    Returns:
+        list: Stems as dicts with name, prompt, gain and pan
+    """
+    mood = normalize_sound(analysis.get('mood') or 'neutral') or 'neutral'
+    stems = [{
+        'name': f"music bed ({mood})",
+        'prompt': f"Subtle {mood} instrumental music bed for reading, no vocals",
+        'gain': MUSIC_BED_GAIN,
+        'pan': 0.0,
+    }]
+
+    sounds = []
+    for sound in analysis.get('ambient_sounds') or []:
+        sound = normalize_sound(sound)
+        if sound and sound not in sounds:
+            sounds.append(sound)
+    sounds = sounds[:MAX_SOUND_STEMS]
+
+    for index, sound in enumerate(sounds):
+        # Spread sounds evenly across the stereo field
+        pan = 0.0 if len(sounds) == 1 else -PAN_SPREAD + 2 * PAN_SPREAD * index / (len(sounds) - 1)
+        stems.append({
+            'name': sound,
+            'prompt': f"{sound}, continuous ambient background sound effect, no music",
+            'gain': SOUND_STEM_GAIN / np.sqrt(len(sounds)),
+            'pan': pan,
+        })
+    return stems
+
+def stem_key(stem):
+    """Cache key for a stem, independent of the scene it is used in"""
+    return ambiance_cache.content_key('stem', stem['prompt'], STEM_DURATION_SECONDS, STEM_OUTPUT_FORMAT)
+
+def generate_stem(client, stem, deadline=None):
+    """Generate a single stem with ElevenLabs and cache it; returns PCM bytes or None"""
+    try:
+        pcm = resilience.call_provider('elevenlabs', lambda: b"".join(
+            client.text_to_sound_effects.convert(
+                text=stem['prompt'],
+                duration_seconds=STEM_DURATION_SECONDS,
+                prompt_influence=STEM_PROMPT_INFLUENCE,
+                output_format=STEM_OUTPUT_FORMAT,
+            )
+        ), timeout_s=deadline.stage_budget('generation') if deadline else None)
+    except Exception as e:
+        logger.error(f"Failed to generate stem '{stem['name']}': {str(e)}")
+        return None
+
+    logger.info(f"Generated stem '{stem['name']}' ({len(pcm)} bytes)")
+    ambiance_cache.put_clip(stem_key(stem), pcm)
+    return pcm
+
+def generate_missing_stems(stems, deadline=None):
+    """
+    Generate stems concurrently
+
+    Args:
+        stems (list): Stems missing from the cache
+        deadline (Deadline): Optional time budget
+
+    Returns:
+        dict: PCM bytes by stem name for the stems that were generated
+    """
+    if deadline and not deadline.check('environment'):
+        deadline.skip('generation')
+        return {}
+
+    if not music_gen.load_environment():
+        logger.error("Failed to load environment variables")
+        return {}
+
+    if resilience.CircuitBreaker('elevenlabs').is_open():
+        logger.error("ElevenLabs circuit breaker is open, skipping stem generation")
+        return {}
+
+    if deadline and not deadline.check('generation'):
+        return {}
+
+    generated = {}
+    try:
+        client = ElevenLabs(
+            api_key=os.getenv('ELEVENLABS_API_KEY'),
+            timeout=resilience.get_policy('elevenlabs')['timeout_s'],
+        )
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_STEMS) as executor:
+            results = executor.map(lambda stem: generate_stem(client, stem, deadline), stems)
+            for stem, pcm in zip(stems, results):
+                if pcm:
+                    generated[stem['name']] = pcm
+    except Exception as e:
+        logger.error(f"Error generating stems: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+    return generated
+
+def pcm_to_samples(pcm):
+    """Convert 16-bit little-endian PCM bytes to float samples in [-1, 1]"""
+    usable = len(pcm) - (len(pcm) % 2)
+    return np.frombuffer(pcm[:usable], dtype='<i2').astype(np.float32) / 32768.0
+
+@profiling.phase('mixing')
+def mix_stems(layers, duration_seconds, sample_rate=SAMPLE_RATE):
+    """
+    Mix mono stems into a stereo track with per-stem gain and panning
+
+    Args:
+        layers (list): (samples, gain, pan) tuples; pan goes from -1 (left) to 1 (right)
+        duration_seconds (float): Length of the output
+        sample_rate (int): Sample rate of the stems and the output
+
+    Returns:
+        numpy.ndarray: float32 array of shape (frames, 2)
+    """
+    frames = int(duration_seconds * sample_rate)
+    mix = np.zeros((frames, 2), dtype=np.float32)
+    fade = np.linspace(0.0, 1.0, max(int(FADE_SECONDS * sample_rate), 1), dtype=np.float32)
+
+    for samples, gain, pan in layers:
+        if samples.size == 0:
+            continue
+        samples = samples.copy()
+        # Short fades hide the seam when the stem is looped
+        if samples.size > 2 * fade.size:
+            samples[:fade.size] *= fade
+            samples[-fade.size:] *= fade[::-1]
+        looped = np.resize(samples, frames)
+
+        # Constant-power panning
+        angle = (pan + 1.0) * np.pi / 4.0
+        mix += np.outer(looped, np.array([np.cos(angle), np.sin(angle)], dtype=np.float32)) * gain
+
+    peak = float(np.max(np.abs(mix))) if mix.size else 0.0
+    if peak > 1.0:
+        mix /= peak
+    return mix
+
+@profiling.phase('mixing')
+def encode_wav(mix, sample_rate=SAMPLE_RATE):
+    """Encode a float stereo mix as 16-bit WAV bytes"""
+    pcm = (np.clip(mix, -1.0, 1.0) * 32767.0).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+def generate_layered_ambiance(analysis, duration_seconds=15.0, output_file=None, deadline_ms=None, report=None):
+    """
+    Build a layered ambiance track from an analysis
+
+    Args:
+        analysis (dict): Output of ambiance_generator (mood, ambient_sounds, ...)
+        duration_seconds (float): Length of the mixed track in seconds
+        output_file (str): Path to save the WAV audio (optional)
+        deadline_ms (int): Optional time budget; when it runs out only the
+            stems already cached are mixed
+        report (dict): Optional dict filled with cached/generated/missing stem names
+
+    Returns:
+        bytes: WAV audio data or None if no stem was available
+    """
+    deadline = Deadline.from_ms(deadline_ms, stages=['environment', 'generation'])
+    if report is None:
+        report = {}
+
+    stems = plan_stems(analysis)
+    pcm_by_name = {}
+    missing = []
+    for stem in stems:
+        pcm = ambiance_cache.get_clip(stem_key(stem))
+        if pcm:
+            pcm_by_name[stem['name']] = pcm
+        else:
+            missing.append(stem)
+    report['cached_stems'] = list(pcm_by_name)
+    report['generated_stems'] = []
+    logger.info(f"Stems: {len(stems)} planned, {len(pcm_by_name)} cached, {len(missing)} to generate")
+
+    if missing:
+        generated = generate_missing_stems(missing, deadline)
+        pcm_by_name.update(generated)
+        report['generated_stems'] = list(generated)
+
+    report['missing_stems'] = [stem['name'] for stem in stems if stem['name'] not in pcm_by_name]
+    report['skipped_stages'] = deadline.skipped_stages if deadline else []
+
+    layers = [
+        (pcm_to_samples(pcm_by_name[stem['name']]), stem['gain'], stem['pan'])
+        for stem in stems if stem['name'] in pcm_by_name
+    ]
+    if not layers:
+        logger.error("No stems available to mix")
+        return None
+
+    audio_data = encode_wav(mix_stems(layers, duration_seconds))
+    logger.info(f"Mixed {len(layers)} stems into {len(audio_data)} bytes of WAV audio")
+
+    if output_file:
+        try:
+            with open(output_file, "wb") as f:
+                f.write(audio_data)
+            logger.info(f"Saved audio to {output_file}")
+        except Exception as e:
+            logger.error(f"Error saving audio file: {str(e)}")
+
+    return audio_data
+
+def main():
+    """Main function to run the script from command line"""
+    parser = argparse.ArgumentParser(description='Generate layered ambiance from an ambiance analysis')
+    parser.add_argument('--analysis-file', type=str, help='JSON file produced by ambiance_generator.py (default: stdin)')
+    parser.add_argument('--duration', type=float, default=15.0, help='Duration in seconds')
+    parser.add_argument('--output', type=str, help='Output WAV file path')
+    parser.add_argument('--deadline-ms', type=int, help='Time budget in milliseconds; mixes only cached stems when exceeded')
+    parser.add_argument('--report-file', type=str, help='Write a JSON report (cached/generated/missing stems) to this file')
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='layered_ambiance')
+
+    try:
+        if args.analysis_file:
+            with open(args.analysis_file, 'r', encoding='utf-8') as f:
+                analysis = json.load(f)
+        elif not sys.stdin.isatty():
+            analysis = json.load(sys.stdin)
+        else:
+            logger.error("No analysis provided (no --analysis-file or stdin)")
+            parser.print_help()
+            return 1
+    except Exception as e:
+        logger.error(f"Error reading analysis: {str(e)}")
+        return 1
+
+    report = {}
+    audio_data = generate_layered_ambiance(
+        analysis,
+        duration_seconds=args.duration,
+        output_file=args.output,
+        deadline_ms=args.deadline_ms,
+        report=report
+    )
+
+    if args.report_file:
+        try:
+            with open(args.report_file, 'w', encoding='utf-8') as f:
+                json.dump(report, f)
+        except Exception as e:
+            logger.error(f"Error writing report file: {str(e)}")
+
+    if not audio_data:
+        logger.error("Failed to generate layered ambiance")
+        return 1
+
+    if not args.output and hasattr(sys.stdout, 'buffer'):
+        sys.stdout.buffer.write(audio_data)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
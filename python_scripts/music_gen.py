@@ -11,11 +11,15 @@ import sys
 import json
 import argparse
 from pathlib import Path
+import profiling  # Imported before the heavier modules so --profile wall times their import
 from dotenv import load_dotenv
 from elevenlabs import ElevenLabs
 import logging
 import traceback
 import requests
+import resilience
+import ambiance_cache
+from deadline import Deadline
 
 # Set up logging - use stderr instead of stdout for logs
 logging.basicConfig(
@@ -27,6 +31,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger('music_gen')
 
+# Below this much generation budget there is no point calling ElevenLabs at all
+MIN_GENERATION_SECONDS = 2.0
+
+# Length of the short preview clip requested when the deadline does not leave
+# room for a typical full-length generation
+PREVIEW_DURATION_SECONDS = 5.0
+
+@profiling.phase('environment')
 def load_environment():
     """Load environment variables from .env files"""
     logger.info("Starting environment loading process for music generation")
@@ -68,7 +80,18 @@ def load_environment():
     logger.info(f"API key starts with: {api_key[:5]}***")
     return True
 
-def generate_music(prompt, duration_seconds=15.0, prompt_influence=0.7, output_file=None):
+@profiling.phase('output')
+def save_audio(audio_data, output_file):
+    """Save audio data to a file, logging rather than raising on failure"""
+    try:
+        with open(output_file, "wb") as f:
+            f.write(audio_data)
+        logger.info(f"Saved audio to {output_file}")
+    except Exception as e:
+        logger.error(f"Error saving audio file: {str(e)}")
+
+def generate_music(prompt, duration_seconds=15.0, prompt_influence=0.7, output_file=None,
+                   deadline_ms=None, report=None):
     """
     Generate music based on a prompt using ElevenLabs API
     
@@ -77,14 +100,62 @@ def generate_music(prompt, duration_seconds=15.0, prompt_influence=0.7, output_f
         duration_seconds (float): Duration of the music in seconds
         prompt_influence (float): How much the prompt influences the generation (0.0-1.0)
         output_file (str): Path to save the generated audio (optional)
+        deadline_ms (int): Optional time budget in milliseconds. When it is too
+            short for a full generation a cached clip or a short preview is returned
+        report (dict): Optional dict filled with the audio "source"
+            ('cache', 'generated' or 'preview') and the "skipped_stages"
         
     Returns:
         bytes: The generated audio data or None if there was an error
     """
+    deadline = Deadline.from_ms(deadline_ms, stages=['environment', 'generation'])
+    if report is None:
+        report = {}
+    report["source"] = None
+    report["skipped_stages"] = deadline.skipped_stages if deadline else []
+    
+    cache_key = ambiance_cache.clip_key(prompt, duration_seconds, prompt_influence)
+    cached_audio = ambiance_cache.get_clip(cache_key)
+    if cached_audio:
+        report["source"] = "cache"
+        if output_file:
+            save_audio(cached_audio, output_file)
+        return cached_audio
+    
+    def cached_preview():
+        # Best partial result when the deadline rules out a new generation
+        preview_audio = ambiance_cache.get_clip(
+            ambiance_cache.clip_key(prompt, PREVIEW_DURATION_SECONDS, prompt_influence)
+        )
+        if preview_audio:
+            report["source"] = "preview"
+            if output_file:
+                save_audio(preview_audio, output_file)
+        return preview_audio
+    
+    if deadline and not deadline.check('environment'):
+        deadline.skip('generation')
+        return cached_preview()
+    
     if not load_environment():
         logger.error("Failed to load environment variables")
         return None
     
+    policy = resilience.get_policy('elevenlabs')
+    if resilience.CircuitBreaker('elevenlabs', policy).is_open():
+        logger.error("ElevenLabs circuit breaker is open, skipping generation")
+        return cached_preview()
+    
+    source = "generated"
+    if deadline:
+        if not deadline.check('generation', MIN_GENERATION_SECONDS):
+            return cached_preview()
+        if deadline.stage_budget('generation') < policy['hedge_default_s'] and duration_seconds > PREVIEW_DURATION_SECONDS:
+            logger.warning(f"Deadline too short for a full clip, requesting a {PREVIEW_DURATION_SECONDS}s preview")
+            duration_seconds = PREVIEW_DURATION_SECONDS
+            cache_key = ambiance_cache.clip_key(prompt, duration_seconds, prompt_influence)
+            source = "preview"
+    
     try:
         logger.info(f"Generating music with prompt: {prompt}")
         logger.info(f"Duration: {duration_seconds} seconds, Influence: {prompt_influence}")
@@ -96,29 +167,34 @@ def generate_music(prompt, duration_seconds=15.0, prompt_influence=0.7, output_f
             
             client = ElevenLabs(
                 api_key=api_key,
+                timeout=policy['timeout_s'],
             )
             logger.info("Successfully created ElevenLabs client")
             
-            # Test the API connection
-            try:
-                logger.info("Testing API connection...")
-                # Simple request to verify API connection
-                response = requests.get(
-                    "https://api.elevenlabs.io/v1/user",
-                    headers={"xi-api-key": api_key}
-                )
-                
-                if response.status_code == 200:
-                    logger.info("API connection test successful")
-                    subscription_data = response.json()
-                    logger.info(f"Subscription tier: {subscription_data.get('subscription', {}).get('tier', 'unknown')}")
-                    logger.info(f"Character limit: {subscription_data.get('subscription', {}).get('character_limit', 'unknown')}")
-                    logger.info(f"Character count: {subscription_data.get('subscription', {}).get('character_count', 'unknown')}")
-                else:
-                    logger.error(f"API connection test failed with status code: {response.status_code}")
-                    logger.error(f"Response: {response.text}")
-            except Exception as conn_test_error:
-                logger.error(f"API connection test failed: {str(conn_test_error)}")
+            # Test the API connection (diagnostics only, so skipped under a deadline)
+            if deadline:
+                logger.info("Skipping API connection test because a deadline is set")
+            else:
+                try:
+                    logger.info("Testing API connection...")
+                    # Simple request to verify API connection
+                    response = requests.get(
+                        "https://api.elevenlabs.io/v1/user",
+                        headers={"xi-api-key": api_key},
+                        timeout=5
+                    )
+                    
+                    if response.status_code == 200:
+                        logger.info("API connection test successful")
+                        subscription_data = response.json()
+                        logger.info(f"Subscription tier: {subscription_data.get('subscription', {}).get('tier', 'unknown')}")
+                        logger.info(f"Character limit: {subscription_data.get('subscription', {}).get('character_limit', 'unknown')}")
+                        logger.info(f"Character count: {subscription_data.get('subscription', {}).get('character_count', 'unknown')}")
+                    else:
+                        logger.error(f"API connection test failed with status code: {response.status_code}")
+                        logger.error(f"Response: {response.text}")
+                except Exception as conn_test_error:
+                    logger.error(f"API connection test failed: {str(conn_test_error)}")
                 
         except Exception as client_error:
             logger.error(f"Error creating ElevenLabs client: {str(client_error)}")
@@ -127,31 +203,32 @@ def generate_music(prompt, duration_seconds=15.0, prompt_influence=0.7, output_f
         
         logger.info("Sending request to ElevenLabs API for music generation...")
         try:
-            response = client.text_to_sound_effects.convert(
-                text=prompt,
-                prompt_influence=prompt_influence,
-                duration_seconds=duration_seconds,
-            )
+            # The response is streamed, so the chunks are joined inside the
+            # hedged call to keep the whole download within the time limit
+            audio_data = resilience.call_provider('elevenlabs', lambda: b"".join(
+                client.text_to_sound_effects.convert(
+                    text=prompt,
+                    prompt_influence=prompt_influence,
+                    duration_seconds=duration_seconds,
+                )
+            ), timeout_s=deadline.stage_budget('generation') if deadline else None)
             
             logger.info("Successfully received response from ElevenLabs")
-            
-            # Join all chunks into one bytes object
-            audio_data = b"".join(response)
             logger.info(f"Generated audio data size: {len(audio_data)} bytes")
+            report["source"] = source
+            ambiance_cache.put_clip(cache_key, audio_data)
             
             # Save to file if output_file is specified
             if output_file:
-                try:
-                    with open(output_file, "wb") as f:
-                        f.write(audio_data)
-                    logger.info(f"Saved audio to {output_file}")
-                except Exception as e:
-                    logger.error(f"Error saving audio file: {str(e)}")
+                save_audio(audio_data, output_file)
             
             return audio_data
         except Exception as api_error:
             logger.error(f"Error calling ElevenLabs API: {str(api_error)}")
             logger.error(f"Traceback: {traceback.format_exc()}")
+            if deadline:
+                deadline.skip('generation')
+                return cached_preview()
             return None
         
     except Exception as e:
@@ -167,8 +244,12 @@ def main():
     parser.add_argument('--duration', type=float, default=15.0, help='Duration in seconds')
     parser.add_argument('--influence', type=float, default=0.7, help='Prompt influence (0.0-1.0)')
     parser.add_argument('--output', type=str, help='Output file path')
+    parser.add_argument('--deadline-ms', type=int, help='Time budget in milliseconds; returns a cached clip or preview when exceeded')
+    parser.add_argument('--report-file', type=str, help='Write a JSON report (audio source, skipped stages) to this file')
+    profiling.add_arguments(parser)
     
     args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='music_gen')
     
     prompt = args.prompt
     if not prompt:
@@ -181,13 +262,23 @@ def main():
         return 1
     
     logger.info(f"Starting music generation with prompt: {prompt}")
+    report = {}
     audio_data = generate_music(
         prompt=prompt, 
         duration_seconds=args.duration,
         prompt_influence=args.influence,
-        output_file=args.output
+        output_file=args.output,
+        deadline_ms=args.deadline_ms,
+        report=report
     )
     
+    if args.report_file:
+        try:
+            with open(args.report_file, 'w', encoding='utf-8') as f:
+                json.dump(report, f)
+        except Exception as e:
+            logger.error(f"Error writing report file: {str(e)}")
+    
     if audio_data:
         logger.info(f"Successfully generated {len(audio_data)} bytes of audio data")
         # If output file wasn't specified, output to stdout
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Ambiance Prefetch for Storia
+
+Readers move forward through a book one page at a time, so the ambiance for
+the next few pages can be prepared while the current one is being read.
+Given a book and the current page, the next N pages are analyzed (cached
+analyses are reused) and compared to find where the scene changes. Only a page
+that starts a new scene gets a clip of its own; a page that continues a scene
+has its cached analysis point at the scene's prompt, so it shares the scene's
+clip instead of paying for a new one. Each prepared page is also recorded under
+its book and page number, which is how the reader's own music request finds
+the prompt and clip prepared for it.
+
+Generations are limited by a budget, and pages are handled nearest first.
+Everything finished before the process stops stays cached, so the Node bridge
+can simply kill a prefetch when the reader jumps elsewhere.
+
+Example:
+
+    python prefetch.py --book-id 1342 --page 12 --pages 5 --max-generations 2
+"""
+
+import sys
+import json
+import argparse
+import logging
+import traceback
+
+import profiling
+import ambiance_cache
+import warmup
+from deadline import Deadline
+
+# Set up logging - use stderr instead of stdout for logs
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger('prefetch')
+
+DEFAULT_PREFETCH_PAGES = 5
+MAX_PREFETCH_PAGES = 20
+
+# Maximum number of new clips generated by one prefetch run
+DEFAULT_MAX_GENERATIONS = 2
+
+def load_book_pages(book_id, last_page):
+    """Return the pages of a book up to last_page, downloading the book only once"""
+    return warmup.paginate_book(warmup.load_book(book_id), last_page + 1)
+
+def page_entry(analysis, ambiance_prompt):
+    """Page cache entry: the prompt whose clip the reader should hear"""
+    return {
+        'ambiance_prompt': ambiance_prompt,
+        'mood': analysis.get('mood'),
+        'setting': analysis.get('setting')
+    }
+
+def scene_of(analysis):
+    """Pages with the same mood and setting belong to the same scene"""
+    return (
+        str(analysis.get('mood', '')).strip().lower(),
+        str(analysis.get('setting', '')).strip().lower()
+    )
+
+def prefetch_pages(pages, current_page, count=DEFAULT_PREFETCH_PAGES,
+                   max_generations=DEFAULT_MAX_GENERATIONS, deadline_ms=None, book_id=None):
+    """
+    Analyze the pages after current_page and prepare the audio for scene changes
+
+    Args:
+        pages (list): Page texts of the book, indexed by page number
+        current_page (int): The page the reader is on
+        count (int): Number of pages to look ahead
+        max_generations (int): Maximum number of new clips to generate
+        deadline_ms (int): Optional time budget for the whole run
+        book_id (str): Book the pages belong to; when given, each analyzed page
+            is recorded in the page cache for the reader's music request
+
+    Returns:
+        dict: One entry per page with its cache key, scene, and the status of
+            its analysis ('cached', 'analyzed' or 'failed') and audio
+            ('cached', 'generated', 'same_scene', 'over_budget', 'deadline'
+            or 'failed'), plus the number of generations used. A page that
+            continues a scene is 'same_scene' only when the scene's clip is
+            ready; otherwise it carries the status of the scene's clip
+    """
+    import ambiance_generator
+    import music_gen
+
+    deadline = Deadline.from_ms(deadline_ms, stages=['analysis', 'generation'])
+    last_page = min(current_page + count, len(pages) - 1)
+    report = {'page': current_page, 'pages': [], 'generations': 0}
+
+    # The next page continues the current page's scene if its analysis is known
+    current = None
+    if 0 <= current_page < len(pages) and pages[current_page].strip():
+        current = ambiance_cache.get_analysis(pages[current_page])
+    scene = scene_of(current) if current else None
+    scene_prompt = current.get('ambiance_prompt') if current else None
+    scene_audio = scene_clip = None
+    clip_keys = set()
+    if scene_prompt:
+        scene_clip = ambiance_cache.clip_key(scene_prompt, warmup.MUSIC_DURATION_SECONDS, warmup.MUSIC_PROMPT_INFLUENCE)
+        if ambiance_cache.get_clip(scene_clip):
+            clip_keys.add(scene_clip)
+        else:
+            # Pages continuing a scene without a clip get one of their own
+            scene = scene_prompt = None
+
+    for page_number in range(current_page + 1, last_page + 1):
+        text = pages[page_number]
+        if not text.strip():
+            continue
+        if deadline and deadline.expired():
+            deadline.skip('analysis')
+            break
+
+        entry = {'page': page_number, 'key': ambiance_cache.content_key(ambiance_cache.normalize_text(text))}
+        report['pages'].append(entry)
+
+        analysis = ambiance_cache.get_analysis(text)
+        entry['analysis'] = 'cached'
+        if analysis is None:
+            analysis = json.loads(ambiance_generator.generate_ambiance_prompt(
+                text, deadline_ms=deadline.remaining_ms() if deadline else None
+            ))
+            entry['analysis'] = 'analyzed'
+            # Partial (local) analyses are not cached, so audio made from them
+            # would never be found by the reader's own request
+            if analysis.get('error') or analysis.get('source') == 'local':
+                entry['analysis'] = 'failed'
+                entry['audio'] = 'failed'
+                scene = scene_prompt = scene_audio = None
+                continue
+
+        entry['mood'], entry['setting'] = analysis.get('mood'), analysis.get('setting')
+        entry['scene_change'] = scene_of(analysis) != scene
+        if not entry['scene_change']:
+            if analysis.get('ambiance_prompt') != scene_prompt:
+                ambiance_cache.put_analysis(text, {**analysis, 'ambiance_prompt': scene_prompt, 'continues_scene': True})
+            if book_id is not None:
+                ambiance_cache.put_page(book_id, page_number, page_entry(analysis, scene_prompt))
+            entry['audio'] = 'same_scene' if scene_clip in clip_keys else scene_audio
+            continue
+        scene, scene_prompt = scene_of(analysis), analysis['ambiance_prompt']
+        if book_id is not None:
+            ambiance_cache.put_page(book_id, page_number, page_entry(analysis, scene_prompt))
+
+        clip_key = scene_clip = ambiance_cache.clip_key(scene_prompt, warmup.MUSIC_DURATION_SECONDS, warmup.MUSIC_PROMPT_INFLUENCE)
+        if clip_key in clip_keys or ambiance_cache.get_clip(clip_key):
+            entry['audio'] = 'cached'
+        elif report['generations'] >= max_generations:
+            entry['audio'] = 'over_budget'
+        elif deadline and not deadline.check('generation', music_gen.MIN_GENERATION_SECONDS):
+            entry['audio'] = 'deadline'
+        else:
+            report['generations'] += 1
+            audio = music_gen.generate_music(
+                scene_prompt,
+                duration_seconds=warmup.MUSIC_DURATION_SECONDS,
+                prompt_influence=warmup.MUSIC_PROMPT_INFLUENCE,
+                deadline_ms=deadline.remaining_ms() if deadline else None
+            )
+            entry['audio'] = 'generated' if audio else 'failed'
+        # Later pages with the same prompt only share a clip that exists
+        if entry['audio'] in ('cached', 'generated'):
+            clip_keys.add(clip_key)
+        scene_audio = entry['audio']
+
+    if deadline:
+        report['skipped_stages'] = deadline.skipped_stages
+    logger.info(
+        f"Prefetched {len(report['pages'])} pages after page {current_page}: "
+        f"{sum(1 for entry in report['pages'] if entry.get('scene_change'))} scene changes, "
+        f"{report['generations']} generations"
+    )
+    return report
+
+def main():
+    """Main function to run the script from command line"""
+    parser = argparse.ArgumentParser(description='Prefetch ambiance for the pages after the current one')
+    parser.add_argument('--book-id', type=str, required=True, help='Gutenberg book id')
+    parser.add_argument('--page', type=int, required=True, help='Page the reader is on')
+    parser.add_argument('--pages', type=int, default=DEFAULT_PREFETCH_PAGES, help='Number of pages to look ahead')
+    parser.add_argument('--max-generations', type=int, default=DEFAULT_MAX_GENERATIONS,
+                        help='Maximum number of new clips to generate')
+    parser.add_argument('--deadline-ms', type=int, help='Time budget in milliseconds for the whole run')
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='prefetch')
+
+    count = max(0, min(args.pages, MAX_PREFETCH_PAGES))
+    try:
+        pages = load_book_pages(args.book_id, args.page + count)
+        report = prefetch_pages(pages, args.page, count, args.max_generations, args.deadline_ms, args.book_id)
+    except Exception as e:
+        logger.error(f"Error prefetching book {args.book_id}: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return 1
+
+    report['book_id'] = args.book_id
+    print(json.dumps(report))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Profiling Hooks for Storia
+
+Opt-in profiling for the Python CLIs and the warm-up workers, so slow runs can
+be profiled where they happen instead of guessed at:
+
+    --profile cpu    cProfile stats sorted by cumulative time (a binary pstats
+                     dump when the output file ends in .prof)
+    --profile mem    tracemalloc top allocations, current and peak memory
+    --profile wall   wall clock per phase (startup, environment, cache,
+                     network, parsing, logging, ...)
+
+Reports go to --profile-output or stderr, never to stdout, which carries the
+results read by the Node bridge. Because the bridge spawns the CLIs, profiling
+can also be switched on with the STORIA_PROFILE and STORIA_PROFILE_OUTPUT
+environment variables; "{pid}" in the output path is replaced by the process
+id so concurrent runs do not overwrite each other.
+
+The cpu profile covers the calling thread only; provider calls run in hedging
+threads (see resilience.py) and show up there as time spent waiting.
+"""
+
+import io
+import os
+import sys
+import time
+import atexit
+import pstats
+import logging
+import cProfile
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+logger = logging.getLogger('profiling')
+
+PROFILE_MODES = ('cpu', 'mem', 'wall')
+
+# Number of functions or allocation sites listed in the cpu and mem reports
+TOP_ENTRIES = int(os.getenv('STORIA_PROFILE_TOP', 25))
+
+# Taken when this module is first imported; the CLIs import it before their
+# heavier dependencies so the "startup" phase covers those imports
+_IMPORTED_AT = time.perf_counter()
+
+class Profiler:
+    """Collects one profile (cpu, mem or wall) for the current process"""
+
+    def __init__(self, mode, output=None, label=None, top=TOP_ENTRIES):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.output = output.replace('{pid}', str(os.getpid())) if output else None
+        self.label = label or Path(sys.argv[0]).name
+        self.top = top
+        self.phases = {}
+        self.running = False
+        self._profile = None
+        self._wrapped_handlers = []
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == 'cpu':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.mode == 'mem':
+            if tracemalloc.is_tracing():
+                tracemalloc.clear_traces()
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+        else:
+            self._add_phase('startup', self.started - _IMPORTED_AT)
+            self._time_logging()
+        self.running = True
+        return self
+
+    def stop(self, write=True):
+        """Stop collecting and write the report (unless write is False)"""
+        if not self.running:
+            return
+        if write:
+            self.write_report()
+        self.running = False
+        if self._profile:
+            self._profile.disable()
+        if self.mode == 'mem':
+            tracemalloc.stop()
+        for handler, emit in self._wrapped_handlers:
+            handler.emit = emit
+        self._wrapped_handlers = []
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block under the given phase name (wall mode only)"""
+        if self.mode != 'wall':
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_phase(name, time.perf_counter() - start)
+
+    def _add_phase(self, name, seconds):
+        total, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (total + seconds, count + 1)
+
+    def _time_logging(self):
+        # Logging to stderr is synchronous, so count the time spent emitting records
+        for handler in logging.getLogger().handlers:
+            emit = handler.emit
+            def timed_emit(record, emit=emit):
+                with self.phase('logging'):
+                    emit(record)
+            handler.emit = timed_emit
+            self._wrapped_handlers.append((handler, emit))
+
+    def report(self):
+        """Build the text report for the collected profile"""
+        # A wall profile includes the startup phase, so it is timed from import
+        origin = _IMPORTED_AT if self.mode == 'wall' else self.started
+        elapsed = time.perf_counter() - origin
+        lines = [f"=== {self.mode} profile: {self.label} (pid {os.getpid()}, {elapsed * 1000:.1f}ms) ==="]
+
+        if self.mode == 'cpu':
+            stream = io.StringIO()
+            self._profile.disable()
+            pstats.Stats(self._profile, stream=stream).sort_stats('cumulative').print_stats(self.top)
+            self._profile.enable()
+            lines.append(stream.getvalue().rstrip())
+        elif self.mode == 'mem':
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"Current: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB")
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            ])
+            lines.append(f"Top {self.top} allocation sites:")
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                lines.append(f"  {stat}")
+        else:
+            # Phases can nest (logging happens inside network calls), so the
+            # shares are of the total run time and need not add up to 100%
+            lines.append(f"{'phase':<24}{'total ms':>12}{'calls':>8}{'share':>8}")
+            for name, (total, count) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+                share = total / elapsed * 100 if elapsed > 0 else 0.0
+                lines.append(f"{name:<24}{total * 1000:>12.1f}{count:>8}{share:>7.1f}%")
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self):
+        """Write the report to the output file, or to stderr if there is none"""
+        try:
+            if self.mode == 'cpu' and self.output and self.output.endswith('.prof'):
+                self._profile.disable()
+                self._profile.dump_stats(self.output)
+                self._profile.enable()
+            elif self.output:
+                with open(self.output, 'w', encoding='utf-8') as f:
+                    f.write(self.report())
+            else:
+                sys.stderr.write(self.report())
+                sys.stderr.flush()
+            if self.output:
+                logger.info(f"Wrote {self.mode} profile to {self.output}")
+        except Exception as e:
+            logger.error(f"Error writing {self.mode} profile: {str(e)}")
+
+_active = None
+
+def start(mode, output=None, label=None):
+    """
+    Start profiling this process; the report is written when it exits
+
+    Any profile inherited from a parent process (fork) is discarded first.
+
+    Args:
+        mode (str): 'cpu', 'mem', 'wall', or None to disable profiling
+        output (str): Report file ("{pid}" is replaced); stderr when omitted
+        label (str): Name shown in the report header
+
+    Returns:
+        Profiler: The active profiler, or None when mode is None
+    """
+    global _active
+    if _active:
+        _active.stop(write=False)
+        _active = None
+    if not mode:
+        return None
+    _active = Profiler(mode, output, label).start()
+    atexit.register(stop)
+    return _active
+
+def stop():
+    """Stop the active profiler, if any, and write its report"""
+    global _active
+    if _active:
+        _active.stop()
+        _active = None
+
+@contextmanager
+def phase(name):
+    """
+    Time a block as a named phase of the active wall profile
+
+    A no-op when no wall profile is running. Also usable as a decorator.
+    """
+    if _active is None or _active.mode != 'wall':
+        yield
+        return
+    with _active.phase(name):
+        yield
+
+def add_arguments(parser):
+    """Add the --profile and --profile-output options to a CLI argument parser"""
+    # argparse does not check defaults against choices, so an invalid
+    # STORIA_PROFILE is dropped here rather than failing in Profiler()
+    env_mode = os.getenv('STORIA_PROFILE') or None
+    if env_mode and env_mode not in PROFILE_MODES:
+        logger.warning(f"Ignoring invalid STORIA_PROFILE value: {env_mode} (expected one of {', '.join(PROFILE_MODES)})")
+        env_mode = None
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=env_mode,
+                        help='Profile this run: cpu (cProfile), mem (tracemalloc) or wall (per-phase timings)')
+    parser.add_argument('--profile-output', type=str, default=os.getenv('STORIA_PROFILE_OUTPUT') or None,
+                        help='Write the profile report here instead of stderr ("{pid}" is replaced; .prof gives a pstats dump in cpu mode)')
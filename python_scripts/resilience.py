@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Upstream Resilience for Storia
+
+This module wraps calls to the upstream providers (OpenAI and ElevenLabs) with
+hedged requests and a per-provider circuit breaker, so that a single stalled
+upstream response cannot hold a reader's request open indefinitely.
+
+Each CLI invocation is a separate process, so breaker state and recent latency
+samples are persisted in a small JSON file per provider.
+"""
+
+import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import logging
+from pathlib import Path
+
+import profiling
+
+logger = logging.getLogger('resilience')
+
+# Directory for small state files shared between script invocations
+STATE_DIR = Path(os.getenv('STORIA_STATE_DIR', Path(tempfile.gettempdir()) / 'storia'))
+
+# Default policy per provider. Every field can be overridden with an
+# environment variable named STORIA_<PROVIDER>_<FIELD>, e.g. STORIA_OPENAI_TIMEOUT_S
+DEFAULT_POLICIES = {
+    'openai': {
+        'timeout_s': 20.0,            # Hard limit for the whole call (all attempts)
+        'hedge_percentile': 95.0,     # Send a duplicate after this latency percentile
+        'hedge_default_s': 6.0,       # Hedge delay used until enough samples exist
+        'hedge_min_samples': 10,
+        'max_attempts': 2,            # Primary + hedged duplicate
+        'failure_threshold': 3,       # Consecutive failures/slow calls before opening
+        'slow_call_s': 12.0,          # Calls slower than this count against the breaker
+        'reset_timeout_s': 30.0,      # How long the breaker stays open before a probe
+    },
+    'elevenlabs': {
+        'timeout_s': 45.0,
+        'hedge_percentile': 95.0,
+        'hedge_default_s': 20.0,
+        'hedge_min_samples': 10,
+        'max_attempts': 2,
+        'failure_threshold': 3,
+        'slow_call_s': 30.0,
+        'reset_timeout_s': 60.0,
+    },
+}
+
+# Number of recent latency samples kept per provider
+LATENCY_WINDOW = 100
+
+# Serializes the load/modify/save of breaker state between threads of one
+# process (e.g. the stems of a layered ambiance generated in parallel)
+_state_lock = threading.RLock()
+
+# Optional semaphores bounding concurrent calls per provider, e.g. shared by
+# the worker processes of a batch job (see set_concurrency_limit)
+_concurrency_limits = {}
+
+class ProviderUnavailableError(Exception):
+    """Raised when a provider call is skipped or fails so the caller can fall back"""
+
+def get_policy(provider):
+    """
+    Get the resilience policy for a provider, applying environment overrides
+
+    Args:
+        provider (str): Provider name ('openai' or 'elevenlabs')
+
+    Returns:
+        dict: Policy values
+    """
+    policy = dict(DEFAULT_POLICIES.get(provider, DEFAULT_POLICIES['openai']))
+    for field, default in policy.items():
+        env_value = os.getenv(f"STORIA_{provider.upper()}_{field.upper()}")
+        if env_value is None:
+            continue
+        try:
+            policy[field] = type(default)(float(env_value))
+        except ValueError:
+            logger.warning(f"Ignoring invalid value for STORIA_{provider.upper()}_{field.upper()}: {env_value}")
+    return policy
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of samples using linear interpolation"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker with state persisted to disk
+
+    States:
+        closed: calls go through normally
+        open: calls are rejected until reset_timeout_s has elapsed
+        half_open: a single probe call is allowed; success closes the breaker
+
+    State changes are serialized between threads with a process-wide lock, so
+    threads calling the same provider at once see each other's updates.
+    """
+
+    def __init__(self, provider, policy=None, state_dir=None):
+        self.provider = provider
+        self.policy = policy or get_policy(provider)
+        self.state_file = Path(state_dir or STATE_DIR) / f"circuit_{provider}.json"
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'state': 'closed', 'failures': 0, 'opened_at': 0.0, 'latencies': []}
+
+    def _save(self, state):
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            # Unique per thread, so concurrent writers never share a temp file
+            tmp_file = self.state_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            logger.warning(f"Could not persist circuit state for {self.provider}: {str(e)}")
+
+    @property
+    def state(self):
+        return self._load()['state']
+
+    def is_open(self):
+        """Check whether calls are currently being rejected, without changing state"""
+        state = self._load()
+        if state['state'] == 'closed':
+            return False
+        return time.time() - state.get('opened_at', 0.0) < self.policy['reset_timeout_s']
+
+    def allow_request(self):
+        """Check whether a call may be sent, moving open -> half_open after the reset timeout"""
+        with _state_lock:
+            if self.is_open():
+                logger.warning(f"Circuit for {self.provider} is {self.state}, skipping call")
+                return False
+
+            state = self._load()
+            if state['state'] == 'closed':
+                return True
+
+            # Let exactly one probe through, then hold the breaker open again
+            # until that probe reports back (or its own reset timeout elapses)
+            logger.info(f"Circuit for {self.provider} is half-open, sending probe request")
+            state['state'] = 'half_open'
+            state['opened_at'] = time.time()
+            self._save(state)
+            return True
+
+    def record_success(self, latency_s):
+        """Record a completed call; slow calls count as failures"""
+        with _state_lock:
+            state = self._load()
+            state['latencies'] = (state.get('latencies', []) + [round(latency_s, 3)])[-LATENCY_WINDOW:]
+            if latency_s > self.policy['slow_call_s']:
+                logger.warning(f"{self.provider} call took {latency_s:.2f}s (slow threshold {self.policy['slow_call_s']}s)")
+                self._register_failure(state)
+            else:
+                if state['state'] != 'closed':
+                    logger.info(f"Probe succeeded, closing circuit for {self.provider}")
+                state['state'] = 'closed'
+                state['failures'] = 0
+            self._save(state)
+
+    def record_failure(self):
+        """Record a failed or timed-out call"""
+        with _state_lock:
+            state = self._load()
+            self._register_failure(state)
+            self._save(state)
+
+    def _register_failure(self, state):
+        state['failures'] = state.get('failures', 0) + 1
+        if state['state'] == 'half_open' or state['failures'] >= self.policy['failure_threshold']:
+            if state['state'] != 'open':
+                logger.warning(f"Opening circuit for {self.provider} after {state['failures']} failures")
+            state['state'] = 'open'
+            state['opened_at'] = time.time()
+
+    def hedge_delay(self):
+        """Delay after which a duplicate request is sent, based on recent latencies"""
+        latencies = self._load().get('latencies', [])
+        if len(latencies) < self.policy['hedge_min_samples']:
+            return self.policy['hedge_default_s']
+        return percentile(latencies, self.policy['hedge_percentile'])
+
+def hedged_call(fn, hedge_after_s, timeout_s, max_attempts=2):
+    """
+    Call fn, sending a duplicate after hedge_after_s and returning the first success
+
+    Attempts run in daemon threads so that a stalled upstream call does not
+    keep the process alive after we have returned.
+
+    Args:
+        fn (callable): Zero-argument function performing the upstream call
+        hedge_after_s (float): Seconds to wait before sending each extra attempt
+        timeout_s (float): Overall time limit across all attempts
+        max_attempts (int): Maximum number of concurrent attempts
+
+    Returns:
+        tuple: (result, attempt_number) for the first attempt that succeeded
+
+    Raises:
+        TimeoutError: If no attempt succeeded within timeout_s
+        Exception: The last attempt's error if every attempt failed
+    """
+    results = queue.Queue()
+
+    def run(attempt):
+        try:
+            results.put((attempt, True, fn()))
+        except Exception as e:
+            results.put((attempt, False, e))
+
+    deadline = time.monotonic() + timeout_s
+    next_launch = time.monotonic()
+    launched = 0
+    pending = 0
+    last_error = None
+
+    while True:
+        now = time.monotonic()
+        # Launch a new attempt when the hedge delay has passed, or straight
+        # away if every attempt so far has already failed
+        if launched < max_attempts and (now >= next_launch or pending == 0):
+            launched += 1
+            pending += 1
+            if launched > 1:
+                logger.info(f"Sending hedged request (attempt {launched})")
+            threading.Thread(target=run, args=(launched,), daemon=True).start()
+            next_launch = now + hedge_after_s
+
+        if pending == 0:
+            raise last_error
+        if now >= deadline:
+            raise TimeoutError(f"No response within {timeout_s:.1f}s after {launched} attempt(s)")
+
+        wait_until = deadline if launched >= max_attempts else min(deadline, next_launch)
+        try:
+            attempt, ok, value = results.get(timeout=max(wait_until - time.monotonic(), 0.0))
+        except queue.Empty:
+            continue
+
+        pending -= 1
+        if ok:
+            return value, attempt
+        logger.warning(f"Attempt {attempt} failed: {str(value)}")
+        last_error = value
+
+def set_concurrency_limit(provider, semaphore):
+    """
+    Bound the number of concurrent calls to a provider
+
+    Every attempt holds a slot, hedged duplicates included, and keeps it until
+    its upstream request returns. An attempt abandoned by hedged_call (timed
+    out, or overtaken by a faster one) therefore still counts against the
+    limit while it runs, and it still costs provider quota. A hedge is only
+    sent when a slot is free at that moment.
+
+    Args:
+        provider (str): Provider name ('openai' or 'elevenlabs')
+        semaphore: A threading or multiprocessing semaphore shared by all
+            callers that should count against the same limit, or None to remove it
+    """
+    if semaphore is None:
+        _concurrency_limits.pop(provider, None)
+    else:
+        _concurrency_limits[provider] = semaphore
+
+def call_provider(provider, fn, timeout_s=None):
+    """
+    Call an upstream provider through its circuit breaker with hedging
+
+    Args:
+        provider (str): Provider name ('openai' or 'elevenlabs')
+        fn (callable): Zero-argument function performing the upstream call
+        timeout_s (float): Optional tighter time limit, e.g. from a request deadline
+
+    Returns:
+        The value returned by fn
+
+    Raises:
+        ProviderUnavailableError: If the circuit is open or every attempt failed,
+            so the caller should use its fallback
+    """
+    policy = get_policy(provider)
+    breaker = CircuitBreaker(provider, policy)
+
+    if not breaker.allow_request():
+        raise ProviderUnavailableError(f"Circuit breaker for {provider} is open")
+
+    limit = _concurrency_limits.get(provider)
+    if limit is None:
+        attempt_fn = fn
+    else:
+        # Only a caller's own deadline bounds the wait for a free slot
+        wait_start = time.monotonic()
+        with profiling.phase(f"slot_wait:{provider}"):
+            acquired = limit.acquire(timeout=timeout_s)
+        if not acquired:
+            raise ProviderUnavailableError(f"No free {provider} slot within {timeout_s:.2f}s")
+        if timeout_s is not None:
+            timeout_s = max(timeout_s - (time.monotonic() - wait_start), 0.0)
+
+        # The first attempt runs on the slot acquired above; hedged attempts
+        # need a free slot of their own. Each attempt releases its slot when
+        # its request returns, even after call_provider has given up on it.
+        first_slot = queue.Queue()
+        first_slot.put(True)
+
+        def attempt_fn():
+            try:
+                first_slot.get_nowait()
+            except queue.Empty:
+                if not limit.acquire(False):
+                    raise ProviderUnavailableError(f"No free {provider} slot for a hedged request")
+            try:
+                return fn()
+            finally:
+                limit.release()
+
+    hedge_after = breaker.hedge_delay()
+    timeout = policy['timeout_s'] if timeout_s is None else min(policy['timeout_s'], timeout_s)
+    logger.info(f"Calling {provider} (hedge after {hedge_after:.2f}s, timeout {timeout:.2f}s)")
+    start = time.monotonic()
+    try:
+        with profiling.phase(f"network:{provider}"):
+            result, attempt = hedged_call(
+                attempt_fn,
+                hedge_after_s=hedge_after,
+                timeout_s=timeout,
+                max_attempts=int(policy['max_attempts'])
+            )
+    except Exception as e:
+        # A caller's tighter deadline running out says nothing about the provider
+        if not (isinstance(e, TimeoutError) and timeout < policy['timeout_s']):
+            breaker.record_failure()
+        raise ProviderUnavailableError(f"{provider} call failed: {str(e)}") from e
+
+    latency = time.monotonic() - start
+    breaker.record_success(latency)
+    logger.info(f"{provider} responded in {latency:.2f}s (attempt {attempt})")
+    return result
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Test script for deadline budgets and partial results
+"""
+
+import sys
+import json
+import time
+from pathlib import Path
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_deadline')
+
+# Add parent directory to path to import the scripts
+sys.path.append(str(Path(__file__).resolve().parent))
+from deadline import Deadline
+import ambiance_cache
+import ambiance_generator
+
+SAMPLE_TEXT = """
+The storm raged across the moor. Rain lashed down, the wind howled and distant
+thunder rolled on, and she felt a creeping fear as lightning split the sky.
+"""
+
+def test_stage_budget_is_split_by_weight():
+    """Earlier stages get their share; unused time flows to later stages"""
+    deadline = Deadline(1000, stages=['environment', 'analysis', 'generation'])
+    assert abs(deadline.stage_budget('environment') - 0.05) < 0.01
+    assert abs(deadline.stage_budget('generation') - 1.0) < 0.01
+    assert deadline.check('analysis', min_seconds=0.1)
+    assert not deadline.check('analysis', min_seconds=5.0)
+    assert deadline.skipped_stages == ['analysis']
+
+def test_expired_deadline_skips_stage():
+    deadline = Deadline(1)
+    time.sleep(0.01)
+    assert deadline.expired()
+    assert not deadline.check('generation')
+    assert 'generation' in deadline.skipped_stages
+
+def test_local_analysis_finds_mood_and_setting():
+    result = ambiance_generator.analyze_text_locally(SAMPLE_TEXT)
+    logger.info(f"Local analysis: {json.dumps(result)}")
+    assert result['mood'] == 'tense'
+    assert result['setting'] == 'storm'
+    assert result['ambient_sounds']
+    assert result['ambiance_prompt']
+
+def test_short_deadline_returns_partial_result():
+    """With no time for OpenAI the analysis falls back to the local result"""
+    deadline = Deadline(100, stages=['environment', 'analysis'])
+    result = ambiance_generator.analyze_text_content(SAMPLE_TEXT, deadline)
+    assert result['source'] == 'local'
+    assert deadline.skipped_stages == ['analysis']
+
+def test_cache_round_trip(temp_cache):
+    assert ambiance_cache.get_analysis(SAMPLE_TEXT) is None
+    ambiance_cache.put_analysis(SAMPLE_TEXT, {'mood': 'tense'})
+    assert ambiance_cache.get_analysis(SAMPLE_TEXT) == {'mood': 'tense'}
+
+    key = ambiance_cache.clip_key("rain", 15.0, 0.7)
+    ambiance_cache.put_clip(key, b"audio")
+    assert ambiance_cache.get_clip(key) == b"audio"
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
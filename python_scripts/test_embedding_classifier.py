@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Test script for the embedding classifier (uses a fake embeddings client)
+"""
+
+import sys
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+import logging
+
+import numpy as np
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_embedding_classifier')
+
+# Add parent directory to path to import embedding_classifier
+sys.path.append(str(Path(__file__).resolve().parent))
+import embedding_classifier
+
+class FakeEmbeddingsClient:
+    """Bag-of-words hashing embeddings, so texts sharing words are similar"""
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.requests = 0
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    def embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in text.lower().replace(',', ' ').replace('.', ' ').split():
+            vector[zlib.crc32(word.encode('utf-8')) % self.dimensions] += 1.0
+        return vector.tolist()
+
+    def create(self, model, input):
+        self.requests += 1
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self.embed(text)) for text in input])
+
+def test_classify_embeddings_picks_nearest_centroid():
+    centroids = {
+        'mood_labels': ['happy', 'sad'],
+        'mood_matrix': np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], dtype=np.float32),
+        'setting_labels': ['sea', 'forest'],
+        'setting_matrix': np.array([[0.0, 0.0, 1.0], [0.0, 1.0, 0.0]], dtype=np.float32),
+    }
+    embeddings = np.array([[2.0, 0.1, 1.0], [0.0, 3.0, 0.1]], dtype=np.float32)
+    results = embedding_classifier.classify_embeddings(embeddings, centroids)
+    assert [(mood, setting) for mood, _, setting, _ in results] == [('happy', 'sea'), ('sad', 'forest')]
+
+def test_embeddings_are_cached_and_batched(temp_cache):
+    client = FakeEmbeddingsClient()
+    texts = [f"page {number} of the book" for number in range(5)]
+    first = embedding_classifier.embed_texts(texts, client)
+    assert first.shape == (5, client.dimensions)
+    assert client.requests == 1          # One request for the whole batch
+
+    second = embedding_classifier.embed_texts(texts, client)
+    assert client.requests == 1          # Served from the cache
+    assert np.array_equal(first, second)
+
+def test_build_and_classify_round_trip(tmp_path, temp_cache, monkeypatch):
+    client = FakeEmbeddingsClient()
+    centroids_file = tmp_path / 'centroids.npz'
+    embedding_classifier.build_centroids(centroids_file, client)
+
+    # The centroid file is passed through, not read from the default location
+    monkeypatch.setattr(embedding_classifier, 'CENTROIDS_FILE', tmp_path / 'missing.npz')
+    monkeypatch.setattr(embedding_classifier, '_centroids', None)
+    results = embedding_classifier.analyze_texts([
+        "the wind howled and the rain lashed down in a violent storm with thunder",
+        "deep in the woods beneath the tall trees, leaves rustling in the forest",
+    ], client, centroids_file=centroids_file)
+
+    logger.info(f"Results: {results}")
+    assert [result['setting'] for result in results] == ['storm', 'forest']
+    assert all(result['ambiance_prompt'] and result['source'] == 'embeddings' for result in results)
+
+def test_missing_centroids_fall_back_to_local_analysis(tmp_path, temp_cache, monkeypatch):
+    import ambiance_generator
+    monkeypatch.setattr(embedding_classifier, 'CENTROIDS_FILE', tmp_path / 'missing.npz')
+    result = ambiance_generator.analyze_text_with_embeddings(
+        "The storm raged on, rain lashing the windows while thunder rolled."
+    )
+    assert result['source'] == 'local'
+    assert 'error' not in result
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
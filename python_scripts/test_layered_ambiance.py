@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Test script for layered ambiance (stem planning, caching and mixing)
+"""
+
+import io
+import sys
+import wave
+from pathlib import Path
+import logging
+
+import numpy as np
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_layered_ambiance')
+
+# Add parent directory to path to import layered_ambiance
+sys.path.append(str(Path(__file__).resolve().parent))
+import ambiance_cache
+import layered_ambiance
+
+SAMPLE_ANALYSIS = {
+    "mood": "Melancholic",
+    "setting": "old house",
+    "ambient_sounds": ["Rain", "fire crackling", "rain.", "distant thunder"],
+    "ambiance_prompt": "Soft piano with rain and a crackling fire"
+}
+
+def test_plan_stems_dedupes_sounds():
+    stems = layered_ambiance.plan_stems(SAMPLE_ANALYSIS)
+    names = [stem['name'] for stem in stems]
+    logger.info(f"Planned stems: {names}")
+    assert names == ["music bed (melancholic)", "rain", "fire crackling", "distant thunder"]
+    # Stem keys depend only on the sound, so they are shared across scenes
+    other = layered_ambiance.plan_stems({"mood": "tense", "ambient_sounds": ["rain"]})
+    assert layered_ambiance.stem_key(other[1]) == layered_ambiance.stem_key(stems[1])
+
+def test_mix_applies_gain_and_pan():
+    tone = np.ones(1000, dtype=np.float32) * 0.5
+    mix = layered_ambiance.mix_stems([(tone, 1.0, -1.0)], duration_seconds=0.2, sample_rate=10000)
+    assert mix.shape == (2000, 2)
+    assert np.abs(mix[:, 0]).max() > 0.4        # Hard left
+    assert np.abs(mix[:, 1]).max() < 1e-6
+
+    loud = [(np.ones(1000, dtype=np.float32), 1.0, 0.0)] * 4
+    assert np.abs(layered_ambiance.mix_stems(loud, 0.1, 10000)).max() <= 1.0
+
+def test_cached_stems_are_mixed_without_generation(temp_cache):
+    t = np.arange(layered_ambiance.SAMPLE_RATE, dtype=np.float32) / layered_ambiance.SAMPLE_RATE
+    pcm = (np.sin(2 * np.pi * 220 * t) * 8000).astype('<i2').tobytes()
+    for stem in layered_ambiance.plan_stems(SAMPLE_ANALYSIS):
+        ambiance_cache.put_clip(layered_ambiance.stem_key(stem), pcm)
+
+    report = {}
+    audio = layered_ambiance.generate_layered_ambiance(SAMPLE_ANALYSIS, duration_seconds=2.0, report=report)
+    assert audio is not None
+    assert report['generated_stems'] == []
+    assert report['missing_stems'] == []
+    assert len(report['cached_stems']) == 4
+
+    with wave.open(io.BytesIO(audio), 'rb') as wav_file:
+        assert wav_file.getnchannels() == 2
+        assert wav_file.getframerate() == layered_ambiance.SAMPLE_RATE
+        assert wav_file.getnframes() == 2 * layered_ambiance.SAMPLE_RATE
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
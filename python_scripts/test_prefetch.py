@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Test script for the ambiance prefetch (uses fake analysis and music generators)
+"""
+
+import sys
+import json
+from pathlib import Path
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_prefetch')
+
+# Add parent directory to path to import prefetch
+sys.path.append(str(Path(__file__).resolve().parent))
+import ambiance_cache
+import ambiance_generator
+import music_gen
+import prefetch
+
+PAGES = [
+    "Chapter one. They walked into the forest at dawn.",
+    "The forest was quiet and the trees were tall.",
+    "Deeper in the forest, leaves rustled overhead.",
+    "Then the storm broke over the hills with thunder.",
+    "The storm raged on through the night.",
+    "",
+    "Morning came to the forest again, calm and still.",
+]
+
+class FakeGenerators:
+    """Stand-ins for the analysis and music generation that count their calls"""
+
+    def __init__(self):
+        self.analyses = 0
+        self.generations = []
+
+    def generate_ambiance_prompt(self, text, deadline_ms=None, **kwargs):
+        self.analyses += 1
+        setting = 'storm' if 'storm' in text else 'forest'
+        analysis = {
+            "mood": "tense" if setting == 'storm' else "peaceful",
+            "setting": setting,
+            "ambiance_prompt": f"{setting} ambiance for: {text[:20]}"
+        }
+        ambiance_cache.put_analysis(text, analysis)
+        return json.dumps(analysis)
+
+    def generate_music(self, prompt, duration_seconds=15.0, prompt_influence=0.7, deadline_ms=None, **kwargs):
+        self.generations.append(prompt)
+        ambiance_cache.put_clip(ambiance_cache.clip_key(prompt, duration_seconds, prompt_influence), b"audio")
+        return b"audio"
+
+@pytest.fixture
+def fakes(temp_cache, monkeypatch):
+    fakes = FakeGenerators()
+    monkeypatch.setattr(ambiance_generator, 'generate_ambiance_prompt', fakes.generate_ambiance_prompt)
+    monkeypatch.setattr(music_gen, 'generate_music', fakes.generate_music)
+    return fakes
+
+def test_scene_changes_get_audio_and_continuations_share_it(fakes):
+    report = prefetch.prefetch_pages(PAGES, 0, count=6, max_generations=5)
+    logger.info(f"Report: {json.dumps(report)}")
+    by_page = {entry['page']: entry for entry in report['pages']}
+    assert sorted(by_page) == [1, 2, 3, 4, 6]          # The blank page is skipped
+    assert [by_page[page]['scene_change'] for page in (1, 2, 3, 4, 6)] == [True, False, True, False, True]
+    assert [by_page[page]['audio'] for page in (1, 2, 3, 4, 6)] == ['generated', 'same_scene', 'generated', 'same_scene', 'generated']
+    assert len(fakes.generations) == 3
+
+    # A page continuing a scene now resolves to the scene's prompt (and clip)
+    assert ambiance_cache.get_analysis(PAGES[2])['ambiance_prompt'] == ambiance_cache.get_analysis(PAGES[1])['ambiance_prompt']
+    assert by_page[2]['key'] == ambiance_cache.content_key(ambiance_cache.normalize_text(PAGES[2]))
+
+def test_budget_and_cache_deduplication(fakes):
+    report = prefetch.prefetch_pages(PAGES, 0, count=6, max_generations=1)
+    assert [entry['audio'] for entry in report['pages'] if entry['scene_change']] == ['generated', 'over_budget', 'over_budget']
+    assert fakes.analyses == 5
+
+    # A second run reuses every analysis and only spends its budget on the missing clips
+    report = prefetch.prefetch_pages(PAGES, 0, count=6, max_generations=1)
+    assert fakes.analyses == 5
+    assert all(entry['analysis'] == 'cached' for entry in report['pages'])
+    assert [entry['audio'] for entry in report['pages'] if entry['scene_change']] == ['cached', 'generated', 'over_budget']
+
+def test_missing_clip_is_not_reported_as_cached(fakes):
+    """A prompt whose clip was never made stays missing for later pages with that prompt"""
+    pages = ["Start.", "The storm broke.", "Into the forest.", "The storm broke."]
+    report = prefetch.prefetch_pages(pages, 0, count=3, max_generations=0)
+    assert [entry['audio'] for entry in report['pages']] == ['over_budget', 'over_budget', 'over_budget']
+
+def test_continuing_page_carries_the_scene_audio_status(fakes):
+    """A page continuing a scene whose clip was not made is not audio-ready"""
+    pages = ["start", "The storm broke.", "The storm raged."]
+    report = prefetch.prefetch_pages(pages, 0, count=2, max_generations=0)
+    assert [(entry['page'], entry['audio']) for entry in report['pages']] == [(1, 'over_budget'), (2, 'over_budget')]
+
+    report = prefetch.prefetch_pages(pages, 0, count=2, max_generations=1)
+    assert [(entry['page'], entry['audio']) for entry in report['pages']] == [(1, 'generated'), (2, 'same_scene')]
+
+def test_pages_are_recorded_for_the_reader(fakes):
+    """Each analyzed page points at the prompt of its scene's clip"""
+    prefetch.prefetch_pages(PAGES, 0, count=6, max_generations=5, book_id='1342')
+    scene_prompt = ambiance_cache.get_analysis(PAGES[1])['ambiance_prompt']
+    assert ambiance_cache.get_page('1342', 1)['ambiance_prompt'] == scene_prompt
+    assert ambiance_cache.get_page('1342', 2) == {'ambiance_prompt': scene_prompt, 'mood': 'peaceful', 'setting': 'forest'}
+    assert ambiance_cache.get_page('1342', 5) is None
+    assert ambiance_cache.get_page('84', 1) is None
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test script for the profiling hooks
+"""
+
+import os
+import sys
+import json
+import pstats
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_profiling')
+
+# Add parent directory to path to import profiling
+SCRIPT_DIR = Path(__file__).resolve().parent
+sys.path.append(str(SCRIPT_DIR))
+import profiling
+
+@profiling.phase('work')
+def busy_work():
+    return sum(number * number for number in range(20000))
+
+def test_wall_profile_times_phases():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output = Path(temp_dir) / 'wall-{pid}.txt'
+        profiler = profiling.start('wall', str(output), label='test')
+        try:
+            busy_work()
+            busy_work()
+            with profiling.phase('network:openai'):
+                logger.warning("Logged inside a phase")
+        finally:
+            profiling.stop()
+
+        assert profiler.phases['work'][1] == 2
+        assert profiler.phases['logging'][1] >= 1
+        report = (Path(temp_dir) / f"wall-{os.getpid()}.txt").read_text()
+        logger.info(f"Report:\n{report}")
+        for name in ('startup', 'work', 'network:openai', 'logging'):
+            assert name in report
+
+        # The run time in the header includes the startup phase
+        header_ms = float(report.splitlines()[0].rsplit(', ', 1)[1].split('ms')[0])
+        assert header_ms >= profiler.phases['startup'][0] * 1000
+        startup_line = next(line for line in report.splitlines() if line.startswith('startup'))
+        assert float(startup_line.split()[-1].rstrip('%')) <= 100.0
+
+def test_cpu_profile_dump_and_mem_report():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump = Path(temp_dir) / 'cpu.prof'
+        profiling.start('cpu', str(dump))
+        busy_work()
+        profiling.stop()
+        stats = pstats.Stats(str(dump))
+        assert any(name == 'busy_work' for _, _, name in stats.stats)
+
+        report_file = Path(temp_dir) / 'mem.txt'
+        profiling.start('mem', str(report_file))
+        data = [bytes(1024) for _ in range(200)]
+        profiling.stop()
+        report = report_file.read_text()
+        assert 'peak' in report and 'test_profiling.py' in report
+        assert data
+
+def test_cli_keeps_stdout_clean():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output = Path(temp_dir) / 'profile.txt'
+        env = dict(os.environ, STORIA_STATE_DIR=temp_dir, STORIA_PROFILE='wall', STORIA_PROFILE_OUTPUT=str(output))
+        result = subprocess.run(
+            [sys.executable, str(SCRIPT_DIR / 'ambiance_generator.py'), '--text', 'Short'],
+            capture_output=True, text=True, env=env, timeout=60
+        )
+        json.loads(result.stdout)  # Only the analysis result is on stdout
+        report = output.read_text()
+        assert 'ambiance_generator' in report and 'startup' in report and 'environment' in report
+
+def test_invalid_env_profile_is_ignored(monkeypatch):
+    monkeypatch.setenv('STORIA_PROFILE', 'bogus')
+    parser = argparse.ArgumentParser()
+    profiling.add_arguments(parser)
+    assert parser.parse_args([]).profile is None
+
+    monkeypatch.setenv('STORIA_PROFILE', 'mem')
+    parser = argparse.ArgumentParser()
+    profiling.add_arguments(parser)
+    assert parser.parse_args([]).profile == 'mem'
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Test script for the upstream resilience layer
+"""
+
+import sys
+import time
+import tempfile
+import threading
+from pathlib import Path
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_resilience')
+
+# Add parent directory to path to import resilience
+import ambiance_cache
+import ambiance_generator
+import music_gen
+sys.path.append(str(Path(__file__).resolve().parent))
+import resilience
+
+def test_hedged_call_returns_first_response():
+    """A stalled primary should be overtaken by the hedged duplicate"""
+    calls = []
+
+    def upstream():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            time.sleep(2.0)  # Primary stalls
+            return "slow"
+        return "fast"
+
+    start = time.monotonic()
+    result, attempt = resilience.hedged_call(upstream, hedge_after_s=0.05, timeout_s=1.0)
+    elapsed = time.monotonic() - start
+
+    logger.info(f"Hedged call returned {result} from attempt {attempt} in {elapsed:.2f}s")
+    assert result == "fast"
+    assert attempt == 2
+    assert elapsed < 1.0
+
+def test_hedged_call_times_out():
+    """If every attempt stalls the call should fail at the overall timeout"""
+    try:
+        resilience.hedged_call(lambda: time.sleep(2.0), hedge_after_s=0.05, timeout_s=0.2)
+    except TimeoutError:
+        return
+    assert False, "Expected TimeoutError"
+
+def test_circuit_breaker_opens_and_probes():
+    """Repeated failures open the breaker; after the reset timeout one probe is allowed"""
+    with tempfile.TemporaryDirectory() as state_dir:
+        policy = dict(resilience.DEFAULT_POLICIES['openai'], failure_threshold=2, reset_timeout_s=0.2)
+        breaker = resilience.CircuitBreaker('openai', policy, state_dir=state_dir)
+
+        assert breaker.allow_request()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.state == 'open'
+        assert not breaker.allow_request()
+
+        time.sleep(0.25)
+        assert breaker.allow_request()       # Probe goes through
+        assert not breaker.allow_request()   # Second caller waits for the probe
+        breaker.record_success(0.1)
+        assert breaker.state == 'closed'
+
+def test_slow_calls_count_as_failures():
+    """Calls slower than slow_call_s should trip the breaker"""
+    with tempfile.TemporaryDirectory() as state_dir:
+        policy = dict(resilience.DEFAULT_POLICIES['elevenlabs'], failure_threshold=1, slow_call_s=1.0)
+        breaker = resilience.CircuitBreaker('elevenlabs', policy, state_dir=state_dir)
+        breaker.record_success(5.0)
+        assert breaker.state == 'open'
+
+def test_circuit_breaker_is_thread_safe():
+    """Threads sharing a breaker keep every update and send a single half-open probe"""
+    with tempfile.TemporaryDirectory() as state_dir:
+        policy = dict(resilience.DEFAULT_POLICIES['elevenlabs'], failure_threshold=100, reset_timeout_s=0.2)
+        breaker = resilience.CircuitBreaker('elevenlabs', policy, state_dir=state_dir)
+
+        threads = [threading.Thread(target=breaker.record_failure) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert breaker._load()['failures'] == 20
+        assert not list(Path(state_dir).glob('*.tmp'))
+
+        breaker._save({'state': 'open', 'failures': 3, 'opened_at': time.time() - 1.0, 'latencies': []})
+        allowed = []
+        start = threading.Barrier(4)
+
+        def stem():
+            start.wait()
+            allowed.append(breaker.allow_request())
+
+        threads = [threading.Thread(target=stem) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert allowed.count(True) == 1, f"{allowed.count(True)} probes sent"
+
+def test_concurrency_limit_counts_every_attempt(temp_cache, monkeypatch):
+    """Hedged attempts need a slot of their own, and abandoned ones keep theirs until they return"""
+    monkeypatch.setenv('STORIA_OPENAI_HEDGE_DEFAULT_S', '0.05')
+    limit = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(resilience, '_concurrency_limits', {'openai': limit})
+    in_flight = []
+    peak = []
+    finished = threading.Event()
+
+    def upstream():
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        time.sleep(0.4)  # Stalls past the caller's timeout
+        in_flight.pop()
+        finished.set()
+        return "late"
+
+    with pytest.raises(resilience.ProviderUnavailableError):
+        resilience.call_provider('openai', upstream, timeout_s=0.2)
+    assert max(peak) == 1, "The hedge ran without a free slot"
+    assert not limit.acquire(False), "The abandoned attempt released its slot early"
+
+    assert finished.wait(1.0)
+    time.sleep(0.05)
+    assert limit.acquire(False)
+    limit.release()
+
+def open_breaker(provider):
+    """Save an open breaker state that will not probe during the test"""
+    breaker = resilience.CircuitBreaker(provider)
+    breaker._save({'state': 'open', 'failures': 99, 'opened_at': time.time(), 'latencies': []})
+
+def test_open_openai_breaker_falls_back_to_local_analysis(temp_cache, monkeypatch):
+    """Without a deadline the analysis still falls back to the local result"""
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    open_breaker('openai')
+    result = ambiance_generator.analyze_text_content("The storm raged and the thunder rolled.")
+    assert result['source'] == 'local'
+    assert 'error' not in result
+
+def test_open_elevenlabs_breaker_serves_cached_preview(temp_cache, monkeypatch):
+    monkeypatch.setenv('ELEVENLABS_API_KEY', 'test-key')
+    open_breaker('elevenlabs')
+    preview_key = ambiance_cache.clip_key("rain", music_gen.PREVIEW_DURATION_SECONDS, 0.7)
+    ambiance_cache.put_clip(preview_key, b"preview")
+    report = {}
+    assert music_gen.generate_music("rain", 15.0, 0.7, report=report) == b"preview"
+    assert report['source'] == 'preview'
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Test script for the structured (JSON) analysis output (uses a fake OpenAI client)
+"""
+
+import sys
+import json
+from pathlib import Path
+from types import SimpleNamespace
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_structured_analysis')
+
+# Add parent directory to path to import ambiance_generator
+sys.path.append(str(Path(__file__).resolve().parent))
+import ambiance_generator
+
+VALID_REPLY = json.dumps({
+    "mood": "melancholic",
+    "setting": "old house",
+    "sounds": ["rain", "fire crackling"],
+    "prompt": "Soft piano with rain on the windows and a crackling fire"
+})
+
+class FakeChatClient:
+    """Returns the queued replies in order and records each request"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        message = SimpleNamespace(content=self.replies.pop(0))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+def test_parse_structured_analysis_validates_schema():
+    analysis = ambiance_generator.parse_structured_analysis(VALID_REPLY)
+    assert analysis == {
+        "mood": "melancholic",
+        "setting": "old house",
+        "ambient_sounds": ["rain", "fire crackling"],
+        "ambiance_prompt": "Soft piano with rain on the windows and a crackling fire"
+    }
+    for invalid in ['not json', '[]', '{"mood": "calm"}', '{"mood": "calm", "setting": "sea", "prompt": "x", "sounds": "waves"}']:
+        try:
+            ambiance_generator.parse_structured_analysis(invalid)
+        except ValueError:
+            continue
+        assert False, f"Expected ValueError for {invalid}"
+
+def test_structured_request_retries_once(temp_cache):
+    client = FakeChatClient(['{"mood": "calm"', VALID_REPLY])
+    analysis = ambiance_generator.request_structured_analysis(client, "Some page text")
+    assert analysis["mood"] == "melancholic"
+    assert len(client.requests) == 2
+    assert client.requests[0]["max_tokens"] == ambiance_generator.STRUCTURED_MAX_TOKENS
+    assert client.requests[0]["response_format"] == {"type": "json_object"}
+    # The retry tells the model what was wrong with its first reply
+    assert "invalid" in client.requests[1]["messages"][-1]["content"]
+
+def test_structured_request_gives_up_after_retry(temp_cache):
+    client = FakeChatClient(['nope', 'still nope'])
+    with pytest.raises(ValueError):
+        ambiance_generator.request_structured_analysis(client, "Some page text")
+    assert len(client.requests) == 2
+
+def test_text_parser_handles_indented_lines():
+    reply = """
+    1. Mood: tense
+    2. Setting: dark forest
+    3. Ambient sounds: wind, owls
+    4. Prompt: Low strings with wind through the trees
+       and the distant call of an owl
+    """
+    analysis = ambiance_generator.parse_text_analysis(reply)
+    assert analysis["mood"] == "tense"
+    assert analysis["ambient_sounds"] == ["wind", "owls"]
+    assert analysis["ambiance_prompt"] == "Low strings with wind through the trees and the distant call of an owl"
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Test script for the corpus warm-up job
+"""
+
+import sys
+import json
+from pathlib import Path
+import logging
+
+import pytest
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('test_warmup')
+
+# Add parent directory to path to import warmup
+sys.path.append(str(Path(__file__).resolve().parent))
+import ambiance_cache
+import ambiance_generator
+import embedding_classifier
+import warmup
+
+def make_book(lines=2000):
+    header = "Project Gutenberg header\n*** START OF THE PROJECT GUTENBERG EBOOK SAMPLE ***\n"
+    body = "\n".join(f"Line {number} of the story, where something happens quietly." for number in range(lines))
+    footer = "\n*** END OF THE PROJECT GUTENBERG EBOOK SAMPLE ***\nLicense text"
+    return (header + body + footer).encode('utf-8')
+
+def test_paginate_book_matches_reader_ranges():
+    raw = make_book()
+    pages = warmup.paginate_book(raw)
+    total_pages = -(-len(raw) // warmup.CHARS_PER_PAGE)
+    assert len(pages) == total_pages
+    assert "START OF THE PROJECT" not in pages[0]
+    assert pages[0].startswith("Line 0 ")
+    assert all(len(page) <= warmup.CHARS_PER_PAGE + 100 for page in pages)
+    # Each block of pages starts at the byte offset the reader requests
+    assert pages[10].startswith(raw[10 * warmup.CHARS_PER_PAGE:].decode('utf-8').split('\n')[0])
+
+    assert len(warmup.paginate_book(raw, max_pages=5)) == 5
+
+def test_run_warmup_skips_cached_and_resumes(tmp_path, temp_cache):
+    tasks = []
+    for number in range(3):
+        text = f"Page {number}: the rain fell softly on the quiet village streets."
+        analysis = {"mood": "peaceful", "ambiance_prompt": f"Soft rain {number}"}
+        ambiance_cache.put_analysis(text, analysis)
+        ambiance_cache.put_clip(
+            ambiance_cache.clip_key(analysis['ambiance_prompt'], warmup.MUSIC_DURATION_SECONDS, warmup.MUSIC_PROMPT_INFLUENCE),
+            b"audio"
+        )
+        tasks.append({'key': f"text:{number}", 'text': text})
+
+    checkpoint_path = tmp_path / 'checkpoint.json'
+    summary = warmup.run_warmup(tasks, checkpoint_path, workers=2)
+    logger.info(f"First run: {json.dumps(summary)}")
+    assert summary['cached'] == 3
+    assert summary['failed'] == 0
+
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert sorted(checkpoint['done']) == ['text:0', 'text:1', 'text:2']
+
+    summary = warmup.run_warmup(tasks, checkpoint_path, workers=2)
+    logger.info(f"Second run: {json.dumps(summary)}")
+    assert summary['skipped_from_checkpoint'] == 3
+    assert summary['cached'] == 0
+
+def test_book_pages_are_recorded_for_the_reader(tmp_path, temp_cache, monkeypatch):
+    """A cached book is not downloaded again, and warmed pages are recorded by book and page"""
+    ambiance_cache.put_book('1342', make_book())
+    def no_download(book_id):
+        raise AssertionError(f"Book {book_id} downloaded again")
+    monkeypatch.setattr(warmup, 'fetch_book_text', no_download)
+
+    tasks = warmup.build_tasks(['1342'], [], 2)
+    assert [(task['key'], task['book_id'], task['page']) for task in tasks] == [('book:1342:0', '1342', 0), ('book:1342:1', '1342', 1)]
+    for task in tasks:
+        analysis = {"mood": "peaceful", "setting": "village", "ambiance_prompt": f"Quiet village {task['page']}"}
+        ambiance_cache.put_analysis(task['text'], analysis)
+        ambiance_cache.put_clip(
+            ambiance_cache.clip_key(analysis['ambiance_prompt'], warmup.MUSIC_DURATION_SECONDS, warmup.MUSIC_PROMPT_INFLUENCE),
+            b"audio"
+        )
+
+    summary = warmup.run_warmup(tasks, tmp_path / 'checkpoint.json', workers=1)
+    assert summary['cached'] == 2
+    assert ambiance_cache.get_page('1342', 1) == {'ambiance_prompt': "Quiet village 1", 'mood': "peaceful", 'setting': "village"}
+
+def test_embeddings_engine_batches_each_book(tmp_path, temp_cache, monkeypatch):
+    """Each book's pages are analyzed in one call instead of one request per page"""
+    centroids_file = tmp_path / 'centroids.npz'
+    centroids_file.write_bytes(b"")
+    monkeypatch.setattr(embedding_classifier, 'CENTROIDS_FILE', centroids_file)
+    monkeypatch.setattr(embedding_classifier, 'create_client', lambda: None)
+    monkeypatch.setattr(ambiance_generator, 'load_environment', lambda: True)
+    batches = []
+    def analyze_texts(texts, client=None, **kwargs):
+        batches.append(len(texts))
+        return [embedding_classifier.build_analysis('peaceful', 'forest') for _ in texts]
+    monkeypatch.setattr(embedding_classifier, 'analyze_texts', analyze_texts)
+
+    prompt = embedding_classifier.build_analysis('peaceful', 'forest')['ambiance_prompt']
+    ambiance_cache.put_clip(
+        ambiance_cache.clip_key(prompt, warmup.MUSIC_DURATION_SECONDS, warmup.MUSIC_PROMPT_INFLUENCE), b"audio"
+    )
+    tasks = [
+        {'key': f"book:{book_id}:{page}", 'text': f"Page {page} of book {book_id} in the forest.", 'book_id': book_id, 'page': page}
+        for book_id in ('11', '84') for page in range(3)
+    ]
+    summary = warmup.run_warmup(tasks, tmp_path / 'checkpoint.json', workers=2, engine='embeddings')
+    assert batches == [3, 3]
+    assert summary['failed'] == 0
+    assert ambiance_cache.get_page('84', 2)['ambiance_prompt'] == prompt
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Corpus Warm-up for Storia
+
+Batch job that precomputes the ambiance analysis and music for popular books
+in the cache shared with the Python bridge. Pages are processed across a
+process pool with per-provider concurrency limits. Progress is checkpointed to
+disk so an interrupted run can be resumed, and pages that are already cached
+are skipped.
+
+Each warmed book page is also recorded under its book id and page number
+(the same page cache the prefetch writes), so the reader's own music request
+(/api/music/generate-simple from views/read-book.ejs) is served the warmed
+clip when the reader opens that page.
+
+Example (nightly):
+
+    python warmup.py --popular 32 --pages 20 --checkpoint warmup_state.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import traceback
+import multiprocessing.util
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import requests
+
+import resilience
+import profiling
+import ambiance_cache
+
+# Set up logging - use stderr instead of stdout for logs
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger('warmup')
+
+GUTENDEX_URL = 'https://gutendex.com/books'
+
+# Pagination constants, mirroring the /read/:id route in src/index.js
+CHARS_PER_PAGE = 2500
+PAGES_PER_RANGE = 10
+RANGE_BUFFER = 1.5
+
+# Text formats in the order the /read/:id route tries them
+FORMAT_PRIORITIES = [
+    'text/plain',
+    'text/plain; charset=utf-8',
+    'text/plain; charset=us-ascii',
+    'text/plain; charset=iso-8859-1',
+    'text/plain; charset=windows-1252',
+]
+
+HEADER_END_MARKERS = [
+    "*** START OF THE PROJECT GUTENBERG EBOOK",
+    "*** START OF THIS PROJECT GUTENBERG EBOOK",
+    "***START OF THE PROJECT GUTENBERG EBOOK",
+    "*** START OF THE PROJECT GUTENBERG",
+    "*** START OF THIS PROJECT GUTENBERG",
+    "*** START OF THE PROJECT",
+    "*END*THE SMALL PRINT"
+]
+
+FOOTER_START_MARKERS = [
+    "*** END OF THE PROJECT GUTENBERG EBOOK",
+    "*** END OF THIS PROJECT GUTENBERG EBOOK",
+    "***END OF THE PROJECT GUTENBERG EBOOK",
+    "*** END OF THE PROJECT GUTENBERG",
+    "*** END OF THIS PROJECT GUTENBERG",
+    "End of the Project Gutenberg",
+    "End of Project Gutenberg"
+]
+
+# Default number of concurrent calls allowed per provider across all workers
+DEFAULT_PROVIDER_LIMITS = {'openai': 4, 'elevenlabs': 2}
+
+# Music parameters used by generateMusicFromText in src/python_bridge.js and by
+# the reader's /api/music/generate-simple request, so warmed clips have the
+# same cache keys as those paths
+MUSIC_DURATION_SECONDS = 15.0
+MUSIC_PROMPT_INFLUENCE = 0.7
+
+def fetch_popular_book_ids(count):
+    """Fetch the ids of the most popular books, as listed on the /books page"""
+    book_ids = []
+    url = f"{GUTENDEX_URL}/?sort=popular"
+    while url and len(book_ids) < count:
+        response = requests.get(url, timeout=15)
+        response.raise_for_status()
+        data = response.json()
+        book_ids.extend(str(book['id']) for book in data.get('results', []))
+        url = data.get('next')
+    return book_ids[:count]
+
+def fetch_book_text(book_id):
+    """Download the raw plain-text bytes of a book"""
+    response = requests.get(f"{GUTENDEX_URL}/{book_id}", timeout=15)
+    response.raise_for_status()
+    formats = response.json().get('formats', {})
+    text_url = next((formats[fmt] for fmt in FORMAT_PRIORITIES if fmt in formats), None)
+    if not text_url:
+        raise ValueError(f"No plain text format available for book {book_id}")
+
+    response = requests.get(text_url, timeout=60, headers={'Accept': 'text/plain'})
+    response.raise_for_status()
+    return response.content
+
+def load_book(book_id):
+    """Return the raw text of a book, downloading it only when it is not cached"""
+    raw_bytes = ambiance_cache.get_book(book_id)
+    if raw_bytes is None:
+        raw_bytes = fetch_book_text(book_id)
+        ambiance_cache.put_book(book_id, raw_bytes)
+    return raw_bytes
+
+def split_range(text, start_page, total_pages):
+    """Split one fetched range into pages exactly as src/index.js does"""
+    end_page = min(start_page + PAGES_PER_RANGE - 1, total_pages - 1)
+
+    if start_page == 0:
+        for marker in HEADER_END_MARKERS:
+            header_end = text.find(marker)
+            if header_end != -1:
+                line_end = text.find('\n', header_end)
+                if line_end != -1:
+                    text = text[line_end + 1:]
+                    break
+
+    if end_page >= total_pages - PAGES_PER_RANGE:
+        for marker in FOOTER_START_MARKERS:
+            footer_start = text.find(marker)
+            if footer_start != -1:
+                text = text[:footer_start]
+                break
+
+    pages = []
+    current_page = ''
+    char_count = 0
+    for line in text.split('\n'):
+        if char_count + len(line) > CHARS_PER_PAGE and current_page:
+            pages.append(current_page)
+            current_page = line
+            char_count = len(line)
+        else:
+            current_page += ('\n' if current_page else '') + line
+            char_count += len(line)
+    if current_page:
+        pages.append(current_page)
+    return pages
+
+def paginate_book(raw_bytes, max_pages=None):
+    """
+    Split a book into the pages a reader sees
+
+    The reader fetches each block of PAGES_PER_RANGE pages with an HTTP Range
+    request and splits it locally; the same byte ranges are cut from the full
+    download here so the page texts match what the reader sees.
+
+    Args:
+        raw_bytes (bytes): The full book text
+        max_pages (int): Only return the first max_pages pages
+
+    Returns:
+        list: Page texts, indexed by page number (blank where the reader gets no text)
+    """
+    total_pages = -(-len(raw_bytes) // CHARS_PER_PAGE)
+    last_page = total_pages if max_pages is None else min(total_pages, max_pages)
+    pages = []
+    for start_page in range(0, last_page, PAGES_PER_RANGE):
+        end_page = min(start_page + PAGES_PER_RANGE - 1, total_pages - 1)
+        start_byte = start_page * CHARS_PER_PAGE
+        bytes_to_fetch = int((end_page - start_page + 1) * CHARS_PER_PAGE * RANGE_BUFFER)
+        chunk = raw_bytes[start_byte:start_byte + bytes_to_fetch + 1].decode('utf-8', errors='replace')
+        range_pages = split_range(chunk, start_page, total_pages)
+        # Keep page numbers aligned: pages missing from a short range are
+        # blank for the reader too
+        page_count = end_page - start_page + 1
+        pages.extend((range_pages + [''] * page_count)[:page_count])
+    return pages[:last_page]
+
+def build_tasks(book_ids, text_files, max_pages):
+    """Build one task per page to warm"""
+    tasks = []
+    for book_id in book_ids:
+        try:
+            pages = paginate_book(load_book(book_id), max_pages)
+            logger.info(f"Book {book_id}: {len(pages)} pages to warm")
+        except Exception as e:
+            logger.error(f"Skipping book {book_id}: {str(e)}")
+            continue
+        for page_number, text in enumerate(pages):
+            if text.strip():
+                tasks.append({'key': f"book:{book_id}:{page_number}", 'text': text, 'book_id': book_id, 'page': page_number})
+
+    for file_name in text_files:
+        with open(file_name, 'r', encoding='utf-8') as f:
+            text = f.read()
+        tasks.append({'key': f"text:{ambiance_cache.content_key(ambiance_cache.normalize_text(text))[:16]}", 'text': text})
+    return tasks
+
+def load_checkpoint(path):
+    """Load a checkpoint, or start a new one"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        logger.info(f"Resuming from checkpoint {path}: {len(checkpoint['done'])} tasks already done")
+        return checkpoint
+    except (OSError, ValueError, KeyError):
+        return {'done': {}, 'failed': {}}
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves it half-written"""
+    path = Path(path)
+    tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def worker_profile_output(profile_output):
+    """Give each worker its own report file, e.g. warmup.prof -> warmup.worker-{pid}.prof"""
+    if not profile_output or '{pid}' in profile_output:
+        return profile_output
+    path = Path(profile_output)
+    return str(path.with_name(f"{path.stem}.worker-{{pid}}{path.suffix}"))
+
+def init_worker(limits, profile=None, profile_output=None):
+    """
+    Share the per-provider semaphores with the resilience layer in each worker
+    and start the worker's own profile when profiling is enabled
+    """
+    for provider, semaphore in limits.items():
+        resilience.set_concurrency_limit(provider, semaphore)
+    # Replaces any profile inherited from the parent through fork. Pool workers
+    # exit without running atexit handlers, so the report is written by a
+    # multiprocessing finalizer instead
+    if profiling.start(profile, worker_profile_output(profile_output), label=f"warmup worker {os.getpid()}"):
+        multiprocessing.util.Finalize(None, profiling.stop, exitpriority=10)
+
+def analyze_with_embeddings(tasks):
+    """
+    Analyze the pages of each book with batched embeddings requests
+
+    The embeddings engine classifies many pages per request, so rather than
+    one request per page in the workers, each book's pages are analyzed here
+    and handed to the workers with their task. Pages of a book that could not
+    be analyzed are left to the workers.
+
+    Args:
+        tasks (list): Tasks from build_tasks; an 'analysis' is added to each analyzed task
+    """
+    import ambiance_generator
+    import embedding_classifier
+
+    if not embedding_classifier.CENTROIDS_FILE.exists():
+        logger.warning(f"Centroid file {embedding_classifier.CENTROIDS_FILE} not found, analyzing pages one by one")
+        return
+    if not ambiance_generator.load_environment():
+        logger.error("Failed to load environment variables, analyzing pages one by one")
+        return
+
+    books = {}
+    for task in tasks:
+        books.setdefault(task.get('book_id'), []).append(task)
+    client = embedding_classifier.create_client()
+    for book_id, book_tasks in books.items():
+        name = f"book {book_id}" if book_id is not None else "text files"
+        try:
+            with profiling.phase('analysis'):
+                analyses = embedding_classifier.analyze_texts([task['text'] for task in book_tasks], client=client)
+        except Exception as e:
+            logger.error(f"Error analyzing {name} with embeddings: {str(e)}")
+            continue
+        logger.info(f"Analyzed {len(book_tasks)} pages of {name} with embeddings")
+        for task, analysis in zip(book_tasks, analyses):
+            task['analysis'] = analysis
+
+def warm_page(task, engine='chat', layered=False):
+    """
+    Compute (or confirm cached) analysis and music for one page
+
+    Returns:
+        dict: key, status ('cached', 'warmed' or 'failed') and details
+    """
+    import ambiance_generator
+    import music_gen
+
+    try:
+        if 'analysis' in task:
+            analysis = task['analysis']
+        else:
+            with profiling.phase('analysis'):
+                analysis = json.loads(ambiance_generator.generate_ambiance_prompt(task['text'], engine=engine))
+        if analysis.get('error'):
+            return {'key': task['key'], 'status': 'failed', 'error': analysis['error']}
+        # A local fallback is not cached; failing the page lets a later run retry it
+        if analysis.get('source') == 'local':
+            return {'key': task['key'], 'status': 'failed', 'error': 'Analysis provider unavailable'}
+        if 'book_id' in task:
+            ambiance_cache.put_page(task['book_id'], task['page'], {
+                'ambiance_prompt': analysis['ambiance_prompt'],
+                'mood': analysis.get('mood'),
+                'setting': analysis.get('setting')
+            })
+
+        report = {}
+        with profiling.phase('music'):
+            if layered:
+                import layered_ambiance
+                audio = layered_ambiance.generate_layered_ambiance(analysis, MUSIC_DURATION_SECONDS, report=report)
+                audio_cached = not report.get('generated_stems')
+            else:
+                audio = music_gen.generate_music(
+                    analysis['ambiance_prompt'],
+                    duration_seconds=MUSIC_DURATION_SECONDS,
+                    prompt_influence=MUSIC_PROMPT_INFLUENCE,
+                    report=report
+                )
+                audio_cached = report.get('source') == 'cache'
+
+        if not audio:
+            return {'key': task['key'], 'status': 'failed', 'error': 'Music generation failed'}
+
+        status = 'cached' if analysis.get('source') == 'cache' and audio_cached else 'warmed'
+        return {'key': task['key'], 'status': status, 'mood': analysis.get('mood')}
+    except Exception as e:
+        logger.error(f"Error warming {task['key']}: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return {'key': task['key'], 'status': 'failed', 'error': str(e)}
+
+def run_warmup(tasks, checkpoint_path, workers=4, provider_limits=None, engine='chat', layered=False,
+               profile=None, profile_output=None):
+    """
+    Warm all tasks across a process pool, checkpointing after every page
+
+    Args:
+        tasks (list): Tasks from build_tasks
+        checkpoint_path (str): Where progress is saved
+        workers (int): Number of worker processes
+        provider_limits (dict): Maximum concurrent calls per provider
+        engine (str): Analysis engine ('chat' or 'embeddings')
+        layered (bool): Warm layered ambiance stems instead of whole clips
+        profile (str): Optional profile mode for the workers ('cpu', 'mem' or 'wall')
+        profile_output (str): Worker report file; each worker gets its own copy
+
+    Returns:
+        dict: Summary with counts, elapsed time and throughput
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    pending = [task for task in tasks if task['key'] not in checkpoint['done']]
+    logger.info(f"{len(tasks)} tasks, {len(tasks) - len(pending)} done in a previous run, {len(pending)} to go")
+    if engine == 'embeddings' and pending:
+        analyze_with_embeddings(pending)
+
+    counts = {'cached': 0, 'warmed': 0, 'failed': 0}
+    started = time.monotonic()
+    limits = {
+        provider: multiprocessing.BoundedSemaphore(limit)
+        for provider, limit in (provider_limits or DEFAULT_PROVIDER_LIMITS).items()
+    }
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(limits, profile, profile_output)) as executor:
+        futures = [executor.submit(warm_page, task, engine, layered) for task in pending]
+        for completed, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            counts[result['status']] += 1
+            if result['status'] == 'failed':
+                checkpoint['failed'][result['key']] = result.get('error')
+            else:
+                checkpoint['done'][result['key']] = result['status']
+                checkpoint['failed'].pop(result['key'], None)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            rate = completed / elapsed if elapsed > 0 else 0.0
+            eta = (len(pending) - completed) / rate if rate > 0 else 0.0
+            logger.info(
+                f"[{completed}/{len(pending)}] {result['key']}: {result['status']} - "
+                f"{rate:.2f} pages/s, ETA {eta:.0f}s"
+            )
+
+    elapsed = time.monotonic() - started
+    return {
+        'total': len(tasks),
+        'skipped_from_checkpoint': len(tasks) - len(pending),
+        **counts,
+        'elapsed_seconds': round(elapsed, 1),
+        'pages_per_second': round(len(pending) / elapsed, 3) if elapsed > 0 else None,
+    }
+
+def main():
+    """Main function to run the script from command line"""
+    parser = argparse.ArgumentParser(description='Precompute ambiance and music for popular books')
+    parser.add_argument('--book-ids', nargs='*', default=[], help='Gutenberg book ids to warm')
+    parser.add_argument('--popular', type=int, default=0, help='Also warm the N most popular books')
+    parser.add_argument('--text-files', nargs='*', default=[], help='Text files to warm as single pages')
+    parser.add_argument('--pages', type=int, default=20, help='Number of pages to warm per book (0 for all)')
+    parser.add_argument('--checkpoint', type=str, default='warmup_checkpoint.json', help='Checkpoint file used to resume')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--openai-concurrency', type=int, default=DEFAULT_PROVIDER_LIMITS['openai'])
+    parser.add_argument('--elevenlabs-concurrency', type=int, default=DEFAULT_PROVIDER_LIMITS['elevenlabs'])
+    parser.add_argument('--engine', choices=['chat', 'embeddings'], default='chat', help='Analysis engine')
+    parser.add_argument('--layered', action='store_true', help='Warm layered ambiance stems instead of whole clips')
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    profiling.start(args.profile, args.profile_output, label='warmup')
+
+    book_ids = list(args.book_ids)
+    if args.popular:
+        try:
+            book_ids += [book_id for book_id in fetch_popular_book_ids(args.popular) if book_id not in book_ids]
+        except Exception as e:
+            logger.error(f"Error fetching popular books: {str(e)}")
+            return 1
+
+    tasks = build_tasks(book_ids, args.text_files, args.pages or None)
+    if not tasks:
+        logger.error("Nothing to warm (no books or text files)")
+        return 1
+
+    summary = run_warmup(
+        tasks,
+        args.checkpoint,
+        workers=args.workers,
+        provider_limits={'openai': args.openai_concurrency, 'elevenlabs': args.elevenlabs_concurrency},
+        engine=args.engine,
+        layered=args.layered,
+        profile=args.profile,
+        profile_output=args.profile_output
+    )
+    print(json.dumps(summary))
+    return 0 if summary['failed'] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
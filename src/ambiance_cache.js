@@ -0,0 +1,129 @@
+/**
+ * Ambiance Cache - Access to the on-disk cache shared with the Python scripts
+ *
+ * Mirrors the key scheme of python_scripts/ambiance_cache.py, so clips are
+ * shared both ways: Node serves clips the Python scripts generated without
+ * spawning a process (e.g. when a request's deadline leaves no time for a
+ * generation), and stores the clips it generates itself. Page entries written
+ * by the prefetch and the warm-up give the prompt prepared for a book page.
+ */
+
+const crypto = require('crypto');
+const path = require('path');
+const fs = require('fs');
+const os = require('os');
+
+// Same default location as CACHE_DIR in python_scripts/ambiance_cache.py
+const CACHE_DIR = process.env.STORIA_CACHE_DIR
+  || path.join(process.env.STORIA_STATE_DIR || path.join(os.tmpdir(), 'storia'), 'cache');
+
+// Length of the short preview clip (PREVIEW_DURATION_SECONDS in music_gen.py)
+const PREVIEW_DURATION_SECONDS = 5.0;
+
+/**
+ * Build a cache key from the given parts (content_key in ambiance_cache.py)
+ *
+ * @param {...*} parts - Values hashed in order
+ * @returns {string} Hex SHA-256 digest
+ */
+function contentKey(...parts) {
+  const digest = crypto.createHash('sha256');
+  for (const part of parts) {
+    digest.update(String(part), 'utf8');
+    digest.update('\0');
+  }
+  return digest.digest('hex');
+}
+
+/**
+ * Collapse whitespace the same way as normalize_text in ambiance_cache.py
+ *
+ * @param {string} text - Page text
+ * @returns {string} The normalized text
+ */
+function normalizeText(text) {
+  return text.split(/\s+/).filter(Boolean).join(' ');
+}
+
+/**
+ * Cache key for a generated clip (clip_key in ambiance_cache.py)
+ */
+function clipKey(prompt, durationSeconds, promptInfluence) {
+  return contentKey(prompt.trim(), Number(durationSeconds).toFixed(2), Number(promptInfluence).toFixed(2));
+}
+
+function clipPath(key) {
+  return path.join(CACHE_DIR, 'clips', key.slice(0, 2), `${key}.audio`);
+}
+
+/**
+ * Store a clip generated by Node, so later requests for the same prompt and
+ * the Python scripts can reuse it (put_clip in ambiance_cache.py)
+ *
+ * @param {string} prompt - The prompt the clip was generated from
+ * @param {number} durationSeconds - Clip duration
+ * @param {number} promptInfluence - Prompt influence
+ * @param {Buffer} audio - The audio data
+ */
+function putClip(prompt, durationSeconds, promptInfluence, audio) {
+  const file = clipPath(clipKey(prompt, durationSeconds, promptInfluence));
+  const tmpFile = `${file}.${process.pid}.tmp`;
+  try {
+    fs.mkdirSync(path.dirname(file), { recursive: true });
+    fs.writeFileSync(tmpFile, audio);
+    fs.renameSync(tmpFile, file);
+  } catch (e) {
+    console.warn(`Could not cache clip: ${e.message}`);
+  }
+}
+
+/**
+ * Return a cached clip for a prompt, or the cached preview clip
+ *
+ * @param {string} prompt - The ambiance prompt
+ * @param {number} durationSeconds - Clip duration
+ * @param {number} promptInfluence - Prompt influence
+ * @returns {{audio: Buffer, source: string}|null} The audio and its source ('cache' or 'preview')
+ */
+function getCachedClip(prompt, durationSeconds, promptInfluence) {
+  const candidates = [
+    { key: clipKey(prompt, durationSeconds, promptInfluence), source: 'cache' },
+    { key: clipKey(prompt, PREVIEW_DURATION_SECONDS, promptInfluence), source: 'preview' }
+  ];
+  for (const { key, source } of candidates) {
+    try {
+      return { audio: fs.readFileSync(clipPath(key)), source };
+    } catch (e) {
+      // Not cached
+    }
+  }
+  return null;
+}
+
+/**
+ * Return the ambiance prepared for a book page (get_page in ambiance_cache.py)
+ *
+ * @param {string} bookId - Gutenberg book id
+ * @param {number} page - Page number
+ * @returns {{ambiance_prompt: string, mood: string, setting: string}|null} The page entry
+ */
+function getPageAmbiance(bookId, page) {
+  const key = contentKey('page', bookId, page);
+  try {
+    const entry = JSON.parse(fs.readFileSync(path.join(CACHE_DIR, 'pages', key.slice(0, 2), `${key}.json`), 'utf8'));
+    return entry && typeof entry.ambiance_prompt === 'string' ? entry : null;
+  } catch (e) {
+    // Not prepared
+    return null;
+  }
+}
+
+module.exports = {
+  CACHE_DIR,
+  contentKey,
+  normalizeText,
+  clipKey,
+  putClip,
+  getCachedClip,
+  getPageAmbiance
+};
@@ -6,6 +6,8 @@ const session = require('express-session');
 const bcrypt = require('bcryptjs');
 const { ElevenLabsClient } = require('elevenlabs');
 const pythonBridge = require('./python_bridge');
+const { getCachedClip, putClip, getPageAmbiance } = require('./ambiance_cache');
+const { scheduler, SchedulerRejectedError } = require('./scheduler');
 const os = require('os');
 
 // Load environment variables from root .env file
@@ -774,9 +776,52 @@ app.get('/search', async (req, res) => {
 });
 
 // Simplified music generation endpoint for Vercel
+/**
+ * Call the ElevenLabs sound generation API directly from Node
+ * 
+ * The call is queued in the shared scheduler as interactive work on its own
+ * 'elevenlabs_direct' provider, sized separately from the Python processes'
+ * ElevenLabs slots. It is rejected with a SchedulerRejectedError when the
+ * queue is full ('shed') or when the deadline or the interactive maximum wait
+ * passes while it is queued ('expired').
+ * 
+ * @param {string} apiKey - ElevenLabs API key
+ * @param {object} data - Request body for /v1/sound-generation
+ * @param {number} timeoutMs - Request timeout in milliseconds
+ * @param {number} deadlineMs - Optional time budget, including time spent queued
+ * @returns {Promise<object>} The axios response, with the audio as an arraybuffer
+ */
+function requestSoundGeneration(apiKey, data, timeoutMs, deadlineMs) {
+  return scheduler.schedule((waitedMs) => axios({
+    method: 'post',
+    url: 'https://api.elevenlabs.io/v1/sound-generation',
+    headers: {
+      'Accept': 'audio/mpeg',
+      'Content-Type': 'application/json',
+      'xi-api-key': apiKey
+    },
+    data,
+    responseType: 'arraybuffer',
+    timeout: deadlineMs !== undefined ? Math.max(Math.min(timeoutMs, deadlineMs - waitedMs), 1) : timeoutMs
+  }), { provider: 'elevenlabs_direct', priority: 'interactive', deadlineMs });
+}
+
+/**
+ * HTTP status for a request the scheduler did not run: a request that ran out
+ * of its own deadline timed out (504), any other rejection means the service
+ * is busy (503)
+ * 
+ * @param {string} reason - The SchedulerRejectedError reason
+ * @param {number} deadlineMs - The request's time budget, if it had one
+ * @returns {number} The HTTP status code
+ */
+function schedulerRejectionStatus(reason, deadlineMs) {
+  return reason === 'expired' && deadlineMs !== undefined ? 504 : 503;
+}
+
 app.post('/api/music/generate-simple', async (req, res) => {
   try {
-    const { text, duration } = req.body;
+    const { text, duration, book_id, page } = req.body;
     
     console.log('===== SIMPLIFIED MUSIC GENERATION REQUEST =====');
     console.log(`Received text of length: ${text ? text.length : 0}`);
@@ -786,6 +831,50 @@ app.post('/api/music/generate-simple', async (req, res) => {
       return res.status(400).json({ error: 'Text content is required' });
     }
     
+    // Pages prepared by the prefetch or the warm-up have their ambiance
+    // prompt, and usually its clip, waiting in the shared cache
+    const bookId = book_id !== undefined && book_id !== null ? String(book_id) : null;
+    const pageNumber = parseInt(page, 10);
+    const isBookPage = bookId !== null && !Number.isNaN(pageNumber);
+    const pageAmbiance = isBookPage ? getPageAmbiance(bookId, pageNumber) : null;
+    const clipDuration = duration || 15.0;
+    
+    let prompt;
+    if (pageAmbiance) {
+      prompt = pageAmbiance.ambiance_prompt;
+    } else {
+      // Generate a simple prompt based on the text
+      const textSample = text.slice(0, 300); // Take a sample of the text
+      prompt = `Create background music for the following passage: "${textSample}..." The music should match the emotional tone of the text.`;
+    }
+    const mood = (pageAmbiance && pageAmbiance.mood) || 'custom';
+    
+    // Sanitize the prompt for use in headers by removing problematic characters
+    const sanitizedPrompt = prompt
+      .replace(/[^\x20-\x7E]/g, '') // Remove non-printable ASCII characters
+      .replace(/[\r\n"]/g, ' ') // Replace newlines, quotes with spaces
+      .substring(0, 100); // Limit length
+    const sanitizedMood = String(mood).replace(/[^\x20-\x7E]/g, '');
+    
+    const cachedClip = getCachedClip(prompt, clipDuration, 0.7);
+    const cachedAudio = cachedClip && cachedClip.source === 'cache' ? cachedClip.audio : null;
+    if (isBookPage) {
+      pythonBridge.recordPageRequest(bookId, pageNumber, {
+        prepared: Boolean(pageAmbiance),
+        cachedAudio: Boolean(cachedAudio)
+      });
+    }
+    if (cachedAudio) {
+      console.log(`Serving cached music for book ${bookId} page ${pageNumber}`);
+      res.set({
+        'Content-Type': 'audio/mpeg',
+        'X-Detected-Mood': sanitizedMood,
+        'X-Ambiance-Prompt': sanitizedPrompt,
+        'X-Audio-Source': 'cache'
+      });
+      return res.send(cachedAudio);
+    }
+    
     // Get API key from environment
     const apiKey = process.env.ELEVENLABS_API_KEY;
     
@@ -799,44 +888,24 @@ app.post('/api/music/generate-simple', async (req, res) => {
     
     console.log(`API key available (${apiKey.length} chars)`);
     
-    // Generate a simple prompt based on the text
-    const textSample = text.slice(0, 300); // Take a sample of the text
-    const prompt = `Create background music for the following passage: "${textSample}..." The music should match the emotional tone of the text.`;
-    
     console.log('Making direct API call to ElevenLabs...');
     
     // Make the API call directly to ElevenLabs
     try {
-      const response = await axios({
-        method: 'post',
-        url: 'https://api.elevenlabs.io/v1/sound-generation',
-        headers: {
-          'Accept': 'audio/mpeg',
-          'Content-Type': 'application/json',
-          'xi-api-key': apiKey
-        },
-        data: {
-          text: prompt,
-          duration_seconds: duration || 15.0,
-          prompt_influence: 0.7,
-          output_format: 'mp3_44100'
-        },
-        responseType: 'arraybuffer',
-        timeout: 60000 // 60 second timeout
-      });
+      const response = await requestSoundGeneration(apiKey, {
+        text: prompt,
+        duration_seconds: clipDuration,
+        prompt_influence: 0.7,
+        output_format: 'mp3_44100'
+      }, 60000); // 60 second timeout
       
       console.log(`ElevenLabs API call successful, received ${response.data.length} bytes`);
-      
-      // Sanitize the prompt for use in headers by removing problematic characters
-      const sanitizedPrompt = prompt
-        .replace(/[^\x20-\x7E]/g, '') // Remove non-printable ASCII characters
-        .replace(/[\r\n"]/g, ' ') // Replace newlines, quotes with spaces
-        .substring(0, 100); // Limit length
+      putClip(prompt, clipDuration, 0.7, Buffer.from(response.data));
       
       // Set response headers with sanitized values
       res.set({
         'Content-Type': 'audio/mpeg',
-        'X-Detected-Mood': 'custom',
+        'X-Detected-Mood': sanitizedMood,
         'X-Ambiance-Prompt': sanitizedPrompt,
         'X-Direct-Generation': 'true'
       });
@@ -846,6 +915,13 @@ app.post('/api/music/generate-simple', async (req, res) => {
     } catch (apiError) {
       console.error('ElevenLabs API error:', apiError.message);
       
+      if (apiError instanceof SchedulerRejectedError) {
+        return res.status(503).json({
+          error: 'Music generation is busy, please try again shortly',
+          details: apiError.message
+        });
+      }
+      
       let errorDetails = {
         message: apiError.message
       };
@@ -900,9 +976,43 @@ app.post('/api/music/generate-simple', async (req, res) => {
 });
 
 // Generate background music API endpoint
+/**
+ * Read an optional deadline_ms request field
+ * 
+ * @param {*} value - The field as sent by the client
+ * @returns {number|undefined} The budget in milliseconds (0 or more), or undefined when not given
+ */
+function parseDeadlineMs(value) {
+  if (value === undefined || value === null || value === '' || Number.isNaN(Number(value))) {
+    return undefined;
+  }
+  return Math.max(Number(value), 0);
+}
+
+/**
+ * Answer a music request whose deadline left no time to generate audio with the
+ * cached clip (or short preview) for its prompt, when there is one
+ * 
+ * @returns {boolean} Whether a response was sent
+ */
+function sendCachedClip(res, prompt, duration, influence) {
+  const cached = getCachedClip(prompt, duration, influence);
+  if (!cached) {
+    return false;
+  }
+  console.log(`No time left for generation, sending the ${cached.source} clip`);
+  res.set('X-Audio-Source', cached.source);
+  res.set('X-Skipped-Stages', 'generation');
+  res.set('Content-Type', 'audio/mpeg');
+  res.send(cached.audio);
+  return true;
+}
+
 app.post('/api/music/generate', async (req, res) => {
   try {
-    const { text } = req.body;
+    const { text, deadline_ms, layered } = req.body;
+    const deadlineMs = parseDeadlineMs(deadline_ms);
+    const startedAt = Date.now();
     
     console.log('===== MUSIC GENERATION REQUEST =====');
     console.log(`Received text of length: ${text ? text.length : 0}`);
@@ -928,9 +1038,37 @@ app.post('/api/music/generate', async (req, res) => {
       });
     }
     
+    // Layered mode mixes cached per-sound stems instead of generating one clip
+    if (layered) {
+      console.log('Generating layered ambiance through the Python bridge...');
+      const result = await pythonBridge.generateMusicFromText(text, 15.0, { deadlineMs, layered: true });
+      if (result.skipped_stages && result.skipped_stages.length > 0) {
+        res.set('X-Skipped-Stages', result.skipped_stages.join(','));
+      }
+      if (!result.audio) {
+        let status = deadlineMs !== undefined && result.skipped_stages?.length ? 504 : 500;
+        if (result.rejected) {
+          status = schedulerRejectionStatus(result.rejected, deadlineMs);
+        }
+        return res.status(status).json({
+          error: result.error || 'Failed to generate layered ambiance',
+          mood: result.mood,
+          skipped_stages: result.skipped_stages
+        });
+      }
+      res.set('X-Detected-Mood', result.mood);
+      res.set('X-Ambiance-Prompt', result.ambiance_prompt.substring(0, 100) + (result.ambiance_prompt.length > 100 ? '...' : ''));
+      res.set('X-Layered', 'true');
+      res.set('Content-Type', result.content_type);
+      return res.send(result.audio);
+    }
+    
     // Generate ambiance prompt
     console.log('Generating ambiance prompt for music...');
-    const ambianceResult = await pythonBridge.generateAmbiancePrompt(text);
+    const ambianceResult = await pythonBridge.generateAmbiancePrompt(text, {
+      deadlineMs: deadlineMs !== undefined ? deadlineMs * pythonBridge.ANALYSIS_DEADLINE_SHARE : undefined
+    });
+    const skippedStages = [...(ambianceResult.skipped_stages || [])];
     
     console.log('Ambiance generation completed');
     console.log('Result structure:', Object.keys(ambianceResult));
@@ -960,29 +1098,32 @@ app.post('/api/music/generate', async (req, res) => {
     
     // Make a direct API call using axios instead of the client library
     try {
+      // Whatever is left of the deadline after the analysis bounds the generation
+      const remainingMs = deadlineMs !== undefined ? deadlineMs - (Date.now() - startedAt) : undefined;
+      if (remainingMs !== undefined && remainingMs <= 0) {
+        skippedStages.push('generation');
+        res.set('X-Detected-Mood', mood);
+        if (sendCachedClip(res, ambiancePrompt, 15, 0.5)) {
+          return;
+        }
+        throw new Error(`Deadline of ${deadlineMs}ms used up before music generation`);
+      }
+      
       console.log('Making direct API call to ElevenLabs...');
       
-      const response = await axios({
-        method: 'post',
-        url: 'https://api.elevenlabs.io/v1/sound-generation',
-        headers: {
-          'Accept': 'audio/mpeg',
-          'Content-Type': 'application/json',
-          'xi-api-key': apiKey
-        },
-        data: {
-          text: ambiancePrompt,
-          duration_seconds: 15,
-          prompt_influence: 0.5
-        },
-        responseType: 'arraybuffer',
-        timeout: 30000
-      });
+      const response = await requestSoundGeneration(apiKey, {
+        text: ambiancePrompt,
+        duration_seconds: 15,
+        prompt_influence: 0.5
+      }, 30000, remainingMs);
       
       console.log('Direct API call successful');
       console.log('Response status:', response.status);
       console.log('Response data length:', response.data.length);
       
+      // Keep the clip for a later request whose deadline leaves no time to generate
+      putClip(ambiancePrompt, 15, 0.5, Buffer.from(response.data));
+      
       // Send the detected mood in the response headers
       res.set('X-Detected-Mood', mood);
       res.set('X-Ambiance-Prompt', ambiancePrompt.substring(0, 100) + (ambiancePrompt.length > 100 ? '...' : ''));
@@ -992,6 +1133,12 @@ app.post('/api/music/generate', async (req, res) => {
       res.send(Buffer.from(response.data));
     } catch (apiError) {
       console.error('ElevenLabs API error:', apiError.message);
+      if (apiError instanceof SchedulerRejectedError && apiError.reason === 'expired') {
+        skippedStages.push('generation');
+      }
+      if (skippedStages.length > 0) {
+        res.set('X-Skipped-Stages', skippedStages.join(','));
+      }
       
       // Use fallback audio based on mood
       let fallbackAudioPath;
@@ -1137,7 +1284,7 @@ app.post('/api/music/generate', async (req, res) => {
 // Generate ambiance prompt API endpoint
 app.post('/api/ambiance/generate', async (req, res) => {
   try {
-    const { text } = req.body;
+    const { text, deadline_ms, engine, priority } = req.body;
     
     if (!text) {
       return res.status(400).json({ error: 'Text content is required' });
@@ -1145,8 +1292,13 @@ app.post('/api/ambiance/generate', async (req, res) => {
     
     console.log('Generating ambiance prompt for text of length:', text.length);
     
-    // Call the Python script to generate an ambiance prompt
-    const result = await pythonBridge.generateAmbiancePrompt(text);
+    // Call the Python script to generate an ambiance prompt, optionally within a time budget
+    const result = await pythonBridge.generateAmbiancePrompt(text, {
+      deadlineMs: parseDeadlineMs(deadline_ms),
+      engine: engine === 'embeddings' ? 'embeddings' : undefined,
+      // Readers' own pages are interactive; background callers can ask for a lower class
+      priority: ['prefetch', 'batch'].includes(priority) ? priority : 'interactive'
+    });
     
     // Log the generated prompt
     console.log('Generated ambiance prompt:', result.ambiance_prompt);
@@ -1155,6 +1307,9 @@ app.post('/api/ambiance/generate', async (req, res) => {
     if (result.error) {
       console.warn('Warning in ambiance generation:', result.error);
     }
+    if (result.shed || result.expired) {
+      return res.status(503).json(result);
+    }
     
     // Send the result back to the client
     res.json(result);
@@ -1167,6 +1322,46 @@ app.post('/api/ambiance/generate', async (req, res) => {
   }
 });
 
+// Scheduler queue depth, wait times and provider slot usage
+app.get('/api/scheduler/stats', (req, res) => {
+  res.json(pythonBridge.getSchedulerStats());
+});
+
+// Prefetch the ambiance for the pages after the reader's current page
+app.post('/api/ambiance/prefetch', (req, res) => {
+  const { book_id, page, pages, max_generations, reader_id } = req.body;
+  const pageNumber = parseInt(page, 10);
+  
+  if (!book_id || Number.isNaN(pageNumber) || pageNumber < 0) {
+    return res.status(400).json({ error: 'book_id and page are required' });
+  }
+  
+  // Runs are tracked per reader, so the id must stay the same across requests.
+  // Anonymous readers get a new session on every request (sessions are only
+  // saved once a user logs in), so they send their own stable reader_id.
+  let readerId = null;
+  if (typeof reader_id === 'string' && reader_id.length > 0 && reader_id.length <= 128) {
+    readerId = `reader:${reader_id}`;
+  } else if (req.session.user) {
+    readerId = `user:${req.session.user.id}`;
+  }
+  if (!readerId) {
+    return res.status(400).json({ error: 'reader_id is required for anonymous readers' });
+  }
+  
+  // Runs in the background; a later request for another book or page cancels it
+  const { status, cancelled_previous } = pythonBridge.prefetchAmbiance(readerId, String(book_id), pageNumber, {
+    pages: parseInt(pages, 10) || undefined,
+    maxGenerations: max_generations !== undefined ? Math.max(parseInt(max_generations, 10) || 0, 0) : undefined
+  });
+  res.status(202).json({ status, cancelled_previous });
+});
+
+// Prefetch runs, cancellations and hit rate
+app.get('/api/ambiance/prefetch/stats', (req, res) => {
+  res.json(pythonBridge.getPrefetchStats());
+});
+
 // Helper function to generate a music prompt based on text content
 function generateMusicPrompt(text) {
   // Extract key themes, emotions, and setting from the text
@@ -1462,7 +1657,8 @@ app.post('/api/debug/ambiance', async (req, res) => {
 // Generate music directly from text (one-step process)
 app.post('/api/music/generate-from-text', async (req, res) => {
   try {
-    const { text, duration, page } = req.body;
+    const { text, duration, page, deadline_ms } = req.body;
+    const deadlineMs = parseDeadlineMs(deadline_ms);
     
     console.log('===== DIRECT MUSIC GENERATION REQUEST =====');
     console.log(`Received text of length: ${text ? text.length : 0}`);
@@ -1496,30 +1692,33 @@ app.post('/api/music/generate-from-text', async (req, res) => {
     
     console.log('Using direct ElevenLabs API with prompt:', prompt);
     
+    if (deadlineMs === 0) {
+      if (sendCachedClip(res, prompt, duration || 15.0, 0.7)) {
+        return;
+      }
+      return res.status(504).json({
+        error: 'Deadline exceeded before music generation',
+        skipped_stages: ['generation']
+      });
+    }
+    
     try {
       // Make the API call to ElevenLabs Sound Effects endpoint
-      const response = await axios({
-        method: 'post',
-        url: 'https://api.elevenlabs.io/v1/sound-generation',
-        headers: {
-          'Accept': 'audio/mpeg',
-          'Content-Type': 'application/json',
-          'xi-api-key': apiKey
-        },
-        data: {
-          text: prompt,
-          duration_seconds: duration || 15.0,
-          prompt_influence: 0.7,
-          output_format: 'mp3_44100'
-        },
-        responseType: 'arraybuffer',
-        timeout: 60000 // Allow up to 60 seconds for generation
-      });
+      // Allow up to 60 seconds for generation, or the request's deadline if shorter
+      const response = await requestSoundGeneration(apiKey, {
+        text: prompt,
+        duration_seconds: duration || 15.0,
+        prompt_influence: 0.7,
+        output_format: 'mp3_44100'
+      }, 60000, deadlineMs);
       
       console.log('ElevenLabs API call successful');
       console.log('Response status:', response.status);
       console.log('Response data length:', response.data.length);
       
+      // Keep the clip for a later request whose deadline leaves no time to generate
+      putClip(prompt, duration || 15.0, 0.7, Buffer.from(response.data));
+      
       // Set response headers
       res.set('X-Detected-Mood', 'custom');
       res.set('X-Ambiance-Prompt', prompt.substring(0, 100) + (prompt.length > 100 ? '...' : ''));
@@ -1535,6 +1734,21 @@ app.post('/api/music/generate-from-text', async (req, res) => {
         console.error('Response headers:', JSON.stringify(apiError.response.headers || {}));
       }
       
+      if (apiError instanceof SchedulerRejectedError && schedulerRejectionStatus(apiError.reason, deadlineMs) === 503) {
+        return res.status(503).json({
+          error: 'Music generation is busy, please try again shortly',
+          details: apiError.message
+        });
+      }
+      
+      if (deadlineMs !== undefined && (apiError.code === 'ECONNABORTED' || apiError instanceof SchedulerRejectedError)) {
+        return res.status(504).json({
+          error: 'Deadline exceeded during music generation',
+          details: apiError.message,
+          skipped_stages: ['generation']
+        });
+      }
+      
       return res.status(500).json({ 
         error: 'Failed to generate music',
         details: apiError.message
@@ -0,0 +1,156 @@
+/**
+ * Prefetch Tracker - Bookkeeping for predictive ambiance prefetch
+ *
+ * Keeps one prefetch run per reader so a run can be cancelled when the reader
+ * jumps elsewhere, remembers which pages were prefetched, and measures how
+ * many of the reader's own music requests were served from what was prefetched.
+ */
+
+// Number of prefetched pages remembered for the hit rate
+const MAX_TRACKED_PAGES = 5000;
+
+class PrefetchTracker {
+  constructor() {
+    this.runs = new Map();
+    this.prefetched = new Map();
+    this.sequence = 0;
+    this.counters = {
+      runs: 0,
+      reused_runs: 0,
+      cancelled: 0,
+      pages_prefetched: 0,
+      clips_generated: 0,
+      page_requests: 0,
+      prepared_page_requests: 0,
+      cached_audio_requests: 0,
+      prefetched_page_requests: 0,
+      audio_ready_requests: 0,
+      hits: 0
+    };
+  }
+
+  /**
+   * Decide what to do with a prefetch request from a reader
+   *
+   * A run still working on a window that includes the new page is kept. Any
+   * other unfinished run for the reader (different book, or a page outside
+   * its window) is returned as `cancel` so its work can be stopped.
+   *
+   * @param {string} readerId - Identifies the reader; must be stable across requests
+   * @param {string} bookId - The book being read
+   * @param {number} page - The page the reader is on
+   * @param {number} pages - Number of pages to look ahead
+   * @returns {{run: object, started: boolean, cancel: object|null}}
+   */
+  begin(readerId, bookId, page, pages) {
+    const previous = this.runs.get(readerId);
+    let cancel = null;
+    if (previous && !previous.done) {
+      const withinWindow = previous.bookId === bookId && page >= previous.page && page < previous.page + previous.pages;
+      if (withinWindow) {
+        this.counters.reused_runs += 1;
+        return { run: previous, started: false, cancel: null };
+      }
+      previous.cancelled = true;
+      this.counters.cancelled += 1;
+      cancel = previous;
+    }
+
+    this.sequence += 1;
+    const run = {
+      readerId,
+      bookId,
+      page,
+      pages,
+      tag: `prefetch:${readerId}:${this.sequence}`,
+      done: false,
+      cancelled: false,
+      process: null
+    };
+    this.runs.set(readerId, run);
+    this.counters.runs += 1;
+    return { run, started: true, cancel };
+  }
+
+  /**
+   * Record the outcome of a run
+   *
+   * @param {object} run - The run returned by begin()
+   * @param {object|null} report - The JSON report printed by prefetch.py, if any
+   */
+  finish(run, report) {
+    run.done = true;
+    if (this.runs.get(run.readerId) === run) {
+      this.runs.delete(run.readerId);
+    }
+    if (!report) {
+      return;
+    }
+    this.counters.clips_generated += report.generations || 0;
+    for (const entry of report.pages || []) {
+      if (entry.analysis === 'failed') {
+        continue;
+      }
+      this.counters.pages_prefetched += 1;
+      // Re-insert so the Map stays in least recently prefetched order
+      const key = `${run.bookId}:${entry.page}`;
+      this.prefetched.delete(key);
+      this.prefetched.set(key, {
+        audioReady: ['cached', 'generated', 'same_scene'].includes(entry.audio)
+      });
+    }
+    while (this.prefetched.size > MAX_TRACKED_PAGES) {
+      this.prefetched.delete(this.prefetched.keys().next().value);
+    }
+  }
+
+  /**
+   * Count a reader's own music request for a page towards the hit rate
+   *
+   * @param {string} bookId - The book being read
+   * @param {number} page - The page the music was requested for
+   * @param {object} served - How the request was served
+   * @param {boolean} served.prepared - The page had a prepared ambiance prompt
+   * @param {boolean} served.cachedAudio - The music came from the cache
+   */
+  recordPageRequest(bookId, page, served) {
+    this.counters.page_requests += 1;
+    if (served.prepared) {
+      this.counters.prepared_page_requests += 1;
+    }
+    if (served.cachedAudio) {
+      this.counters.cached_audio_requests += 1;
+    }
+    const prefetched = this.prefetched.get(`${bookId}:${page}`);
+    if (!prefetched) {
+      return;
+    }
+    this.counters.prefetched_page_requests += 1;
+    if (prefetched.audioReady) {
+      this.counters.audio_ready_requests += 1;
+    }
+    if (served.cachedAudio) {
+      this.counters.hits += 1;
+    }
+  }
+
+  /**
+   * Prefetch counters and hit rate: the share of the reader's music requests
+   * for a page that had been prefetched and whose music came from the cache
+   *
+   * @returns {object} Prefetch statistics
+   */
+  getStats() {
+    const { page_requests, hits } = this.counters;
+    return {
+      ...this.counters,
+      active_runs: this.runs.size,
+      tracked_pages: this.prefetched.size,
+      hit_rate: page_requests ? Number((hits / page_requests).toFixed(3)) : null
+    };
+  }
+}
+
+module.exports = {
+  PrefetchTracker
+};
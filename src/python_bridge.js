@@ -8,10 +8,28 @@ const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
 const os = require('os');
+const { scheduler, SchedulerRejectedError } = require('./scheduler');
+const { PrefetchTracker } = require('./prefetch');
+const { getCachedClip } = require('./ambiance_cache');
 
 // Path to the Python scripts directory
 const PYTHON_SCRIPTS_DIR = path.join(__dirname, '..', 'python_scripts');
 
+// Extra time given to a Python process past its deadline before it is killed
+const DEADLINE_GRACE_MS = 250;
+
+// Share of an end-to-end deadline given to the ambiance analysis step in
+// generateMusicFromText (environment + analysis weights in deadline.py)
+const ANALYSIS_DEADLINE_SHARE = 0.4;
+
+// Defaults for prefetching the pages after the reader's current one
+const PREFETCH_PAGES = 5;
+const PREFETCH_MAX_GENERATIONS = 2;
+const PREFETCH_DEADLINE_MS = 120000;
+
+// Neutral result returned when an analysis cannot be run
+const NEUTRAL_AMBIANCE_PROMPT = 'Subtle neutral background ambiance with gentle soundscape';
+
 // Logging utility with timestamps
 function logWithTimestamp(level, message) {
   const timestamp = new Date().toISOString();
@@ -91,13 +109,85 @@ function logEnvironmentVariables() {
   }
 }
 
+/**
+ * Kill a Python process if it is still running when its deadline has passed
+ * 
+ * @param {ChildProcess} pythonProcess - The spawned process
+ * @param {number} deadlineMs - The deadline given to the process
+ * @param {Function} onKill - Called after the process has been killed
+ * @returns {NodeJS.Timeout|null} The timer, to be cleared when the process exits
+ */
+function killAfterDeadline(pythonProcess, deadlineMs, onKill) {
+  if (deadlineMs === undefined) {
+    return null;
+  }
+  return setTimeout(() => {
+    logWithTimestamp('warn', `Python process exceeded its ${deadlineMs}ms deadline, killing it`);
+    pythonProcess.kill('SIGKILL');
+    onKill();
+  }, deadlineMs + DEADLINE_GRACE_MS);
+}
+
+/**
+ * Deadline left for a job after waiting in the scheduler queue
+ * 
+ * @param {number} deadlineMs - The caller's time budget, if any
+ * @param {number} waitedMs - Time spent queued
+ * @returns {number|undefined} The remaining budget (0 once it is used up), or undefined without a deadline
+ */
+function remainingDeadline(deadlineMs, waitedMs) {
+  return deadlineMs !== undefined ? Math.max(deadlineMs - waitedMs, 0) : undefined;
+}
+
 /**
  * Call the ambiance generator script with the provided text
  * 
+ * The call is queued in the scheduler under the OpenAI provider, so the page a
+ * reader is looking at ('interactive', the default) goes ahead of prefetch and
+ * batch work.
+ * 
  * @param {string} text - The text content to analyze
+ * @param {object} options - Optional settings
+ * @param {number} options.deadlineMs - Time budget in milliseconds, including time spent
+ *   queued; when it runs out a partial result is returned with the skipped stages
+ *   listed in skipped_stages
+ * @param {string} options.engine - 'chat' (default) or 'embeddings' for the faster
+ *   centroid classifier
+ * @param {string} options.priority - 'interactive' (default), 'prefetch' or 'batch'
+ * @param {string} options.tag - Optional scheduler tag used to cancel the queued call
  * @returns {Promise<object>} The analysis results
  */
-async function generateAmbiancePrompt(text) {
+async function generateAmbiancePrompt(text, options = {}) {
+  const { deadlineMs, priority = 'interactive', tag } = options;
+  try {
+    return await scheduler.schedule(
+      (waitedMs) => runAmbiancePrompt(text, { ...options, deadlineMs: remainingDeadline(deadlineMs, waitedMs) }),
+      { provider: 'openai', priority, deadlineMs, tag }
+    );
+  } catch (e) {
+    if (!(e instanceof SchedulerRejectedError)) {
+      throw e;
+    }
+    logWithTimestamp('warn', `Ambiance analysis not run: ${e.message}`);
+    if (deadlineMs !== undefined && e.reason === 'expired') {
+      return {
+        mood: 'neutral',
+        setting: 'unspecified',
+        ambiance_prompt: NEUTRAL_AMBIANCE_PROMPT,
+        partial: true,
+        skipped_stages: ['analysis']
+      };
+    }
+    return {
+      error: `Ambiance analysis ${e.reason}: ${e.message}`,
+      [e.reason]: true,
+      ambiance_prompt: NEUTRAL_AMBIANCE_PROMPT
+    };
+  }
+}
+
+async function runAmbiancePrompt(text, options = {}) {
+  const { deadlineMs, engine } = options;
   logWithTimestamp('log', `Generating ambiance prompt for text (length: ${text?.length || 0})...`);
   if (!text || typeof text !== 'string' || text.trim().length === 0) {
     logWithTimestamp('error', 'Invalid text provided to generateAmbiancePrompt');
@@ -145,12 +235,28 @@ async function generateAmbiancePrompt(text) {
     
     return new Promise((resolve) => {
       // Call the Python script with the temporary file
-      logWithTimestamp('log', `Executing Python script: ${pythonCommand} ${scriptPath} --file ${tempFile}`);
-      const pythonProcess = spawn(pythonCommand, [
-        scriptPath,
-        '--file',
-        tempFile
-      ], { env: process.env }); // Explicitly pass all environment variables
+      const cmdArgs = [scriptPath, '--file', tempFile];
+      if (engine) {
+        cmdArgs.push('--engine', engine);
+      }
+      if (deadlineMs !== undefined) {
+        cmdArgs.push('--deadline-ms', String(Math.max(Math.round(deadlineMs), 0)));
+      }
+      logWithTimestamp('log', `Executing Python script: ${pythonCommand} ${cmdArgs.join(' ')}`);
+      const pythonProcess = spawn(pythonCommand, cmdArgs, { env: process.env }); // Explicitly pass all environment variables
+      
+      // Past the deadline, answer with a neutral partial result instead of waiting
+      let timedOut = false;
+      const deadlineTimer = killAfterDeadline(pythonProcess, deadlineMs, () => {
+        timedOut = true;
+        resolve({
+          mood: 'neutral',
+          setting: 'unspecified',
+          ambiance_prompt: 'Subtle neutral background ambiance with gentle soundscape',
+          partial: true,
+          skipped_stages: ['analysis']
+        });
+      });
       
       let outputData = '';
       let errorData = '';
@@ -170,6 +276,7 @@ async function generateAmbiancePrompt(text) {
       // Handle process completion
       pythonProcess.on('close', (code) => {
         logWithTimestamp('log', `Python process exited with code ${code}`);
+        clearTimeout(deadlineTimer);
         
         // Clean up the temporary file
         try {
@@ -179,6 +286,10 @@ async function generateAmbiancePrompt(text) {
           logWithTimestamp('warn', `Failed to delete temporary file ${tempFile}: ${e.message}`);
         }
         
+        if (timedOut) {
+          return;
+        }
+        
         if (code !== 0) {
           logWithTimestamp('error', `Python process exited with code ${code}`);
           logWithTimestamp('error', `Error output: ${errorData}`);
@@ -214,6 +325,7 @@ async function generateAmbiancePrompt(text) {
       // Handle process errors
       pythonProcess.on('error', (err) => {
         logWithTimestamp('error', `Failed to start Python process: ${err.message}`);
+        clearTimeout(deadlineTimer);
         
         // Clean up the temporary file
         try {
@@ -238,15 +350,88 @@ async function generateAmbiancePrompt(text) {
   }
 }
 
+/**
+ * Run a music job through the scheduler under the ElevenLabs provider
+ * 
+ * When the deadline is already used up (before or while queued) no generation
+ * is started; the cached clip or preview is returned instead, if there is one.
+ * 
+ * @param {Function} run - Called with the options adjusted for the time spent queued
+ * @param {object} options - Options passed to generateMusic or generateLayeredAmbiance
+ * @param {Function} cachedClip - Returns {audio, source} for a cached clip, or null
+ * @returns {Promise<Buffer|null>} The audio, or null when the job was not run
+ */
+async function scheduleMusicJob(run, options, cachedClip = () => null) {
+  const { deadlineMs, priority, tag } = options;
+  const skipGeneration = () => {
+    const cached = cachedClip();
+    if (options.report) {
+      options.report.source = cached ? cached.source : null;
+      options.report.skipped_stages = ['generation'];
+    }
+    return cached ? cached.audio : null;
+  };
+  
+  if (deadlineMs !== undefined && deadlineMs <= 0) {
+    logWithTimestamp('warn', 'No time left for music generation, skipping it');
+    return skipGeneration();
+  }
+  try {
+    return await scheduler.schedule(
+      (waitedMs) => {
+        const remainingMs = remainingDeadline(deadlineMs, waitedMs);
+        if (remainingMs !== undefined && remainingMs <= 0) {
+          logWithTimestamp('warn', 'Deadline passed while queued, skipping music generation');
+          return skipGeneration();
+        }
+        return run({ ...options, deadlineMs: remainingMs });
+      },
+      { provider: 'elevenlabs', priority, deadlineMs, tag }
+    );
+  } catch (e) {
+    if (!(e instanceof SchedulerRejectedError)) {
+      throw e;
+    }
+    logWithTimestamp('warn', `Music generation not run: ${e.message}`);
+    const audio = e.reason === 'expired' ? skipGeneration() : null;
+    if (options.report) {
+      if (!audio) {
+        options.report.source = null;
+      }
+      options.report.skipped_stages = ['generation'];
+      options.report[e.reason] = true;
+    }
+    return audio;
+  }
+}
+
 /**
  * Generate music using ElevenLabs API based on an ambiance prompt
  * 
  * @param {string} prompt - The ambiance prompt to use for generating music
  * @param {number} duration - The duration of the music in seconds (default: 15.0)
  * @param {number} influence - The prompt influence factor between 0.0 and 1.0 (default: 0.7)
+ * @param {object} options - Optional settings
+ * @param {number} options.deadlineMs - Time budget in milliseconds, including time spent
+ *   queued; when it is too short for a full generation a cached clip or short preview
+ *   is returned
+ * @param {object} options.report - Filled with the audio source ('cache', 'generated'
+ *   or 'preview') and skipped_stages
+ * @param {string} options.priority - 'interactive' (default), 'prefetch' or 'batch'
+ * @param {string} options.tag - Optional scheduler tag used to cancel the queued call
  * @returns {Promise<Buffer>} The generated audio data as a Buffer
  */
-async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
+async function generateMusic(prompt, duration = 15.0, influence = 0.7, options = {}) {
+  return scheduleMusicJob(
+    (runOptions) => runMusic(prompt, duration, influence, runOptions),
+    options,
+    () => (typeof prompt === 'string' && prompt.trim() ? getCachedClip(prompt, duration, influence) : null)
+  );
+}
+
+async function runMusic(prompt, duration = 15.0, influence = 0.7, options = {}) {
+  const { deadlineMs } = options;
+  const report = options.report || {};
   logWithTimestamp('log', `Generating music with prompt: ${prompt}`);
   logWithTimestamp('log', `Parameters: duration=${duration}s, influence=${influence}`);
   
@@ -279,6 +464,7 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
   
   // Create a temporary file to store the prompt
   const tempFile = path.join(os.tmpdir(), `storia_prompt_${Date.now()}.txt`);
+  const reportFile = path.join(os.tmpdir(), `storia_report_${Date.now()}.json`);
   
   try {
     // Write the prompt to the temporary file
@@ -291,12 +477,25 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
         scriptPath,
         '--prompt', prompt,
         '--duration', duration.toString(),
-        '--influence', influence.toString()
+        '--influence', influence.toString(),
+        '--report-file', reportFile
       ];
+      if (deadlineMs !== undefined) {
+        cmdArgs.push('--deadline-ms', String(Math.max(Math.round(deadlineMs), 0)));
+      }
       
       logWithTimestamp('log', `Executing Python script: ${pythonCommand} ${cmdArgs.join(' ')}`);
       const pythonProcess = spawn(pythonCommand, cmdArgs, { env: process.env }); // Explicitly pass all environment variables
       
+      // Past the deadline, give up on this clip rather than holding the request open
+      let timedOut = false;
+      const deadlineTimer = killAfterDeadline(pythonProcess, deadlineMs, () => {
+        timedOut = true;
+        report.source = null;
+        report.skipped_stages = ['generation'];
+        resolve(null);
+      });
+      
       // Collect stdout data as binary
       const chunks = [];
       pythonProcess.stdout.on('data', (data) => {
@@ -314,6 +513,7 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
       // Handle process completion
       pythonProcess.on('close', (code) => {
         logWithTimestamp('log', `Python process for music generation exited with code ${code}`);
+        clearTimeout(deadlineTimer);
         
         // Clean up the temporary file
         try {
@@ -323,6 +523,18 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
           logWithTimestamp('warn', `Failed to delete temporary file ${tempFile}: ${e.message}`);
         }
         
+        // Pick up the audio source and skipped stages reported by the script
+        try {
+          Object.assign(report, JSON.parse(fs.readFileSync(reportFile, 'utf8')));
+          fs.unlinkSync(reportFile);
+        } catch (e) {
+          logWithTimestamp('warn', `No music generation report available: ${e.message}`);
+        }
+        
+        if (timedOut) {
+          return;
+        }
+        
         if (code !== 0) {
           logWithTimestamp('error', `Python process exited with code ${code}`);
           logWithTimestamp('error', `Log output: ${logData}`);
@@ -347,6 +559,7 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
       // Handle process errors
       pythonProcess.on('error', (err) => {
         logWithTimestamp('error', `Failed to start Python process: ${err.message}`);
+        clearTimeout(deadlineTimer);
         
         // Clean up the temporary file
         try {
@@ -365,14 +578,311 @@ async function generateMusic(prompt, duration = 15.0, influence = 0.7) {
   }
 }
 
+/**
+ * Generate layered ambiance (cached per-sound stems plus a music bed, mixed locally)
+ * 
+ * @param {object} analysis - The result of generateAmbiancePrompt (mood, ambient_sounds, ...)
+ * @param {number} duration - The duration of the mix in seconds (default: 15.0)
+ * @param {object} options - Optional settings
+ * @param {number} options.deadlineMs - Time budget in milliseconds, including time spent
+ *   queued; when it runs out only the stems that are already cached are mixed
+ * @param {object} options.report - Filled with the cached, generated and missing stems
+ * @param {string} options.priority - 'interactive' (default), 'prefetch' or 'batch'
+ * @param {string} options.tag - Optional scheduler tag used to cancel the queued call
+ * @returns {Promise<Buffer>} The mixed audio as a WAV Buffer
+ */
+async function generateLayeredAmbiance(analysis, duration = 15.0, options = {}) {
+  return scheduleMusicJob((runOptions) => runLayeredAmbiance(analysis, duration, runOptions), options);
+}
+
+async function runLayeredAmbiance(analysis, duration = 15.0, options = {}) {
+  const { deadlineMs } = options;
+  const report = options.report || {};
+  logWithTimestamp('log', `Generating layered ambiance for mood: ${analysis?.mood}, sounds: ${JSON.stringify(analysis?.ambient_sounds || [])}`);
+  
+  if (!analysis || typeof analysis !== 'object') {
+    logWithTimestamp('error', 'Invalid analysis provided to generateLayeredAmbiance');
+    return null;
+  }
+  
+  // Check if Python is available
+  const pythonAvailable = await isPythonAvailable();
+  if (!pythonAvailable) {
+    logWithTimestamp('error', 'Python is not available, cannot generate layered ambiance');
+    return null;
+  }
+  
+  // Get the appropriate Python command
+  const pythonCommand = await getPythonCommand();
+  
+  // Path to the layered ambiance script
+  const scriptPath = path.join(PYTHON_SCRIPTS_DIR, 'layered_ambiance.py');
+  
+  // Check if the script exists
+  if (!fs.existsSync(scriptPath)) {
+    logWithTimestamp('error', `Layered ambiance script not found at ${scriptPath}`);
+    return null;
+  }
+  
+  // Create temporary files for the analysis and the report
+  const tempFile = path.join(os.tmpdir(), `storia_analysis_${Date.now()}.json`);
+  const reportFile = path.join(os.tmpdir(), `storia_layers_${Date.now()}.json`);
+  
+  try {
+    fs.writeFileSync(tempFile, JSON.stringify(analysis), 'utf8');
+    logWithTimestamp('log', `Analysis written to temporary file: ${tempFile}`);
+    
+    return new Promise((resolve) => {
+      const cmdArgs = [
+        scriptPath,
+        '--analysis-file', tempFile,
+        '--duration', duration.toString(),
+        '--report-file', reportFile
+      ];
+      if (deadlineMs !== undefined) {
+        cmdArgs.push('--deadline-ms', String(Math.max(Math.round(deadlineMs), 0)));
+      }
+      
+      logWithTimestamp('log', `Executing Python script: ${pythonCommand} ${cmdArgs.join(' ')}`);
+      const pythonProcess = spawn(pythonCommand, cmdArgs, { env: process.env }); // Explicitly pass all environment variables
+      
+      let timedOut = false;
+      const deadlineTimer = killAfterDeadline(pythonProcess, deadlineMs, () => {
+        timedOut = true;
+        resolve(null);
+      });
+      
+      // Collect stdout data as binary
+      const chunks = [];
+      pythonProcess.stdout.on('data', (data) => {
+        chunks.push(data);
+      });
+      
+      // Collect stderr data for logging
+      let logData = '';
+      pythonProcess.stderr.on('data', (data) => {
+        logData += data.toString();
+        logWithTimestamp('log', `Layered ambiance logs: ${data}`);
+      });
+      
+      // Handle process completion
+      pythonProcess.on('close', (code) => {
+        logWithTimestamp('log', `Python process for layered ambiance exited with code ${code}`);
+        clearTimeout(deadlineTimer);
+        
+        // Pick up which stems were cached, generated or missing
+        try {
+          Object.assign(report, JSON.parse(fs.readFileSync(reportFile, 'utf8')));
+        } catch (e) {
+          logWithTimestamp('warn', `No layered ambiance report available: ${e.message}`);
+        }
+        
+        // Clean up the temporary files
+        for (const file of [tempFile, reportFile]) {
+          try {
+            fs.unlinkSync(file);
+          } catch (e) {
+            logWithTimestamp('warn', `Failed to delete temporary file ${file}: ${e.message}`);
+          }
+        }
+        
+        if (timedOut) {
+          return;
+        }
+        
+        if (code !== 0) {
+          logWithTimestamp('error', `Python process exited with code ${code}`);
+          logWithTimestamp('error', `Log output: ${logData}`);
+          resolve(null);
+          return;
+        }
+        
+        const buffer = Buffer.concat(chunks);
+        if (buffer.length === 0) {
+          logWithTimestamp('error', 'No audio data received from layered ambiance generator');
+          resolve(null);
+          return;
+        }
+        
+        logWithTimestamp('log', `Received total ${buffer.length} bytes of layered audio data`);
+        resolve(buffer);
+      });
+      
+      // Handle process errors
+      pythonProcess.on('error', (err) => {
+        logWithTimestamp('error', `Failed to start Python process: ${err.message}`);
+        clearTimeout(deadlineTimer);
+        
+        try {
+          fs.unlinkSync(tempFile);
+        } catch (e) {
+          logWithTimestamp('warn', `Failed to delete temporary file ${tempFile}: ${e.message}`);
+        }
+        
+        resolve(null);
+      });
+    });
+  } catch (e) {
+    logWithTimestamp('error', `Error preparing layered ambiance: ${e.message}`);
+    return null;
+  }
+}
+
+const prefetchTracker = new PrefetchTracker();
+
+/**
+ * Prefetch the ambiance for the pages after a reader's current page
+ * 
+ * Runs prefetch.py in the background at 'prefetch' priority: the next pages
+ * are analyzed and, where the scene changes, their music is generated or found
+ * in the cache. A reader moving forward within the window of a run still in
+ * progress reuses it; jumping anywhere else cancels the previous run (queued or
+ * running) before starting a new one.
+ * 
+ * @param {string} readerId - Identifies the reader; must be stable across requests
+ * @param {string} bookId - Gutenberg book id
+ * @param {number} page - The page the reader is on
+ * @param {object} options - Optional settings
+ * @param {number} options.pages - Number of pages to look ahead (default 5)
+ * @param {number} options.maxGenerations - Maximum new clips per run (default 2)
+ * @param {number} options.deadlineMs - Time budget for the run, including time queued
+ * @returns {{status: string, cancelled_previous: boolean, completion: Promise<object|null>}}
+ *   status is 'started' or 'in_progress'; completion resolves with the prefetch report
+ */
+function prefetchAmbiance(readerId, bookId, page, options = {}) {
+  const {
+    pages = PREFETCH_PAGES,
+    maxGenerations = PREFETCH_MAX_GENERATIONS,
+    deadlineMs = PREFETCH_DEADLINE_MS
+  } = options;
+  const { run, started, cancel } = prefetchTracker.begin(readerId, bookId, page, pages);
+  
+  if (cancel) {
+    logWithTimestamp('log', `Reader moved to book ${bookId} page ${page}, cancelling prefetch of book ${cancel.bookId} from page ${cancel.page}`);
+    scheduler.cancel(cancel.tag);
+    if (cancel.process) {
+      cancel.process.kill('SIGTERM');
+    }
+  }
+  
+  if (!started) {
+    return { status: 'in_progress', cancelled_previous: false, completion: run.completion };
+  }
+  
+  run.completion = scheduler.schedule(
+    (waitedMs) => runPrefetch(run, { pages, maxGenerations, deadlineMs: remainingDeadline(deadlineMs, waitedMs) }),
+    {
+      provider: maxGenerations > 0 ? ['openai', 'elevenlabs'] : 'openai',
+      priority: 'prefetch',
+      deadlineMs,
+      tag: run.tag
+    }
+  ).catch((e) => {
+    logWithTimestamp('warn', `Prefetch of book ${bookId} from page ${page} not run: ${e.message}`);
+    return null;
+  }).then((report) => {
+    prefetchTracker.finish(run, report);
+    return report;
+  });
+  
+  return { status: 'started', cancelled_previous: Boolean(cancel), completion: run.completion };
+}
+
+async function runPrefetch(run, options) {
+  const { pages, maxGenerations, deadlineMs } = options;
+  if (run.cancelled) {
+    return null;
+  }
+  
+  const pythonCommand = await getPythonCommand();
+  const scriptPath = path.join(PYTHON_SCRIPTS_DIR, 'prefetch.py');
+  
+  return new Promise((resolve) => {
+    const cmdArgs = [
+      scriptPath,
+      '--book-id', String(run.bookId),
+      '--page', String(run.page),
+      '--pages', String(pages),
+      '--max-generations', String(maxGenerations)
+    ];
+    if (deadlineMs !== undefined) {
+      cmdArgs.push('--deadline-ms', String(Math.max(Math.round(deadlineMs), 0)));
+    }
+    
+    logWithTimestamp('log', `Executing Python script: ${pythonCommand} ${cmdArgs.join(' ')}`);
+    const pythonProcess = spawn(pythonCommand, cmdArgs, { env: process.env });
+    run.process = pythonProcess;
+    
+    const deadlineTimer = killAfterDeadline(pythonProcess, deadlineMs, () => resolve(null));
+    
+    let outputData = '';
+    pythonProcess.stdout.on('data', (data) => {
+      outputData += data.toString();
+    });
+    
+    pythonProcess.stderr.on('data', (data) => {
+      logWithTimestamp('log', `Prefetch logs: ${data}`);
+    });
+    
+    pythonProcess.on('close', (code) => {
+      clearTimeout(deadlineTimer);
+      run.process = null;
+      if (run.cancelled) {
+        logWithTimestamp('log', `Prefetch of book ${run.bookId} from page ${run.page} cancelled`);
+        resolve(null);
+        return;
+      }
+      if (code !== 0) {
+        logWithTimestamp('error', `Prefetch process exited with code ${code}`);
+        resolve(null);
+        return;
+      }
+      try {
+        const report = JSON.parse(outputData);
+        logWithTimestamp('log', `Prefetched ${report.pages.length} pages of book ${run.bookId} after page ${run.page} (${report.generations} generations)`);
+        resolve(report);
+      } catch (e) {
+        logWithTimestamp('error', `Failed to parse prefetch output as JSON: ${e.message}`);
+        resolve(null);
+      }
+    });
+    
+    pythonProcess.on('error', (err) => {
+      logWithTimestamp('error', `Failed to start Python process: ${err.message}`);
+      clearTimeout(deadlineTimer);
+      resolve(null);
+    });
+  });
+}
+
+/**
+ * Reason a step was not run by the scheduler ('shed' or 'expired'), from the
+ * flags generateAmbiancePrompt and the music report set
+ * 
+ * @param {object} result - The analysis result or music report
+ * @returns {string|undefined} The rejection reason, if the step was rejected
+ */
+function schedulerRejection(result) {
+  return ['shed', 'expired'].find((reason) => result && result[reason]);
+}
+
 /**
  * Generate ambiance prompt and then generate music in one step
  * 
  * @param {string} text - The text content to analyze for generating music
  * @param {number} duration - The duration of the music in seconds (default: 15.0)
- * @returns {Promise<Object>} Object containing the audio data, mood, and ambiance prompt
+ * @param {object} options - Optional settings
+ * @param {number} options.deadlineMs - End-to-end time budget in milliseconds, split
+ *   between the analysis and generation steps
+ * @param {boolean} options.layered - Mix cached per-sound stems instead of generating
+ *   one clip for the whole scene (returns WAV audio)
+ * @param {string} options.priority - Scheduler priority for both steps (default 'interactive')
+ * @returns {Promise<Object>} Object containing the audio data, mood, and ambiance prompt;
+ *   without audio, `rejected` gives the reason a step was not run by the scheduler
  */
-async function generateMusicFromText(text, duration = 15.0) {
+async function generateMusicFromText(text, duration = 15.0, options = {}) {
+  const { deadlineMs, layered, priority } = options;
+  const startedAt = Date.now();
   logWithTimestamp('log', `Generating music from text of length: ${text?.length || 0}`);
   
   if (!text || typeof text !== 'string' || text.trim().length === 0) {
@@ -391,12 +901,16 @@ async function generateMusicFromText(text, duration = 15.0) {
     
     // First, generate an ambiance prompt
     logWithTimestamp('log', 'Step 1: Generating ambiance prompt from text...');
-    const ambianceResult = await generateAmbiancePrompt(text);
+    const ambianceResult = await generateAmbiancePrompt(text, {
+      deadlineMs: deadlineMs !== undefined ? deadlineMs * ANALYSIS_DEADLINE_SHARE : undefined,
+      priority
+    });
     
     if (!ambianceResult || ambianceResult.error) {
       logWithTimestamp('error', 'Error generating ambiance prompt:', ambianceResult?.error || 'Unknown error');
       return {
         error: ambianceResult?.error || 'Failed to generate ambiance prompt',
+        rejected: schedulerRejection(ambianceResult),
         audio: null,
         mood: 'neutral',
         ambiance_prompt: 'Subtle neutral background ambiance with gentle soundscape'
@@ -412,15 +926,32 @@ async function generateMusicFromText(text, duration = 15.0) {
     
     // Generate music using the ambiance prompt
     logWithTimestamp('log', 'Step 2: Generating music from ambiance prompt...');
-    const audioData = await generateMusic(ambiancePrompt, duration, 0.7);
+    const musicReport = {};
+    const musicOptions = {
+      deadlineMs: deadlineMs !== undefined ? Math.max(deadlineMs - (Date.now() - startedAt), 0) : undefined,
+      report: musicReport,
+      priority
+    };
+    const audioData = layered
+      ? await generateLayeredAmbiance(ambianceResult, duration, musicOptions)
+      : await generateMusic(ambiancePrompt, duration, 0.7, musicOptions);
+    const contentType = layered ? 'audio/wav' : 'audio/mpeg';
+    
+    // Report which stages were skipped to stay within the deadline
+    const deadlineInfo = deadlineMs !== undefined ? {
+      skipped_stages: [...(ambianceResult.skipped_stages || []), ...(musicReport.skipped_stages || [])],
+      audio_source: musicReport.source || null
+    } : {};
     
     if (!audioData) {
       logWithTimestamp('error', 'Failed to generate music from ambiance prompt');
       return {
         error: 'Failed to generate music',
+        rejected: schedulerRejection(musicReport),
         audio: null,
         mood,
-        ambiance_prompt: ambiancePrompt
+        ambiance_prompt: ambiancePrompt,
+        ...deadlineInfo
       };
     }
     
@@ -428,8 +959,10 @@ async function generateMusicFromText(text, duration = 15.0) {
     return {
       error: null,
       audio: audioData,
+      content_type: contentType,
       mood,
-      ambiance_prompt: ambiancePrompt
+      ambiance_prompt: ambiancePrompt,
+      ...deadlineInfo
     };
   } catch (error) {
     logWithTimestamp('error', `Error in generateMusicFromText: ${error.message}`);
@@ -447,5 +980,11 @@ module.exports = {
   generateAmbiancePrompt,
   isPythonAvailable,
   generateMusic,
-  generateMusicFromText
+  generateLayeredAmbiance,
+  generateMusicFromText,
+  prefetchAmbiance,
+  ANALYSIS_DEADLINE_SHARE,
+  getSchedulerStats: () => scheduler.getStats(),
+  getPrefetchStats: () => prefetchTracker.getStats(),
+  recordPageRequest: (bookId, page, served) => prefetchTracker.recordPageRequest(bookId, page, served)
 }; 
\ No newline at end of file
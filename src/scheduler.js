@@ -0,0 +1,296 @@
+/**
+ * Scheduler - Priority scheduling and admission control for Python work
+ *
+ * Every Python bridge call spawns a process that talks to an upstream provider
+ * (OpenAI for the ambiance analysis, ElevenLabs for music). Without a scheduler
+ * they all run at once, first come first served, so background work can starve
+ * the page the reader is looking at.
+ *
+ * Jobs are queued per priority class (interactive, prefetch, batch) in bounded
+ * queues and started highest priority first, subject to a concurrency limit per
+ * provider. Background classes may never take the slots reserved for
+ * interactive work, so a reader's request starts as soon as one frees up.
+ * When a queue is full, low-priority work is shed: the oldest queued prefetch
+ * makes way for a newer one (the reader has moved on), and batch submissions
+ * are refused so the caller can defer and retry later.
+ *
+ * Producers: the Python bridge (analysis, music, layered ambiance, prefetch)
+ * and the routes in src/index.js that call ElevenLabs directly, all of which
+ * submit interactive work except the prefetch. Nothing submits batch work
+ * yet: the warm-up job (python_scripts/warmup.py) runs as its own process and
+ * bounds its provider calls with its own semaphores, so its load is not
+ * visible here and can still compete with readers for provider quota.
+ */
+
+const PRIORITIES = ['interactive', 'prefetch', 'batch'];
+
+// Maximum number of queued (not yet running) jobs per priority class
+const DEFAULT_QUEUE_LIMITS = { interactive: 32, prefetch: 16, batch: 64 };
+
+// Queued prefetches older than this are no longer useful to the reader, and a
+// reader waiting longer than STORIA_INTERACTIVE_MAX_WAIT_MS is better told the
+// service is busy
+const DEFAULT_MAX_WAIT_MS = {
+  interactive: Number(process.env.STORIA_INTERACTIVE_MAX_WAIT_MS) || 20000,
+  prefetch: 30000,
+  batch: null
+};
+
+// Concurrent jobs per provider. 'openai' and 'elevenlabs' count Python
+// processes (STORIA_OPENAI_CONCURRENCY, STORIA_ELEVENLABS_CONCURRENCY);
+// 'elevenlabs_direct' counts the requests src/index.js sends to ElevenLabs
+// itself (STORIA_ELEVENLABS_DIRECT_CONCURRENCY). Both ElevenLabs limits draw
+// on the same account, so together they should stay within its concurrency.
+const DEFAULT_PROVIDER_LIMITS = {
+  openai: Number(process.env.STORIA_OPENAI_CONCURRENCY) || 4,
+  elevenlabs: Number(process.env.STORIA_ELEVENLABS_CONCURRENCY) || 2,
+  elevenlabs_direct: Number(process.env.STORIA_ELEVENLABS_DIRECT_CONCURRENCY) || 3
+};
+
+// Slots per provider that prefetch and batch work may never take. Only
+// interactive work calls ElevenLabs directly, so nothing is reserved there.
+const DEFAULT_RESERVED_INTERACTIVE = { openai: 1, elevenlabs: 1, elevenlabs_direct: 0 };
+
+// Number of recent queue wait times kept per class for the percentiles
+const WAIT_SAMPLE_SIZE = 200;
+
+/**
+ * Raised (as a rejection) when a job is not run: its queue was full ('shed'),
+ * its deadline or maximum wait passed while queued ('expired'), or it was
+ * cancelled by tag ('cancelled')
+ */
+class SchedulerRejectedError extends Error {
+  constructor(reason, message) {
+    super(message);
+    this.name = 'SchedulerRejectedError';
+    this.reason = reason;
+  }
+}
+
+function percentile(sortedSamples, pct) {
+  if (sortedSamples.length === 0) {
+    return null;
+  }
+  const index = Math.min(sortedSamples.length - 1, Math.ceil((pct / 100) * sortedSamples.length) - 1);
+  return sortedSamples[Math.max(index, 0)];
+}
+
+class Scheduler {
+  /**
+   * @param {object} options - Optional overrides
+   * @param {object} options.providerLimits - Concurrent jobs per provider
+   * @param {object} options.reservedInteractive - Slots per provider kept for interactive jobs
+   * @param {object} options.queueLimits - Maximum queued jobs per priority class
+   * @param {object} options.maxWaitMs - Maximum queue wait per priority class (null for none)
+   */
+  constructor(options = {}) {
+    this.providerLimits = { ...DEFAULT_PROVIDER_LIMITS, ...options.providerLimits };
+    this.reservedInteractive = { ...DEFAULT_RESERVED_INTERACTIVE, ...options.reservedInteractive };
+    this.queueLimits = { ...DEFAULT_QUEUE_LIMITS, ...options.queueLimits };
+    this.maxWaitMs = { ...DEFAULT_MAX_WAIT_MS, ...options.maxWaitMs };
+    for (const provider of Object.keys(this.providerLimits)) {
+      if (this._backgroundLimit(provider) <= 0) {
+        console.warn(`[scheduler] All ${provider} slots are reserved for interactive work; prefetch and batch jobs on it will not run`);
+      }
+    }
+    this.queues = {};
+    this.counters = {};
+    this.waitSamples = {};
+    for (const priority of PRIORITIES) {
+      this.queues[priority] = [];
+      this.counters[priority] = { submitted: 0, started: 0, completed: 0, failed: 0, shed: 0, expired: 0, cancelled: 0, running: 0 };
+      this.waitSamples[priority] = [];
+    }
+    this.active = {};
+  }
+
+  /**
+   * Queue a job and run it when its priority and provider allow
+   *
+   * @param {Function} fn - Called with the time spent queued (ms); may return a promise
+   * @param {object} options - Scheduling options
+   * @param {string|string[]} options.provider - Upstream provider(s) the job holds a slot on
+   * @param {string} options.priority - 'interactive' (default), 'prefetch' or 'batch'
+   * @param {number} options.deadlineMs - Optional time budget; the job expires if it
+   *   is still queued when the budget runs out
+   * @param {string} options.tag - Optional label used to cancel queued jobs
+   * @returns {Promise<*>} The value returned by fn, or a SchedulerRejectedError rejection
+   */
+  schedule(fn, options = {}) {
+    const { provider, priority = 'interactive', deadlineMs, tag } = options;
+    if (!PRIORITIES.includes(priority)) {
+      return Promise.reject(new Error(`Unknown priority: ${priority}`));
+    }
+    const providers = [].concat(provider);
+    const unknown = providers.find((name) => !(name in this.providerLimits));
+    if (providers.length === 0 || unknown !== undefined) {
+      return Promise.reject(new Error(`Unknown provider: ${unknown}`));
+    }
+
+    const counters = this.counters[priority];
+    counters.submitted += 1;
+
+    return new Promise((resolve, reject) => {
+      const queue = this.queues[priority];
+      if (queue.length >= this.queueLimits[priority]) {
+        if (priority === 'prefetch') {
+          // The newest prefetch is closest to where the reader is now
+          this._reject(queue[0], 'shed', 'Replaced by a newer prefetch');
+        } else {
+          counters.shed += 1;
+          reject(new SchedulerRejectedError('shed', `The ${priority} queue is full (${queue.length} jobs)`));
+          return;
+        }
+      }
+
+      const job = { fn, provider: providers.join('+'), providers, priority, tag, resolve, reject, enqueuedAt: Date.now(), timer: null };
+      // A used-up deadline (0) expires the job unless a slot is free right now
+      const waitLimits = [deadlineMs, this.maxWaitMs[priority]].filter((limit) => typeof limit === 'number' && limit >= 0);
+      if (waitLimits.length > 0) {
+        job.timer = setTimeout(() => {
+          this._reject(job, 'expired', `Waited ${Date.now() - job.enqueuedAt}ms in the ${priority} queue`);
+        }, Math.min(...waitLimits));
+      }
+      queue.push(job);
+      this._dispatch();
+    });
+  }
+
+  /**
+   * Cancel queued jobs with the given tag (running jobs are left to finish)
+   *
+   * @param {string} tag - The tag given to schedule()
+   * @returns {number} The number of jobs cancelled
+   */
+  cancel(tag) {
+    let cancelled = 0;
+    for (const priority of PRIORITIES) {
+      for (const job of this.queues[priority].filter((queued) => queued.tag === tag)) {
+        this._reject(job, 'cancelled', `Cancelled (${tag})`);
+        cancelled += 1;
+      }
+    }
+    return cancelled;
+  }
+
+  /**
+   * Queue depth, running jobs, outcome counters and queue wait times per
+   * priority class, plus slot usage per provider
+   *
+   * @returns {object} Scheduler statistics
+   */
+  getStats() {
+    const classes = {};
+    for (const priority of PRIORITIES) {
+      const samples = [...this.waitSamples[priority]].sort((a, b) => a - b);
+      const oldest = this.queues[priority][0];
+      classes[priority] = {
+        queued: this.queues[priority].length,
+        queue_limit: this.queueLimits[priority],
+        ...this.counters[priority],
+        oldest_queued_ms: oldest ? Date.now() - oldest.enqueuedAt : 0,
+        wait_ms: {
+          avg: samples.length ? Math.round(samples.reduce((sum, value) => sum + value, 0) / samples.length) : null,
+          p50: percentile(samples, 50),
+          p95: percentile(samples, 95),
+          max: samples.length ? samples[samples.length - 1] : null
+        }
+      };
+    }
+    const providers = {};
+    for (const [provider, limit] of Object.entries(this.providerLimits)) {
+      providers[provider] = {
+        active: this.active[provider] || 0,
+        limit,
+        background_limit: this._backgroundLimit(provider)
+      };
+    }
+    return { classes, providers };
+  }
+
+  _backgroundLimit(provider) {
+    // May be 0: background work never takes the last interactive slot
+    return this.providerLimits[provider] - (this.reservedInteractive[provider] || 0);
+  }
+
+  _canStart(providers, priority) {
+    return providers.every((provider) => {
+      const active = this.active[provider] || 0;
+      const limit = priority === 'interactive' ? this.providerLimits[provider] : this._backgroundLimit(provider);
+      return active < limit;
+    });
+  }
+
+  _dispatch() {
+    // Highest priority first; within a class, the oldest job whose provider has a free slot
+    for (const priority of PRIORITIES) {
+      const queue = this.queues[priority];
+      for (let index = 0; index < queue.length;) {
+        const job = queue[index];
+        if (this._canStart(job.providers, priority)) {
+          queue.splice(index, 1);
+          this._start(job);
+        } else {
+          index += 1;
+        }
+      }
+    }
+  }
+
+  _start(job) {
+    clearTimeout(job.timer);
+    const waitedMs = Date.now() - job.enqueuedAt;
+    const samples = this.waitSamples[job.priority];
+    samples.push(waitedMs);
+    if (samples.length > WAIT_SAMPLE_SIZE) {
+      samples.shift();
+    }
+
+    const counters = this.counters[job.priority];
+    counters.started += 1;
+    counters.running += 1;
+    for (const provider of job.providers) {
+      this.active[provider] = (this.active[provider] || 0) + 1;
+    }
+
+    Promise.resolve()
+      .then(() => job.fn(waitedMs))
+      .then((result) => {
+        counters.completed += 1;
+        job.resolve(result);
+      }, (error) => {
+        counters.failed += 1;
+        job.reject(error);
+      })
+      .finally(() => {
+        counters.running -= 1;
+        for (const provider of job.providers) {
+          this.active[provider] -= 1;
+        }
+        this._dispatch();
+      });
+  }
+
+  _reject(job, reason, message) {
+    const queue = this.queues[job.priority];
+    const index = queue.indexOf(job);
+    if (index === -1) {
+      return;
+    }
+    queue.splice(index, 1);
+    clearTimeout(job.timer);
+    this.counters[job.priority][reason] += 1;
+    console.warn(`[scheduler] ${job.priority} ${job.provider} job ${reason}: ${message}`);
+    job.reject(new SchedulerRejectedError(reason, message));
+  }
+}
+
+// Shared by all bridge calls in this Node process
+const scheduler = new Scheduler();
+
+module.exports = {
+  PRIORITIES,
+  Scheduler,
+  SchedulerRejectedError,
+  scheduler
+};